@@ -0,0 +1,92 @@
+import logging
+import os
+import random
+import sys
+from decimal import Decimal
+from timeit import Timer
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from market_maker.base import BaseMarketMaker
+from utils.ladder import Ladder
+from utils.utility import TickSize
+
+# Times building and formatting a quote ladder from a spot price, with the
+# Ladder arrays and with the old list of dicts path.
+#
+#   python benchmarks/ladder.py
+
+
+class BenchmarkMarketMaker(BaseMarketMaker):
+    def generate_orders(self):
+        pass
+
+    def sanity_check(self):
+        pass
+
+    def apply_risk_limits(self, buy_orders, sell_orders):
+        return buy_orders, sell_orders
+
+
+class BenchmarkClient:
+    contract_size = Decimal('0.001')
+
+
+def market_maker():
+    mm = object.__new__(BenchmarkMarketMaker)
+    mm.logger = logging.getLogger(__name__)
+    mm.product_id = 1
+    mm.post_only = 'true'
+    mm.ticks = TickSize('0.5')
+    mm.tick_size = mm.ticks.tick_size
+    mm.buy_price_scale_factor = Decimal('0.9995')
+    mm.sell_price_scale_factor = Decimal('1.0005')
+    mm.delta = BenchmarkClient()
+    return mm
+
+
+def ladder_cycle(mm, spot, num_levels):
+    spot_ticks = float(spot / mm.tick_size)
+    sizes = numpy.random.randint(1, 1001, size=(2, num_levels)) / 100
+    return mm.prepare_orders(
+        Ladder.around('buy', spot_ticks, num_levels, sizes[0]),
+        Ladder.around('sell', spot_ticks, num_levels, sizes[1]))
+
+
+def list_cycle(mm, spot, num_levels):
+    buy_orders = []
+    sell_orders = []
+    for i in range(1, num_levels + 1):
+        buy_orders.append({
+            'price': spot - i * mm.tick_size,
+            'size': Decimal(random.randint(1, 1000)) / 100
+        })
+        sell_orders.append({
+            'price': spot + i * mm.tick_size,
+            'size': Decimal(random.randint(1, 1000)) / 100
+        })
+    return mm.prepare_orders(buy_orders, sell_orders)
+
+
+def run(cycle, num_levels, repeat=5):
+    mm = market_maker()
+    spot = Decimal('20000.37')
+    timer = Timer(lambda: cycle(mm, spot, num_levels))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main():
+    logging.disable(logging.INFO)
+    print('%8s %12s %12s' % ('levels', 'ladder ms', 'list ms'))
+    for num_levels in (5, 25, 50, 100, 200):
+        print('%8d %12.3f %12.3f' % (
+            num_levels,
+            run(ladder_cycle, num_levels) * 1000,
+            run(list_cycle, num_levels) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clients.local_exchange import LocalExchange
+
+# End to end order round trips and reconnects of the threaded Delta client
+# against the in-process local exchange.
+#
+#   python benchmarks/local_exchange.py [latency_seconds]
+
+ACCOUNT = {'api_key': 'local', 'api_secret': 'local', 'chain': 'local'}
+
+
+def ladder(delta, num_levels, offset=10):
+    mid = delta.ticks.to_ticks(delta.get_mark_price(delta.product_id))
+    orders = []
+    for i in range(num_levels):
+        for side, price_ticks in (('buy', mid - offset - i), ('sell', mid + offset + i)):
+            orders.append({
+                'product_id': delta.product_id,
+                'limit_price': delta.ticks.to_str(price_ticks),
+                'size': 10,
+                'side': side,
+                'order_type': 'limit_order',
+                'post_only': 'true'
+            })
+    return orders
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def wait_for(condition, timeout=30):
+    started = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - started > timeout:
+            return None
+        time.sleep(0.005)
+    return time.perf_counter() - started
+
+
+def main(latency=0.0):
+    logging.disable(logging.INFO)
+    exchange = LocalExchange(port=0, latency=latency, seed=1).start()
+    os.environ['LOCAL_EXCHANGE_URL'] = exchange.url
+    os.environ['PRODUCT_CACHE_DIR'] = ''
+    from clients.delta import Delta
+
+    delta = Delta(ACCOUNT, ['trading_notifications', 'l2_orderbook', 'positions'],
+                  product_id=1, batch_concurrency=4)
+    print('%-26s %10s %10s' % ('operation', 'orders', 'ms'))
+    for num_levels in (5, 25, 50):
+        orders = ladder(delta, num_levels)
+        seconds, created = timed(delta.batch_create, delta.product_id, orders)
+        created = [order for batch in created for order in batch]
+        print('%-26s %10d %10.1f' % ('batch_create', len(orders), seconds * 1000))
+        edits = [{'id': order['id'], 'product_id': order['product_id'],
+                  'limit_price': order['limit_price'], 'unfilled_size': 20}
+                 for order in created]
+        seconds, _ = timed(delta.batch_edit, delta.product_id, edits)
+        print('%-26s %10d %10.1f' % ('batch_edit', len(edits), seconds * 1000))
+        seconds, _ = timed(delta.batch_cancel, delta.product_id, created)
+        print('%-26s %10d %10.1f' % ('batch_cancel', len(created), seconds * 1000))
+
+    first_book = wait_for(lambda: delta.cached_market_depth(delta.symbol) is not None)
+    print('%-26s %10s %10.1f' % ('first book update', '-', (first_book or 0) * 1000))
+    version = delta.book_version(delta.symbol)
+    exchange.drop_connections()
+    reconnect = wait_for(lambda: delta.book_version(delta.symbol) != version and delta.isConnected())
+    print('%-26s %10s %10s' % ('reconnect to next book', '-',
+                               '%.1f' % (reconnect * 1000) if reconnect is not None else 'timeout'))
+    print('exchange stats: %s' % exchange.stats)
+    delta.disconnect()
+    exchange.stop()
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.0)
@@ -0,0 +1,95 @@
+import logging
+import os
+import random
+import sys
+from decimal import Decimal
+from timeit import Timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from market_maker.base import BaseMarketMaker
+from utils.utility import TickSize
+
+# Times BaseMarketMaker.plan_orders (diff, edit matching and trend) for
+# ladders of increasing depth. Time per level should stay roughly flat.
+#
+#   python benchmarks/order_diff.py
+
+
+class BenchmarkMarketMaker(BaseMarketMaker):
+    def generate_orders(self):
+        pass
+
+    def sanity_check(self):
+        pass
+
+    def apply_risk_limits(self, buy_orders, sell_orders):
+        return buy_orders, sell_orders
+
+
+def market_maker(num_levels, inverse=False):
+    mm = object.__new__(BenchmarkMarketMaker)
+    mm.logger = logging.getLogger(__name__)
+    mm.num_levels = num_levels
+    mm.diff_size_percent = Decimal(5)
+    mm.diff_price_percent = Decimal('0.05')
+    mm.post_only = 'true'
+    mm.product_id = 1
+    mm.ticks = TickSize('0.5')
+    mm.product = {
+        'product_type': 'inverse_future' if inverse else 'future'}
+    return mm
+
+
+def ladder(mm, side, num_levels, best_ticks, rng, open_orders=False):
+    orders = []
+    step = -1 if side == 'buy' else 1
+    for i in range(num_levels):
+        price_ticks = best_ticks + step * i * rng.randint(1, 2)
+        order = {
+            'side': side,
+            'product_id': 1,
+            'price_ticks': price_ticks,
+            'limit_price': mm.ticks.to_str(price_ticks)
+        }
+        if open_orders:
+            order['id'] = len(orders) + (0 if side == 'buy' else num_levels)
+            order['unfilled_size'] = rng.randint(10, 1000)
+        else:
+            order['size'] = rng.randint(10, 1000)
+        orders.append(order)
+    return orders
+
+
+def run(num_levels, inverse=False, repeat=5):
+    rng = random.Random(num_levels)
+    mm = market_maker(num_levels, inverse)
+    mid = 20000
+    # Quotes moved by a few ticks since the last cycle, the usual case
+    old_orders = ladder(mm, 'buy', num_levels, mid - 2, rng, True) + \
+        ladder(mm, 'sell', num_levels, mid + 2, rng, True)
+    buy_orders = ladder(mm, 'buy', num_levels, mid - 5, rng)
+    sell_orders = ladder(mm, 'sell', num_levels, mid + 1, rng)
+
+    def plan():
+        mm.plan_orders([dict(o) for o in old_orders], list(buy_orders),
+                       list(sell_orders))
+
+    timer = Timer(plan)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main():
+    logging.disable(logging.INFO)
+    print('%8s %8s %12s %14s' % ('levels', 'type', 'ms/cycle', 'us/level'))
+    for inverse in (False, True):
+        for num_levels in (5, 25, 50, 100, 200, 400, 800):
+            seconds = run(num_levels, inverse)
+            print('%8d %8s %12.3f %14.2f' % (
+                num_levels, 'inverse' if inverse else 'linear',
+                seconds * 1000, seconds * 1e6 / num_levels))
+
+
+if __name__ == '__main__':
+    main()
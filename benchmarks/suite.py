@@ -0,0 +1,439 @@
+import gc
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clients.delta import Delta
+from market_maker.base import BaseMarketMaker
+from utils.margin_helper import calculateMarginFromLiquidationPrice
+from utils.utility import round_price_by_tick_size
+
+# Per call latency percentiles and allocations of the bot's hot paths on
+# pinned synthetic fixtures, compared against a saved baseline.
+#
+#   python benchmarks/suite.py [--save] [case name filters...]
+#
+# --save writes the results to benchmarks/baseline.json, with filters only
+# the matching cases are replaced. Without it the run
+# is compared with that file and exits with 1 when a case got slower than
+# its tolerance times its baseline median, after correcting for the
+# calibration case. Timings only compare on the same machine and python, re-save the
+# baseline when moving to another one.
+
+SEED = 20200501
+TOLERANCE = 1.3
+# Message dispatch is mostly json decoding and dict churn, which follows the
+# calibration case less closely across machine speeds than the numeric cases
+CASE_TOLERANCES = {'on_message': 1.6}
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+PRODUCT = {
+    'id': 1,
+    'symbol': 'BTCUSD',
+    'product_type': 'future',
+    'contract_type': 'perpetual_futures',
+    'contract_value': '0.001',
+    'tick_size': '0.5',
+    'is_quanto': False,
+    'spot_index': {'symbol': '.DEXBTUSD'}
+}
+MID_TICKS = 40000
+
+LADDER_DEPTHS = (5, 25, 100)
+BOOK_DEPTHS = (20, 100)
+
+
+class BenchmarkMarketMaker(BaseMarketMaker):
+    def generate_orders(self):
+        pass
+
+    def sanity_check(self):
+        pass
+
+    def apply_risk_limits(self, buy_orders, sell_orders):
+        return buy_orders, sell_orders
+
+
+class IdleSocket:
+    connected = True
+
+    def __init__(self):
+        self.sock = self
+
+    def send(self, message):
+        pass
+
+
+def delta_client():
+    delta = object.__new__(Delta)
+    delta.logger = logging.getLogger(__name__)
+    delta.recorder = None
+    delta.exited = True
+    delta.init_stream_state(
+        ['trading_notifications', 'l2_orderbook', 'mark_price', 'spot_price'], 60)
+    delta.init_product(PRODUCT)
+    # on_message is timed through parsing and applying the update, not
+    # just handing it to a consumer thread
+    delta.init_stream_queues(0)
+    delta.product_id = PRODUCT['id']
+    delta.ws = IdleSocket()
+    return delta
+
+
+def market_maker(delta, num_levels):
+    mm = object.__new__(BenchmarkMarketMaker)
+    mm.logger = logging.getLogger(__name__)
+    mm.delta = delta
+    mm.product = delta.product
+    mm.product_id = delta.product_id
+    mm.ticks = delta.ticks
+    mm.tick_size = delta.tick_size
+    mm.num_levels = num_levels
+    mm.min_levels = 1
+    mm.post_only = 'true'
+    mm.diff_size_percent = Decimal(5)
+    mm.diff_price_percent = Decimal('0.05')
+    mm.buy_price_scale_factor = Decimal('0.9995')
+    mm.sell_price_scale_factor = Decimal('1.0005')
+    mm.depth_indexes = {}
+    return mm
+
+
+# Exchange order dicts best price first, as plan_orders hands them over
+def order_ladder(mm, rng, side, num_levels, best_ticks, open_orders=False):
+    step = -1 if side == 'buy' else 1
+    orders = []
+    price_ticks = best_ticks
+    for i in range(num_levels):
+        order = mm.limit_order_format(
+            price_ticks=price_ticks, size=rng.randint(10, 1000), side=side)
+        if open_orders:
+            order['id'] = rng.randint(1, 10 ** 9)
+            order['unfilled_size'] = order['size']
+        orders.append(order)
+        price_ticks += step * rng.randint(1, 2)
+    return orders
+
+
+# generate_orders output, {'price', 'size'} dicts with a few repeated prices
+def quote_levels(mm, rng, side, num_levels):
+    step = -1 if side == 'buy' else 1
+    levels = []
+    price_ticks = MID_TICKS - step * 3
+    for i in range(num_levels):
+        if rng.random() > 0.2:
+            price_ticks += step * rng.randint(1, 3)
+        levels.append({
+            'price': mm.ticks.to_price(price_ticks),
+            'size': Decimal(rng.randint(1, 1000)) / 100
+        })
+    return levels
+
+
+def book_message(rng, num_levels, ticks):
+    def side(step):
+        levels = []
+        price_ticks = MID_TICKS
+        for i in range(num_levels):
+            price_ticks += step * rng.randint(1, 3)
+            levels.append({
+                'limit_price': ticks.to_str(price_ticks),
+                'size': rng.randint(1, 50000)
+            })
+        return levels
+    return {
+        'type': 'l2_orderbook',
+        'symbol': PRODUCT['symbol'],
+        'buy': side(-1),
+        'sell': side(1)
+    }
+
+
+# A websocket minute in miniature: mostly books, some prices and fills
+def message_stream(rng, num_levels, ticks, size=200):
+    frames = []
+    for i in range(size):
+        kind = rng.random()
+        if kind < 0.6:
+            message = book_message(rng, num_levels, ticks)
+        elif kind < 0.8:
+            message = {
+                'type': 'mark_price',
+                'symbol': 'MARK:%s' % PRODUCT['symbol'],
+                'product_id': PRODUCT['id'],
+                'price': ticks.to_str(MID_TICKS + rng.randint(-20, 20))
+            }
+        elif kind < 0.95:
+            message = {
+                'type': 'spot_price',
+                'symbol': PRODUCT['spot_index']['symbol'],
+                'price': ticks.to_str(MID_TICKS + rng.randint(-20, 20))
+            }
+        else:
+            message = {
+                'type': 'fill',
+                'symbol': PRODUCT['symbol'],
+                'product_id': PRODUCT['id'],
+                'order_id': rng.randint(1, 10 ** 9),
+                'size': rng.randint(1, 100)
+            }
+        frames.append(json.dumps(message))
+    return frames
+
+
+def cycle(items):
+    state = {'index': 0}
+
+    def next_item():
+        item = items[state['index'] % len(items)]
+        state['index'] += 1
+        return item
+    return next_item
+
+
+def copies(orders):
+    return [dict(order) for order in orders]
+
+
+# Each case is (name, prepare, run). prepare builds the arguments of one
+# call and is not timed, so cases that mutate their input get fresh copies.
+# Fixed pure Python work with no repo code in it. Comparisons are divided
+# by its change, so a machine that is slower across the board (frequency
+# scaling, a busy neighbour) does not read as a regression.
+def calibration():
+    total = Decimal(0)
+    for i in range(200):
+        total += Decimal(i) / 7
+    return {'total': total}
+
+
+def cases(delta):
+    rng = random.Random(SEED)
+    yield ('calibration', lambda: (), calibration)
+    ticks = delta.ticks
+
+    prices = [ticks.to_price(MID_TICKS) + Decimal(rng.randint(0, 10 ** 6)) / 10 ** 6
+              for i in range(1000)]
+    next_price = cycle(prices)
+    yield ('round_price_by_tick_size', lambda: (next_price(), PRODUCT['tick_size'], 'floor'),
+           round_price_by_tick_size)
+
+    positions = []
+    for i in range(1000):
+        entry_price = ticks.to_price(MID_TICKS + rng.randint(-2000, 2000))
+        size = Decimal(rng.choice((-1, 1)) * rng.randint(1, 100000))
+        distance = entry_price * Decimal(rng.randint(5, 50)) / 100
+        liquidation_price = entry_price - distance if size > 0 else entry_price + distance
+        positions.append((size, entry_price, liquidation_price, Decimal('0.5')))
+    next_position = cycle(positions)
+    for inverse in (False, True):
+        yield ('calculateMarginFromLiquidationPrice[%s]' % ('inverse' if inverse else 'linear'),
+               lambda inverse=inverse: next_position() + (inverse,),
+               calculateMarginFromLiquidationPrice)
+
+    for book_levels in BOOK_DEPTHS:
+        books = [book_message(rng, book_levels, ticks) for i in range(50)]
+        next_book = cycle(books)
+
+        def update_and_read(message, delta=delta):
+            delta.orderbook_updates(message)
+            return delta.market_depth(PRODUCT['symbol'])
+        yield ('market_depth[book=%d]' % book_levels, lambda next_book=next_book: (next_book(),),
+               update_and_read)
+
+        next_frame = cycle(message_stream(rng, book_levels, ticks))
+        yield ('on_message[book=%d]' % book_levels, lambda next_frame=next_frame: (next_frame(),),
+               delta._Delta__on_message)
+
+    for num_levels in LADDER_DEPTHS:
+        mm = market_maker(delta, num_levels)
+        # Quotes moved a few ticks since the last cycle, the usual case
+        old_buy = order_ladder(mm, rng, 'buy', num_levels, MID_TICKS - 2, True)
+        new_buy = order_ladder(mm, rng, 'buy', num_levels, MID_TICKS - 5)
+        for order in old_buy:
+            order['size'] = order['unfilled_size']
+        yield ('calculate_orders_diff[levels=%d]' % num_levels,
+               lambda old_buy=old_buy, new_buy=new_buy: ('buy', old_buy, new_buy),
+               mm.calculate_orders_diff)
+
+        create, delete = mm.calculate_orders_diff('buy', old_buy, new_buy)
+        yield ('get_orders[levels=%d]' % num_levels,
+               lambda create=create, delete=delete: (create, delete),
+               mm.get_orders)
+
+        buy_levels = quote_levels(mm, rng, 'buy', num_levels)
+        sell_levels = quote_levels(mm, rng, 'sell', num_levels)
+        yield ('merge_levels[levels=%d]' % num_levels,
+               lambda buy_levels=buy_levels: (copies(buy_levels),),
+               mm.merge_levels)
+
+        merged_buy = mm.merge_levels(copies(buy_levels))
+        merged_sell = mm.merge_levels(copies(sell_levels))
+        yield ('create_order_format[levels=%d]' % num_levels,
+               lambda merged_buy=merged_buy, merged_sell=merged_sell: (
+                   copies(merged_buy), copies(merged_sell)),
+               mm.create_order_format)
+
+        orders = order_ladder(mm, rng, 'sell', num_levels, MID_TICKS + 2, True)
+        yield ('slice_orders[levels=%d]' % num_levels,
+               lambda orders=orders: (orders,),
+               delta.slice_orders)
+
+
+def tolerance(name):
+    return CASE_TOLERANCES.get(name.split('[')[0], TOLERANCE)
+
+
+def fixture_digest(args):
+    return hashlib.md5(repr(args).encode('utf-8')).hexdigest()[:12]
+
+
+def timed_calls(prepare, run, calls):
+    samples = numpy.empty(calls)
+    clock = time.perf_counter
+    # Every round starts with the same garbage to collect
+    gc.collect()
+    for i in range(calls):
+        args = prepare()
+        started = clock()
+        run(*args)
+        samples[i] = clock() - started
+    return samples * 1e6
+
+
+# Peak traced memory of single calls, kept out of the timed loop as tracing
+# slows every allocation down
+def allocations(prepare, run, calls=200):
+    gc.collect()
+    tracemalloc.start()
+    peaks = numpy.empty(calls)
+    for i in range(calls):
+        args = prepare()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        run(*args)
+        peaks[i] = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return float(numpy.median(peaks)) / 1024
+
+
+# Rounds go over every case in turn, so a burst of load on the machine slows
+# one round of many cases instead of all rounds of one. The quietest round's
+# median is what regressions are judged on.
+def run_suite(filters, rounds=30, calls=100, warmup=200):
+    delta = delta_client()
+    selected = [case for case in cases(delta) if not filters or
+                case[0] == 'calibration' or any(f in case[0] for f in filters)]
+    samples = {}
+    for name, prepare, run in selected:
+        for i in range(warmup):
+            run(*prepare())
+        samples[name] = []
+    for r in range(rounds):
+        for name, prepare, run in selected:
+            samples[name].append(timed_calls(prepare, run, calls))
+
+    results = {}
+    for name, prepare, run in selected:
+        p50 = min(numpy.median(round_samples) for round_samples in samples[name])
+        all_samples = numpy.concatenate(samples[name])
+        p90, p99 = numpy.percentile(all_samples, (90, 99))
+        results[name] = {
+            'p50_us': round(float(p50), 3),
+            'p90_us': round(float(p90), 3),
+            'p99_us': round(float(p99), 3),
+            'max_us': round(float(all_samples.max()), 3),
+            'calls_per_second': round(1e6 / float(all_samples.mean())),
+            'alloc_kib': round(allocations(prepare, run), 3),
+            'fixture': fixture_digest(prepare())
+        }
+    return results
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE):
+        return None
+    with open(BASELINE) as f:
+        return json.load(f)
+
+
+def report(results, baseline):
+    cases = baseline['cases'] if baseline else {}
+    regressions = []
+    machine = 1.0
+    if 'calibration' in cases and 'calibration' in results:
+        machine = results['calibration']['p50_us'] / cases['calibration']['p50_us']
+        print('Machine speed vs baseline: %.2fx slower' % machine)
+    print('%-44s %10s %10s %10s %12s %10s %8s' % (
+        'case', 'p50 us', 'p90 us', 'p99 us', 'calls/s', 'alloc KiB', 'vs base'))
+    for name, result in results.items():
+        base = cases.get(name)
+        if base is None:
+            change = '-'
+        elif base['fixture'] != result['fixture']:
+            change = 'fixture'
+        else:
+            ratio = result['p50_us'] / base['p50_us'] / machine
+            change = '%.2fx' % ratio
+            if ratio > tolerance(name):
+                regressions.append(name)
+                change += ' !'
+        print('%-44s %10.2f %10.2f %10.2f %12d %10.2f %8s' % (
+            name, result['p50_us'], result['p90_us'], result['p99_us'],
+            result['calls_per_second'], result['alloc_kib'], change))
+    return regressions
+
+
+def scaled(results, factor):
+    timings = ('p50_us', 'p90_us', 'p99_us', 'max_us')
+    return {
+        name: dict(result, calls_per_second=round(result['calls_per_second'] / factor),
+                   **{key: round(result[key] * factor, 3) for key in timings})
+        for name, result in results.items()
+    }
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    save = '--save' in args
+    filters = [arg for arg in args if not arg.startswith('--')]
+    results = run_suite(filters)
+    baseline = load_baseline()
+    if baseline and baseline.get('python') != platform.python_version():
+        print('Baseline was saved with python %s' % baseline.get('python'))
+    regressions = report(results, None if save else baseline)
+    if save:
+        saved = baseline['cases'] if baseline and filters else {}
+        if 'calibration' in saved:
+            # Saving some cases keeps the rest and their calibration, the
+            # new timings are scaled to the speed the baseline was saved at
+            results = scaled(results, saved['calibration']['p50_us'] / results.pop('calibration')['p50_us'])
+        saved.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'saved_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'cases': saved
+            }, f, indent=2, sort_keys=True)
+        print('Saved baseline to %s' % BASELINE)
+    elif regressions:
+        print('%d cases slower than their baseline: %s' % (
+            len(regressions), ', '.join('%s (%.1fx)' % (name, tolerance(name)) for name in regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
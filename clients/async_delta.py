@@ -0,0 +1,476 @@
+import asyncio
+import json
+import logging
+from decimal import Decimal
+from time import monotonic
+
+import aiohttp
+from delta_rest_client import cancel_order_format
+from delta_rest_client.delta_rest_client import query_string, body_string
+
+from clients.base import BaseClient
+from clients.feed_health import FeedMonitor
+from clients.delta import DeltaStreamHandlers, OrderState, delta_endpoints, auth_message, subscribe_message, get_time_stamp, generate_signature
+from clients.rest import TIMEOUTS, endpoint_class
+from clients.product_catalog import product_catalog
+import custom_exceptions
+from utils.decorators import handle_async_requests_exceptions
+from utils.metrics import registry as metrics
+from utils.rate_limiter import RateLimiter
+from utils.utility import rest_order_format
+
+
+class AsyncDelta(DeltaStreamHandlers, BaseClient):
+    # asyncio counterpart of Delta: one event loop drives the websocket feed
+    # and pooled REST calls. Every network method is a coroutine.
+    # queue_size is accepted for option compatibility with Delta, handlers
+    # already run on the event loop without blocking the socket
+    def __init__(self, account, channels, product_id, callback=None, order_reconcile_interval=60, batch_concurrency=4, rate_limiter=None, recorder=None, queue_size=None, stale_after=None, ping_after=40, rest_pool_size=None, rest_timeouts=None, rest_keepalive=30):
+        super().__init__()
+        self.logger = logging.getLogger(__name__)
+        self.api_key = account['api_key']
+        self.api_secret = account['api_secret']
+        self.delta_base_url, self.ws_endpoint = delta_endpoints(
+            account['chain'])
+
+        self.product_id = product_id
+        self.callback = callback
+        self.init_stream_state(
+            channels, order_reconcile_interval, stale_after=stale_after)
+        self.recorder = recorder
+        self.exited = True
+        self.closed = False
+        self.reconnecting = False
+        self.monitor = FeedMonitor(self.feed_health, ping_after)
+        self.monitor_task = None
+
+        self.batch_concurrency = batch_concurrency
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.rest_pool_size = rest_pool_size or batch_concurrency * 2
+        self.rest_timeouts = dict(TIMEOUTS, **(rest_timeouts or {}))
+        self.rest_keepalive = rest_keepalive
+        self.rest_stats = {'requests': 0, 'connections': 0, 'reused': 0}
+        self.last_request = monotonic()
+        self.catalog = product_catalog(self.delta_base_url)
+        self.session = None
+        self.keep_alive_task = None
+        self.ws = None
+        self.ws_task = None
+
+    # aiohttp sessions need a running loop, so setup lives outside __init__
+    async def start(self):
+        self.session = self.connect_rc()
+        await self.prewarm()
+        if self.rest_keepalive > 0:
+            self.keep_alive_task = asyncio.ensure_future(self.run_keep_alive())
+        self.init_product(await self.get_product(self.product_id))
+        if self.channels:
+            await self.connect()
+            self.monitor_task = asyncio.ensure_future(self.run_monitor())
+
+    async def close(self):
+        if self.monitor_task is not None:
+            self.monitor_task.cancel()
+        if self.keep_alive_task is not None:
+            self.keep_alive_task.cancel()
+        await self.disconnect()
+        await self.session.close()
+
+    def connect_rc(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.rest_pool_size, keepalive_timeout=60)
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.on_connection_created)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reused)
+        return aiohttp.ClientSession(
+            connector=connector, trace_configs=[trace_config])
+
+    async def on_connection_created(self, session, context, params):
+        self.rest_stats['connections'] += 1
+
+    async def on_connection_reused(self, session, context, params):
+        self.rest_stats['reused'] += 1
+
+    # aiohttp cannot open idle connections, concurrent reads leave one open
+    # for each batch request that may run at once
+    async def prewarm(self):
+        await asyncio.gather(
+            *[self.keep_alive_ping() for _ in range(min(self.batch_concurrency, self.rest_pool_size))],
+            return_exceptions=True)
+
+    async def keep_alive_ping(self):
+        await self.request('GET', 'orderbook/%s/l2' % self.product_id)
+
+    # Keeps a connection open while no requests are sent, see
+    # PooledDeltaRestClient.keep_alive
+    async def run_keep_alive(self):
+        while True:
+            await asyncio.sleep(self.rest_keepalive / 2.0)
+            if monotonic() - self.last_request < self.rest_keepalive:
+                continue
+            try:
+                await self.keep_alive_ping()
+            except Exception as e:
+                self.logger.info('REST keep-alive ping failed: %s' % str(e))
+
+    def transport_stats(self):
+        return dict(self.rest_stats, pool_size=self.rest_pool_size)
+
+    # timeout is a (connect, read) pair in seconds, by default the one for
+    # the endpoint class from rest_timeouts
+    async def request(self, method, path, payload=None, query=None, auth=False, headers=None, raw=False, timeout=None):
+        kind = endpoint_class(method, path)
+        await self.rate_limiter.acquire_async(kind)
+        url = '%s/%s' % (self.delta_base_url, path)
+        if auth:
+            timestamp = get_time_stamp()
+            signature_data = method + timestamp + '/' + path + \
+                query_string(query) + body_string(payload)
+            signature = generate_signature(self.api_secret, signature_data)
+            req_headers = {
+                'api-key': self.api_key,
+                'timestamp': timestamp,
+                'signature': signature,
+                'User-Agent': 'rest-client',
+                'Content-Type': 'application/json'
+            }
+        else:
+            req_headers = {'User-Agent': 'rest-client'}
+        if headers:
+            req_headers.update(headers)
+        if query:
+            query = {key: str(value) for key, value in query.items()}
+
+        connect, read = timeout or self.rest_timeouts[kind]
+        self.rest_stats['requests'] += 1
+        self.last_request = monotonic()
+        async with self.session.request(method, url, data=body_string(payload), params=query, headers=req_headers,
+                                        timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)) as response:
+            text = await response.text()
+            self.rate_limiter.on_status(response.status, response.headers)
+            if response.status >= 400:
+                raise custom_exceptions.HTTPStatusError(response.status, text)
+            # raw returns (status, headers, parsed body or None)
+            if raw:
+                return response.status, response.headers, json.loads(text) if text else None
+            return json.loads(text)
+
+    """     *******     SOCKET METHODS   *******     """
+
+    # See Delta.connect, raises when the socket does not open in time
+    async def connect(self, timeout=5):
+        self.closed = False
+        await self.open_socket(timeout)
+
+    async def open_socket(self, timeout=5):
+        self.auth_acked = asyncio.Event()
+        self.auth_success = False
+        self.ws = await asyncio.wait_for(
+            self.session.ws_connect(self.ws_endpoint, heartbeat=30), timeout)
+        self.logger.info("Delta Websocket Opened.")
+        self.exited = False
+        self.ws_task = asyncio.ensure_future(self.receive())
+        if self.api_key and self.api_secret:
+            await self.ws.send_str(auth_message(self.api_key, self.api_secret))
+            try:
+                await asyncio.wait_for(self.auth_acked.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if not self.auth_success:
+                self.logger.warning('Delta websocket authentication failed')
+        for channel_name in self.channels:
+            self.callbacks[channel_name] = self.callback
+        await self.ws.send_str(subscribe_message(self.channel_subscriptions()))
+
+    async def receive(self):
+        async for message in self.ws:
+            if message.type == aiohttp.WSMsgType.TEXT:
+                received_at = self.clock()
+                if self.recorder is not None:
+                    self.recorder.record(message.data, received_at)
+                self.dispatch_frame(message.data, received_at)
+            elif message.type == aiohttp.WSMsgType.ERROR:
+                self.logger.info(self.ws.exception())
+                break
+        self.logger.info('Delta Websocket Closed.')
+        # Notifications may be missed while disconnected
+        self.order_store.mark_stale()
+        self.position_store.mark_stale()
+        if not self.exited:
+            await self.reconnect()
+
+    async def disconnect(self):
+        self.closed = True
+        self.exited = True
+        if self.ws is not None:
+            await self.ws.close()
+        self.callbacks.clear()
+        self.subscriptions.clear()
+        self.logger.info("Delta Websocket Disconnected.")
+
+    # See Delta.reconnect
+    async def reconnect(self):
+        if self.reconnecting:
+            return
+        self.reconnecting = True
+        try:
+            if self.closed:
+                return
+            started = monotonic()
+            self.exited = True
+            if self.ws is not None:
+                await self.ws.close()
+            resyncs = asyncio.gather(
+                *[call(product_id) for call, product_id in self.resync_calls()],
+                return_exceptions=True)
+            delay = 0.1
+            while True:
+                try:
+                    await self.open_socket()
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.logger.info(
+                        "Couldn't establish connection with Delta websocket: %s" % str(e))
+                if self.closed:
+                    resyncs.cancel()
+                    return
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+            for result in await resyncs:
+                if isinstance(result, Exception):
+                    self.logger.info('Resync after reconnect failed: %s' % str(result))
+            elapsed = monotonic() - started
+            metrics.observe('delta_reconnect_seconds', (), elapsed)
+            self.logger.info('Delta Websocket reconnected in %.3fs' % elapsed)
+        finally:
+            self.reconnecting = False
+
+    def isConnected(self):
+        return self.ws is not None and not self.ws.closed
+
+    async def ping(self):
+        await self.ws.send_str(json.dumps({
+            "type": "ping"
+        }))
+
+    async def run_monitor(self):
+        while True:
+            await asyncio.sleep(self.monitor.interval)
+            try:
+                if self.monitor.check(self.isConnected()):
+                    await self.ping()
+            except Exception as e:
+                self.logger.info('Feed monitor error: %s' % str(e))
+
+    async def subscribeChannel(self, channel_name, symbol, callback=None):
+        symbols = symbol if isinstance(symbol, list) else [symbol]
+        await self.ws.send_str(subscribe_message({channel_name: symbols}))
+        self.add_subscription(channel_name, symbols, callback)
+
+    async def unsubscribeChannel(self, channel_name, symbol=None):
+        symbols = [symbol] if isinstance(symbol, str) else symbol
+        await self.ws.send_str(json.dumps({
+            "type": "unsubscribe",
+            "channels": [
+                {
+                    "name": channel_name,
+                    "symbols": self.remove_subscription(channel_name, symbols)
+                }
+            ]
+        }))
+
+    async def market_depth(self, symbol, levels=None):
+        if self.isConnected():
+            snapshot = self.cached_market_depth(symbol, levels)
+            if snapshot is not None:
+                return snapshot
+        snapshot = await self.getorderbook(self.product_for_symbol(symbol)['id'])
+        return snapshot if levels is None else snapshot.top(levels)
+
+    async def mark_price(self, product_id):
+        if self.isConnected():
+            mark_price = self.cached_mark_price(product_id)
+            if mark_price is not None:
+                return mark_price
+        return await self.get_mark_price(product_id)
+
+    async def spot_price(self, spot_symbol, product_id):
+        if self.isConnected():
+            spot_price = self.cached_spot_price(spot_symbol)
+            if spot_price is not None:
+                return spot_price
+        return await self.get_spot_price(product_id)
+
+    async def open_orders(self, product_id):
+        if self.order_store.needs_reconcile(product_id):
+            self.order_store.reset(await self.get_open_orders(product_id), product_id)
+        return self.order_store.open_orders(product_id)
+
+    # See Delta.position
+    async def position(self, product_id, fresh=False):
+        if not fresh and self.isConnected():
+            position = self.position_store.get(product_id)
+            if position is not None:
+                return position
+        position = await self.get_position_over_rest(product_id)
+        self.position_store.reset(product_id, position)
+        return dict(position)
+
+    """     *******     HTTP METHODS   *******     """
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def getorderbook(self, product_id):
+        orderbook = await self.request("GET", "orderbook/%s/l2" % product_id, auth=True)
+        book = self.orderbooks.book(
+            self.products.get(product_id, self.product)['symbol'])
+        book.apply_snapshot(
+            orderbook['buy_book'], orderbook['sell_book'], price_key='price')
+        return book.snapshot()
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def get_mark_price(self, product_id):
+        orderbook = await self.request("GET", "orderbook/%s/l2" % product_id, auth=True)
+        return Decimal(orderbook['mark_price'])
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def get_spot_price(self, product_id):
+        orderbook = await self.request("GET", "orderbook/%s/l2" % product_id, auth=True)
+        return Decimal(orderbook['spot_price'])
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def get_position_over_rest(self, product_id):
+        positions = await self.request("GET", "positions", query={'product_id': product_id}, auth=True)
+        return self.position_from_response(positions[0] if positions else None, product_id)
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def addPositionMargin(self, product_id, delta_margin):
+        self.position_store.mark_stale(product_id)
+        return await self.request('POST', 'positions/change_margin', {
+            'product_id': product_id,
+            'delta_margin': delta_margin
+        }, auth=True)
+
+    async def get_wallet(self, product_id=None):
+        product = self.products.get(product_id, self.product)
+        return await self.request("GET", "wallet/balance", query={
+            'asset_id': product['settling_asset']['id']
+        }, auth=True)
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def funds(self, product_id=None):
+        response = await self.get_wallet(product_id)
+        return Decimal(response['balance']) - Decimal(response['position_margin'])
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def available_funds(self, product_id=None):
+        response = await self.get_wallet(product_id)
+        return Decimal(response['balance']) - Decimal(response['position_margin']) - Decimal(response['order_margin']) - Decimal(response['commission'])
+
+    async def get_product(self, product_id):
+        product = self.catalog.cached(product_id)
+        if product is None:
+            await self.refresh_catalog()
+            product = self.catalog.get(product_id)
+        return product
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def refresh_catalog(self):
+        headers = {'If-None-Match': self.catalog.etag} if self.catalog.etag else None
+        status, response_headers, products = await self.request(
+            "GET", "products", auth=True, headers=headers, raw=True)
+        if status == 304:
+            self.catalog.revalidated()
+        else:
+            self.catalog.store(products, response_headers.get('ETag'))
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def get_open_orders(self, product_id, state=OrderState.OPEN, page_num=1, page_size=500):
+        query = {
+            'product_id': product_id,
+            'state': state.value,
+            'page_num': page_num,
+            'page_size': page_size
+        }
+        if state.value == 'pending':
+            query['stop_order_type'] = 'stop_loss_order'
+        return await self.request("GET", "orders", query=query, auth=True)
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def set_leverage(self, product_id, leverage):
+        return await self.request("POST", "orders/leverage", {
+            'product_id': product_id,
+            'leverage': leverage
+        }, auth=True)
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def batch_create(self, product_id, orders, trace=None):
+        create_batches = self.slice_orders(orders)
+
+        async def send(create_order):
+            sent = self.clock()
+            response = await self.request("POST", "orders/batch", {
+                'product_id': product_id,
+                'orders': list(map(rest_order_format, create_order))
+            }, auth=True)
+            if trace is not None:
+                trace.request('create', sent, len(create_order))
+            return self.track_orders(response)
+
+        results = await self.dispatch_batches(send, create_batches)
+        self.logger.info('Created orders: %s, batch size: %s' %
+                         (len(orders), len(create_batches)))
+        return results
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def batch_cancel(self, product_id, orders, trace=None):
+        delete_batches = self.slice_orders(orders)
+
+        async def send(delete_order):
+            sent = self.clock()
+            response = await self.request("DELETE", "orders/batch", {
+                'product_id': product_id,
+                'orders': list(map(cancel_order_format, delete_order))
+            }, auth=True)
+            if trace is not None:
+                trace.request('cancel', sent, len(delete_order))
+            self.order_store.remove(delete_order)
+            return response
+
+        results = await self.dispatch_batches(send, delete_batches)
+        self.logger.info('Deleted orders: %s, batch size: %s' %
+                         (len(orders), len(delete_batches)))
+        return results
+
+    @handle_async_requests_exceptions(client='Delta')
+    async def batch_edit(self, product_id, orders, trace=None):
+        edit_batches = self.slice_orders(orders, size=20)
+
+        async def send(edit_order):
+            sent = self.clock()
+            response = await self.request("PUT", "orders/batch", {
+                'product_id': product_id,
+                'orders': list(edit_order)
+            }, auth=True)
+            if trace is not None:
+                trace.request('edit', sent, len(edit_order))
+            return self.track_orders(response)
+
+        results = await self.dispatch_batches(send, edit_batches)
+        self.logger.info('Edited orders: %s' % (len(orders)))
+        return results
+
+    async def dispatch_batches(self, send, batches):
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def bounded_send(batch):
+            async with semaphore:
+                return await send(batch)
+
+        results = await asyncio.gather(*map(bounded_send, batches), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            self.order_store.mark_stale()
+            for error in errors[1:]:
+                self.logger.info('Delta batch error: %s' % str(error))
+            raise errors[0]
+        return results
@@ -0,0 +1,27 @@
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Websocket frame decoders by name. orjson is optional, it parses the
+# l2_orderbook frames several times faster than the stdlib.
+decoders = {'json': json.loads}
+if orjson is not None:
+    decoders['orjson'] = orjson.loads
+
+
+# JSON_DECODER picks the decoder, auto (the default) takes the fastest one
+# installed. A decoder that is not installed falls back to the stdlib.
+def json_decoder(name=None):
+    name = (name or os.getenv('JSON_DECODER', 'auto')).lower()
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in decoders else 'json'
+    if name not in decoders:
+        logging.getLogger(__name__).warning(
+            'JSON decoder %s is not installed, using json' % name)
+        name = 'json'
+    return decoders[name]
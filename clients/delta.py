@@ -1,24 +1,38 @@
-from delta_rest_client import DeltaRestClient, create_order_format, round_by_tick_size, cancel_order_format, OrderType
+from delta_rest_client import create_order_format, round_by_tick_size, cancel_order_format, OrderType
 import logging
 from decimal import Decimal
 import datetime
 import time
 import threading
 import json
+import os
 import base64
 import hmac
 import hashlib
+from collections import OrderedDict
+from functools import partial
 from itertools import islice
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, monotonic
 import requests
 import websocket
-from threading import Timer
 from enum import Enum
 
-from utils.utility import get_position, round_price_by_tick_size
+from utils.utility import get_position, round_price_by_tick_size, rest_order_format, TickSize
 from clients.base import BaseClient
+from clients.orderbook import OrderBookStore
+from clients.order_store import OpenOrderStore
+from clients.position_store import PositionStore
+from clients.rest import PooledDeltaRestClient
+from clients.product_catalog import product_catalog
+from clients.codec import json_decoder
+from clients.stream_queue import ChannelDispatcher
+from clients.feed_health import FeedHealth, FeedMonitor
 import custom_exceptions
 from utils.decorators import handle_requests_exceptions
+from utils.rate_limiter import RateLimiter
+from utils.tracing import MarketStamp, exchange_time
+from utils.metrics import registry as metrics
 
 
 def get_time_stamp():
@@ -33,10 +47,91 @@ def generate_signature(secret, message):
     hash = hmac.new(secret, message, hashlib.sha256)
     return hash.hexdigest()
 
+
+# chain 'local' points at clients.local_exchange, LOCAL_EXCHANGE_URL
+# overrides where it listens
+def delta_endpoints(chain):
+    if chain == 'local':
+        base_url = os.getenv('LOCAL_EXCHANGE_URL', 'http://127.0.0.1:8765')
+        return base_url, base_url.replace('http', 'ws', 1)
+    elif chain == 'testnet':
+        return "https://testnet-api.delta.exchange", "wss://testnet-api.delta.exchange:2096"
+    elif chain == 'mainnet':
+        return "https://api.delta.exchange", "wss://api.delta.exchange:2096"
+    elif chain == 'devnet':
+        return "https://devnet-api.delta.exchange", "wss://devnet-api.delta.exchange:2096"
+    else:
+        raise Exception('InvalidDeltaChain')
+
+
+def auth_message(api_key, api_secret):
+    method = 'GET'
+    timestamp = get_time_stamp()
+    path = '/live'
+    signature_data = method + timestamp + path
+    signature = generate_signature(api_secret, signature_data)
+    return json.dumps({
+        "type": "auth",
+        "payload": {
+            "api-key": api_key,
+            "signature": signature,
+            "timestamp": timestamp
+        }
+    })
+
+
+# One message for every channel, subscriptions maps channel names to
+# lists of symbols
+def subscribe_message(subscriptions):
+    return json.dumps({
+        "type": "subscribe",
+        "payload": {
+            "channels": [
+                {
+                    "name": channel_name,
+                    "symbols": symbols
+                }
+                for channel_name, symbols in subscriptions.items()
+            ]
+        }
+    })
+
+
+metrics.describe('delta_reconnect_seconds',
+                 'Time from a lost websocket to resubscribed with books and positions resynced')
+
 # TODO:
 # Exception handling in Delta
 
 
+TRADING_NOTIFICATIONS = ('fill', 'self_trade', 'pnl', 'liquidation',
+                         'adl', 'stop_trigger', 'stop_cancel')
+
+# Channel consumer each event is handed to by the threaded client. Only the
+# newest book or price per symbol is worth applying. Positions are few and
+# checked for sequence gaps, so they are applied in order like trading
+# notifications.
+STREAM_CHANNELS = {
+    'l2_orderbook': ('l2_orderbook',),
+    'mark_price': ('mark_price',),
+    'spot_price': ('spot_price',),
+    'positions': ('positions',),
+    'trading_notifications': TRADING_NOTIFICATIONS
+}
+LATEST_VALUE_CHANNELS = ('l2_orderbook', 'mark_price', 'spot_price')
+
+# Seconds without an update after which cached market data is not trusted
+# and the feed counts as stale
+STALE_AFTER = {
+    'l2_orderbook': 2.0,
+    'mark_price': 15.0,
+    'spot_price': 15.0
+}
+
+metrics.describe('delta_stream_errors_total',
+                 'Websocket frames that failed to decode or whose handler raised')
+
+
 class OrderState(Enum):
     OPEN = 'open'
     CLOSE = 'closed'
@@ -44,122 +139,460 @@ class OrderState(Enum):
     PENDING = 'pending'
 
 
-class Delta(BaseClient):
-    def __init__(self, account, channels, product_id, callback=None):
-        super().__init__()
-        self.logger = logging.getLogger(__name__)
-        self.timer = Timer(40.0, self.ping)
-        self.api_key = account['api_key']
-        self.api_secret = account['api_secret']
-        if account['chain'] == 'testnet':
-            self.delta_base_url = "https://testnet-api.delta.exchange"
-            self.ws_endpoint = "wss://testnet-api.delta.exchange:2096"
-        elif account['chain'] == 'mainnet':
-            self.delta_base_url = "https://api.delta.exchange"
-            self.ws_endpoint = "wss://api.delta.exchange:2096"
-        elif account['chain'] == 'devnet':
-            self.delta_base_url = "https://devnet-api.delta.exchange"
-            self.ws_endpoint = "wss://devnet-api.delta.exchange:2096"
-        else:
-            raise Exception('InvalidDeltaChain')
-
+# Websocket state shared by the threaded and the asyncio clients. Handlers
+# only touch local state, so they are safe to call from either transport.
+class DeltaStreamHandlers:
+    # clock returns the current time in seconds and monotonic_clock a
+    # monotonic one, replay passes its simulated clock for both.
+    # stale_after overrides entries of STALE_AFTER.
+    def init_stream_state(self, channels, order_reconcile_interval, clock=time.time, stale_after=None, monotonic_clock=monotonic):
+        self.clock = clock
         self.channels = channels
-        self.product_id = product_id
-        self.callback = callback
+        self.stale_after = dict(STALE_AFTER, **(stale_after or {}))
+        # Only subscribed feeds can go stale
+        self.feed_health = FeedHealth({
+            event: seconds for event, seconds in self.stale_after.items()
+            if any(event in STREAM_CHANNELS.get(channel, (channel,)) for channel in channels)
+        }, monotonic_clock)
         self.callbacks = {}
+        # Symbols of each channel subscribed after connecting, as ordered
+        # sets, resubscribed on reconnect
+        self.subscriptions = OrderedDict()
+        # Set when the exchange answers an auth message, clients replace it
+        # with a fresh event for each connection
+        self.auth_acked = threading.Event()
+        self.auth_success = False
+        self.listeners = []
+        self.order_store = OpenOrderStore(order_reconcile_interval)
+        # Without fills over the socket the store cannot be trusted between reads
+        self.order_store.tracking = 'trading_notifications' in channels
+        self.position_store = PositionStore(
+            order_reconcile_interval, monotonic_clock)
+        self.position_store.tracking = 'positions' in channels
         self.data = {
-            'positions': {},
-            'mark_price': {},
-            'l2_orderbook': [],
-            'spot_price': {}
-        }
-        self.last_seen = {
-            'positions': {},
+            'positions': self.position_store.positions,
             'mark_price': {},
+            'l2_orderbook': {},
             'spot_price': {}
         }
-        self.exited = True
-
-        self.delta_client = self.connect_rc()
-
-        self.product = self.get_product(product_id)
+        # Every product streamed over this connection, the first one
+        # registered is the client's own product
+        self.products = {}
+        self.product_ticks = {}
+        self.symbols = []
+        # Latest market data stamp per message symbol, for tracing
+        self.market_stamps = {}
+        self.decode = json_decoder()
+        self.init_handlers()
+
+    def init_handlers(self):
+        self.handlers = {}
+        self.event_errors = {}
+        self.register_handler(
+            'l2_orderbook', self.market_data_handler(self.orderbook_updates))
+        self.register_handler(
+            'mark_price', self.market_data_handler(self.mark_price_update))
+        self.register_handler(
+            'spot_price', self.market_data_handler(self.spot_price_update))
+        self.register_handler(
+            'positions', lambda message, received_at: self.position_updates(message))
+        for event in TRADING_NOTIFICATIONS:
+            self.register_handler(event, self.trading_notification_handler)
+        self.register_handler('auth', self.auth_handler)
+
+    # handler(message, received_at) is called for every message of type
+    # event, replacing any handler registered before
+    def register_handler(self, event, handler):
+        self.handlers[event] = handler
+
+    def market_data_handler(self, update):
+        def handler(message, received_at):
+            symbol = message.get('symbol')
+            self.market_stamps[symbol] = MarketStamp(
+                message['type'], symbol, exchange_time(message), received_at)
+            update(message)
+        return handler
+
+    def auth_handler(self, message, received_at):
+        self.auth_success = bool(message.get('success'))
+        self.auth_acked.set()
+
+    # Every channel to subscribe on connecting: the stream channels for all
+    # products, then the ones subscribed since
+    def channel_subscriptions(self):
+        subscriptions = OrderedDict(
+            (channel_name, OrderedDict.fromkeys(self.symbols)) for channel_name in self.channels)
+        for channel_name, symbols in self.subscriptions.items():
+            subscriptions.setdefault(channel_name, OrderedDict()).update(symbols)
+        return OrderedDict(
+            (channel_name, list(symbols)) for channel_name, symbols in subscriptions.items())
+
+    # Products sharing a connection each subscribe their own symbols
+    def add_subscription(self, channel_name, symbols, callback):
+        self.subscriptions.setdefault(channel_name, OrderedDict()).update(
+            OrderedDict.fromkeys(symbols))
+        self.callbacks[channel_name] = callback
+        for event in STREAM_CHANNELS.get(channel_name, (channel_name,)):
+            if event in self.stale_after and event not in self.feed_health.stale_after:
+                self.feed_health.watch(event, self.stale_after[event])
+
+    # Removes symbols, by default every symbol of the channel, and returns
+    # the ones to unsubscribe
+    def remove_subscription(self, channel_name, symbols=None):
+        subscribed = self.subscriptions.get(channel_name, OrderedDict())
+        if symbols is None:
+            symbols = list(subscribed) or (
+                list(self.symbols) if channel_name in self.channels else [])
+        for symbol in symbols:
+            subscribed.pop(symbol, None)
+        if not subscribed:
+            self.subscriptions.pop(channel_name, None)
+            self.callbacks.pop(channel_name, None)
+        return symbols
+
+    # (method, product_id) pairs fetching the streamed books and positions
+    # over REST, for when the stream was interrupted
+    def resync_calls(self):
+        calls = []
+        if 'l2_orderbook' in self.channels:
+            calls += [(self.getorderbook, product_id) for product_id in self.products]
+        if 'positions' in self.channels:
+            calls += [(partial(self.position, fresh=True), product_id)
+                      for product_id in self.products]
+        return calls
+
+    def trading_notification_handler(self, message, received_at):
+        self.trading_notification_updates(message)
+        callback = self.callbacks.get('trading_notifications')
+        if callback is not None:
+            callback(message)
+
+    def init_product(self, product):
+        self.product = product
         self.contract_size = round_price_by_tick_size(
             self.product['contract_value'], self.product['contract_value'])
-        self.tick_size = round_price_by_tick_size(
-            self.product['tick_size'], self.product['tick_size'])
+        self.ticks = TickSize(self.product['tick_size'])
+        self.tick_size = self.ticks.tick_size
+        self.orderbooks = OrderBookStore(self.ticks, self.clock)
+        self.data['l2_orderbook'] = self.orderbooks.books
         self.isInverse = self.product['product_type'] == 'inverse_future'
         self.isQuanto = self.product['is_quanto']
         self.symbol = self.product['symbol']
+        self.register_product(product)
+
+    def register_product(self, product):
+        if product['id'] in self.products:
+            return
+        ticks = TickSize(product['tick_size'])
+        self.products[product['id']] = product
+        self.product_ticks[product['id']] = ticks
+        self.symbols.append(product['symbol'])
+        self.orderbooks.add_symbol(product['symbol'], ticks)
+
+    def product_for_symbol(self, symbol):
+        for product in self.products.values():
+            if product['symbol'] == symbol:
+                return product
+        return self.product
+
+    # None for frames that are not a JSON object, counted as decode errors
+    def decode_frame(self, frame):
+        try:
+            message = self.decode(frame)
+            if not isinstance(message, dict):
+                raise ValueError('Expected a JSON object')
+        except Exception as e:
+            self.count_error('decode', e)
+            return None
+        self.feed_health.seen(message.get('type'))
+        return message
+
+    # received_at is when the frame came off the socket, now by default
+    def dispatch_frame(self, frame, received_at=None):
+        message = self.decode_frame(frame)
+        if message is not None:
+            self.dispatch_message(message, received_at)
+
+    def dispatch_message(self, message, received_at=None):
+        event = message.get('type')
+        if event is None:
+            if 'message' in message:
+                self.logger.info(message['message'])
+            return
+        if received_at is None:
+            received_at = self.clock()
+        handler = self.handlers.get(event)
+        try:
+            if handler is not None:
+                handler(message, received_at)
+            self.notify_listeners(event, message)
+        except Exception as e:
+            self.count_error(event, e)
+
+    # Must be called from the except block. The first failure of an event
+    # type is logged with its traceback, repeats only every 1000th time.
+    def count_error(self, event, error):
+        count = self.event_errors.get(event, 0) + 1
+        self.event_errors[event] = count
+        metrics.counter('delta_stream_errors_total', (('event', event),)).inc()
+        if count == 1:
+            self.logger.exception('Delta %s handler failed' % event)
+        elif count % 1000 == 0:
+            self.logger.warning('Delta %s handler failed %d times, last error: %s' %
+                                (event, count, error))
+
+    # keys limits a listener to messages whose symbol or product_id is in it
+    def add_listener(self, listener, keys=None):
+        self.listeners.append((listener, keys))
+
+    def remove_listener(self, listener):
+        self.listeners = [
+            entry for entry in self.listeners if entry[0] != listener]
+
+    def notify_listeners(self, event, message):
+        for listener, keys in self.listeners:
+            if keys is None or message.get('symbol') in keys or message.get('product_id') in keys:
+                listener(event, message)
+
+    def orderbook_updates(self, result):
+        self.orderbooks.update(result)
+        self.feed_health.seen_key('l2_orderbook', result['symbol'])
+
+    def trading_notification_updates(self, result):
+        event = result['type']
+        if event == 'fill':
+            self.order_store.apply_fill(result)
+        elif event in ['self_trade', 'liquidation', 'adl', 'stop_trigger']:
+            self.order_store.mark_stale(result.get('product_id'))
+
+    # Normalized like REST positions, so closed positions come out empty
+    def position_updates(self, result):
+        product_id = result['product_id']
+        self.position_store.update(
+            product_id, self.position_from_response(result, product_id), result.get('seq_no'))
+        self.feed_health.seen_key('positions', product_id)
+
+    def mark_price_update(self, result):
+        product_id = result['product_id']
+        self.data['mark_price'][product_id] = Decimal(result['price'])
+        self.feed_health.seen_key('mark_price', product_id)
+
+    def spot_price_update(self, result):
+        spot_symbol = result['symbol']
+        self.data['spot_price'][spot_symbol] = Decimal(result['price'])
+        self.feed_health.seen_key('spot_price', spot_symbol)
+
+    # Ages come from feed_health, on its monotonic clock
+    def fresh(self, event, key):
+        return self.feed_health.age(event, key) < self.stale_after[event]
+
+    def cached_mark_price(self, product_id):
+        if product_id in self.data['mark_price'] and self.fresh('mark_price', product_id):
+            return self.data['mark_price'][product_id]
+        return None
+
+    def cached_spot_price(self, spot_symbol):
+        if spot_symbol in self.data['spot_price'] and self.fresh('spot_price', spot_symbol):
+            return self.data['spot_price'][spot_symbol]
+        return None
+
+    def cached_market_depth(self, symbol, levels=None):
+        orderbook = self.orderbooks.get(symbol)
+        if orderbook and self.fresh('l2_orderbook', symbol):
+            return orderbook.depth(levels)
+        return None
+
+    def book_version(self, symbol):
+        return self.orderbooks.version(symbol)
+
+    # Most recently received market data stamp among symbols
+    def latest_stamp(self, symbols):
+        latest = None
+        for symbol in symbols:
+            stamp = self.market_stamps.get(symbol)
+            if stamp is not None and (latest is None or stamp.received_at > latest.received_at):
+                latest = stamp
+        return latest
+
+    # Age and staleness of each feed as of the last monitor check, a dict
+    # lookup for strategies
+    def feed_state(self):
+        return self.feed_health.state
+
+    def feed_healthy(self):
+        return self.feed_health.healthy()
+
+    def track_orders(self, response):
+        if isinstance(response, list):
+            self.order_store.update(response)
+        else:
+            self.order_store.mark_stale()
+        return response
+
+    def position_from_response(self, positions, product_id=None):
+        if positions and int(positions['size']) != 0:
+            ticks = self.product_ticks.get(product_id, self.ticks)
+            position = get_position(
+                entry_price=ticks.round(positions['entry_price']),
+                size=int(positions['size'])
+            )
+            position['margin'] = Decimal(positions['margin'])
+            position['liquidation_price'] = Decimal(
+                positions['liquidation_price'])
+            return position
+        else:
+            # RETURN EMPTY POSITION ONLY IF NO OPEN POSITIONS IS FOUND
+            position = get_position()
+            position['margin'] = 0
+            position['liquidation_price'] = None
+            self.logger.info(position)
+            return position
+
+    def slice_orders(self, orders, size=5):
+        orders = iter(orders)
+        return list(iter(lambda: tuple(islice(orders, size)), ()))
+
+
+class Delta(DeltaStreamHandlers, BaseClient):
+    def __init__(self, account, channels, product_id, callback=None, order_reconcile_interval=60, batch_concurrency=4, rate_limiter=None, product_ids=None, recorder=None, queue_size=1024, stale_after=None, ping_after=40, rest_pool_size=None, rest_timeouts=None, rest_keepalive=30):
+        super().__init__()
+        self.logger = logging.getLogger(__name__)
+        self.ws = None
+        self.api_key = account['api_key']
+        self.api_secret = account['api_secret']
+        self.delta_base_url, self.ws_endpoint = delta_endpoints(
+            account['chain'])
+
+        self.product_id = product_id
+        self.callback = callback
+        self.init_stream_state(
+            channels, order_reconcile_interval, stale_after=stale_after)
+        self.queue_size = queue_size
+        self.recorder = recorder
+        self.exited = True
+        self.closed = False
+        self.reconnect_lock = threading.Lock()
+        self.ws_opened = threading.Event()
+        self.ping_after = ping_after
+
+        self.batch_concurrency = batch_concurrency
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # Batch workers plus reads from the strategy and the keep-alive
+        self.rest_pool_size = rest_pool_size or batch_concurrency + 2
+        self.rest_timeouts = rest_timeouts
+        self.rest_keepalive = rest_keepalive
+        self.start_workers()
+        self.catalog = product_catalog(self.delta_base_url)
+
+        # product_ids are streamed over the same connection as product_id
+        if product_ids:
+            products = self.get_products([product_id] + list(product_ids))
+            self.init_product(products[product_id])
+            for pid in product_ids:
+                self.register_product(products[pid])
+        else:
+            self.init_product(self.get_product(product_id))
         if self.channels:
             self.connect()
+            self.monitor.start(self.ping, self.isConnected)
 
     def __auth(self):
         if not self.ws:
             raise Exception('Need to establish a socket connection first')
-        method = 'GET'
-        timestamp = get_time_stamp()
-        path = '/live'
-        signature_data = method + timestamp + path
-        signature = generate_signature(self.api_secret, signature_data)
-        self.ws.send(json.dumps({
-            "type": "auth",
-            "payload": {
-                "api-key": self.api_key,
-                "signature": signature,
-                "timestamp": timestamp
-            }
-        }))
+        self.ws.send(auth_message(self.api_key, self.api_secret))
 
     def __on_error(self, error):
         self.logger.info(error)
 
     def __on_open(self):
         self.logger.info("Delta Websocket Opened.")
+        self.ws_opened.set()
 
     def __on_close(self):
         self.logger.info('Delta Websocket Closed.')
-        if not self.exited:
+        # Notifications may be missed while disconnected
+        self.order_store.mark_stale()
+        self.position_store.mark_stale()
+        # A replaced socket closing late leaves the new one alone
+        if not self.exited and not self.isConnected():
             self.reconnect()
 
+    # The websocket thread only decodes and queues, channel consumers apply
+    # the updates and run callbacks
     def __on_message(self, message):
-        self.__restart_ping_timer()
-        try:
-            message = json.loads(message)
-            if 'type' in message:
-                event = message['type']
-                if event == 'l2_orderbook':
-                    self.orderbook_updates(message)
-                elif event in ['fill', 'self_trade', 'pnl', 'liquidation', 'adl', 'stop_trigger', 'stop_cancel']:
-                    if 'trading_notifications' in self.callbacks:
-                        self.callbacks['trading_notifications'](message)
-                elif event == 'positions':
-                    self.position_updates(message)
-                elif event == 'mark_price':
-                    self.mark_price_update(message)
-                elif event == 'spot_price':
-                    self.spot_price_update(message)
-                else:
-                    pass
-            elif 'message' in message:
-                self.logger.info(message['message'])
-        except Exception:
-            pass
-
-    def __restart_ping_timer(self):
-        if self.timer.isAlive():
-            self.timer.cancel()
-        self.timer = Timer(40.0, self.ping)
-        self.timer.start()
+        received_at = self.clock()
+        if self.recorder is not None:
+            self.recorder.record(message, received_at)
+        if self.stream is None:
+            self.dispatch_frame(message, received_at)
+            return
+        message = self.decode_frame(message)
+        if message is not None:
+            self.stream.put(message, received_at)
+
+    # queue_size 0 applies every message on the websocket thread
+    def init_stream_queues(self, queue_size):
+        self.stream = None
+        if queue_size:
+            self.stream = ChannelDispatcher(
+                self.dispatch_message, self.stream_overflow, STREAM_CHANNELS,
+                LATEST_VALUE_CHANNELS, maxsize=queue_size)
+
+    def stream_overflow(self, channel, message):
+        # A lost fill leaves the local open orders wrong until reconciled
+        if channel == 'trading_notifications':
+            self.order_store.mark_stale(message.get('product_id'))
+        elif channel == 'positions':
+            self.position_store.mark_stale(message.get('product_id'))
+        self.logger.warning('Delta %s queue full, dropped %s' %
+                            (channel, message.get('type')))
+
+    # Depth, high watermark and drops of each channel queue
+    def queue_stats(self):
+        return self.stream.stats() if self.stream is not None else {}
+
+    # REST requests and connections, see PooledDeltaRestClient.stats
+    def transport_stats(self):
+        return self.delta_client.stats()
+
+    # Stream consumers, feed monitor, batch workers and the REST session.
+    # disconnect stops them and a later connect starts new ones.
+    def start_workers(self):
+        self.init_stream_queues(self.queue_size)
+        self.monitor = FeedMonitor(self.feed_health, self.ping_after)
+        self.batch_executor = ThreadPoolExecutor(
+            max_workers=self.batch_concurrency)
+        self.delta_client = self.connect_rc().prewarm()
+        self.delta_client.keep_alive(
+            self.rest_keepalive, lambda: self.delta_client.get_L2_orders(self.product_id))
 
     def connect_rc(self):
-        delta_client = DeltaRestClient(
+        delta_client = PooledDeltaRestClient(
             base_url=self.delta_base_url,
             api_key=self.api_key,
-            api_secret=self.api_secret
+            api_secret=self.api_secret,
+            pool_size=self.rest_pool_size,
+            rate_limiter=self.rate_limiter,
+            timeouts=self.rest_timeouts
         )
         return delta_client
 
-    def connect(self):
+    # Waits for the open and auth acknowledgement events, up to timeout
+    # seconds each, then subscribes every channel in one message. False
+    # when the socket did not open.
+    def connect(self, timeout=5):
+        if self.closed:
+            self.start_workers()
+            self.monitor.start(self.ping, self.isConnected)
+        self.closed = False
+        return self.open_socket(timeout)
+
+    # connect without clearing closed, so reconnect gives up once
+    # disconnect was called
+    def open_socket(self, timeout=5):
+        self.ws_opened = threading.Event()
+        self.auth_acked = threading.Event()
+        self.auth_success = False
         self.ws = websocket.WebSocketApp(self.ws_endpoint,
                                          on_message=self.__on_message,
                                          on_close=self.__on_close,
@@ -171,184 +604,152 @@ class Delta(BaseClient):
         self.wst.daemon = True
         self.wst.start()
 
-        conn_timeout = 5
-        while not self.ws.sock or not self.ws.sock.connected and conn_timeout:
-            sleep(1)
-            conn_timeout -= 1
-        if not conn_timeout:
-            self.logger.debug(
-                "Couldn't establish connetion with Delta websocket")
-        else:
-            self.exited = False
-            if self.api_key and self.api_secret:
-                self.__auth()
-                sleep(2)
-            for channel_name in self.channels:
-                self.subscribeChannel(channel_name, self.symbol, self.callback)
+        if not self.ws_opened.wait(timeout):
+            self.logger.info(
+                "Couldn't establish connection with Delta websocket")
+            # A socket opening late would feed the handlers twice
+            self.ws.close()
+            return False
+        self.exited = False
+        if self.api_key and self.api_secret:
+            self.__auth()
+            if not self.auth_acked.wait(timeout) or not self.auth_success:
+                self.logger.warning('Delta websocket authentication failed')
+        for channel_name in self.channels:
+            self.callbacks[channel_name] = self.callback
+        self.ws.send(subscribe_message(self.channel_subscriptions()))
+        return True
 
     def is_thread_alive(self):
         return (self.wst and self.wst.is_alive())
 
     def disconnect(self):
+        self.closed = True
         self.exited = True
-        self.timer.cancel()
-        self.ws.close()
+        if self.ws is not None:
+            self.ws.close()
         self.callbacks.clear()
+        self.subscriptions.clear()
+        # reconnect keeps all of these running, connect starts them again
+        self.monitor.stop()
+        if self.stream is not None:
+            self.stream.close()
+        self.delta_client.close()
+        self.batch_executor.shutdown(wait=False)
         # self.wst.join()
         self.logger.info("Delta Websocket Disconnected.")
 
+    # Books and positions are fetched over REST while the new socket opens,
+    # authenticates and resubscribes. Retries with backoff until connected
+    # or disconnect is called, a reconnect already running is left to finish.
     def reconnect(self):
-        self.disconnect()
-        self.connect()
+        if not self.reconnect_lock.acquire(blocking=False):
+            return
+        try:
+            if self.closed:
+                return
+            started = monotonic()
+            self.exited = True
+            if self.ws is not None:
+                self.ws.close()
+            resyncs = [self.batch_executor.submit(call, product_id)
+                       for call, product_id in self.resync_calls()]
+            delay = 0.1
+            while not self.open_socket():
+                if self.closed:
+                    return
+                sleep(delay)
+                delay = min(delay * 2, 5)
+            for resync in resyncs:
+                try:
+                    resync.result()
+                except Exception as e:
+                    self.logger.info('Resync after reconnect failed: %s' % str(e))
+            elapsed = monotonic() - started
+            metrics.observe('delta_reconnect_seconds', (), elapsed)
+            self.logger.info('Delta Websocket reconnected in %.3fs' % elapsed)
+        finally:
+            self.reconnect_lock.release()
 
     def isConnected(self):
-        return self.ws.sock and self.ws.sock.connected
+        return self.ws is not None and bool(self.ws.sock and self.ws.sock.connected)
 
     def ping(self):
         self.ws.send(json.dumps({
             "type": "ping"
         }))
 
-    def orderbook_updates(self, result):
-        orderbooks = list(filter(
-            lambda x: x['symbol'] == result['symbol'], self.data['l2_orderbook']
-        ))
-
-        if orderbooks:
-            orderbook = orderbooks[0]
-            orderbook['last_seen'] = time.time()
-            orderbook['bids'] = result['buy']
-            orderbook['asks'] = result['sell']
-        else:
-            orderbook = {
-                'last_seen': time.time(),
-                'symbol': result['symbol'],
-                'asks': result['buy'],
-                'bids': result['sell']
-            }
-            self.data['l2_orderbook'].append(orderbook)
-
-    def position_updates(self, result):
-        product_id = result['product_id']
-        position = get_position(
-            entry_price=round_price_by_tick_size(
-                result['entry_price'], self.tick_size),
-            size=int(result['size'])
-        )
-        position['margin'] = Decimal(result['margin'])
-        position['liquidation_price'] = Decimal(result['liquidation_price'])
-        self.data['positions'][product_id] = position
-        self.last_seen['positions'][product_id] = time.time()
-
-    def mark_price_update(self, result):
-        product_id = result['product_id']
-        self.data['mark_price'][product_id] = Decimal(result['price'])
-        self.last_seen['mark_price'][product_id] = time.time()
-
-    def spot_price_update(self, result):
-        spot_symbol = result['symbol']
-        self.data['spot_price'][spot_symbol] = Decimal(result['price'])
-        self.last_seen['spot_price'][spot_symbol] = time.time()
-
     """     *******     SOCKET METHODS   *******     """
 
+    # symbol may be a list to subscribe several products in one message
     def subscribeChannel(self, channel_name, symbol, callback=None):
-        self.ws.send(json.dumps({
-            "type": "subscribe",
-            "payload": {
-                "channels": [
-                    {
-                        "name": channel_name,
-                        "symbols": [symbol]
-                    }
-                ]
-            }
-        }))
-        self.callbacks[channel_name] = callback
+        symbols = symbol if isinstance(symbol, list) else [symbol]
+        self.ws.send(subscribe_message({channel_name: symbols}))
+        self.add_subscription(channel_name, symbols, callback)
 
-    def unsubscribeChannel(self, channel_name):
+    # symbol may be a list, by default every symbol of the channel
+    def unsubscribeChannel(self, channel_name, symbol=None):
+        symbols = [symbol] if isinstance(symbol, str) else symbol
         self.ws.send(json.dumps({
             "type": "unsubscribe",
             "channels": [
                     {
                         "name": channel_name,
-                        "symbols": [self.symbol]
+                        "symbols": self.remove_subscription(channel_name, symbols)
                     }
             ]
         }
         ))
-        if channel_name in self.callbacks:
-            del self.callbacks[channel_name]
-
-    def market_depth(self, symbol):
-        if self.isConnected() and 'l2_orderbook' in self.data:
-            orderbooks = list(filter(
-                lambda x: x['symbol'] == symbol, self.data['l2_orderbook']
-            ))
-            if orderbooks and time.time() - orderbooks[0]['last_seen'] < 2:
-                asks = list(map(
-                    lambda x: {
-                        'price': round_price_by_tick_size(x['limit_price'], self.tick_size),
-                        'size': int(x['size'])
-                    }, orderbooks[0]['asks']
-                ))
-                bids = list(map(
-                    lambda x: {
-                        'price': round_price_by_tick_size(x['limit_price'], self.tick_size),
-                        'size': int(x['size'])
-                    }, orderbooks[0]['bids']
-                ))
-                bids = list(filter(
-                    lambda x: Decimal(x['price']) > self.tick_size,
-                    bids
-                ))
-                asks.sort(key=lambda x: x['price'])
-                bids.sort(key=lambda x: x['price'], reverse=True)
-                return {'asks': asks, 'bids': bids}
-        return self.getorderbook(self.product_id)
+
+    def market_depth(self, symbol, levels=None):
+        if self.isConnected():
+            snapshot = self.cached_market_depth(symbol, levels)
+            if snapshot is not None:
+                return snapshot
+        snapshot = self.getorderbook(self.product_for_symbol(symbol)['id'])
+        return snapshot if levels is None else snapshot.top(levels)
 
     def mark_price(self, product_id):
-        if self.isConnected() and 'mark_price' in self.data:
-            if product_id in self.data['mark_price'] and time.time() - self.last_seen['mark_price'][product_id] < 15:
-                return self.data['mark_price'][product_id]
+        if self.isConnected():
+            mark_price = self.cached_mark_price(product_id)
+            if mark_price is not None:
+                return mark_price
         return self.get_mark_price(product_id)
 
     def spot_price(self, spot_symbol, product_id):
-        if self.isConnected() and 'spot_price' in self.data:
-            if spot_symbol in self.data['spot_price'] and time.time() - self.last_seen['spot_price'][spot_symbol] < 15:
-                return self.data['spot_price'][spot_symbol]
+        if self.isConnected():
+            spot_price = self.cached_spot_price(spot_symbol)
+            if spot_price is not None:
+                return spot_price
         return self.get_spot_price(product_id)
 
-    def position(self, product_id):
-        # if self.isConnected():
-        #     if product_id in self.data['positions'] and time.time() - self.last_seen['positions'][product_id] < 15:
-        #         return self.data['positions'][product_id]
-        # Get position from rest and set locally
+    def open_orders(self, product_id):
+        if self.order_store.needs_reconcile(product_id):
+            self.order_store.reset(
+                self.get_open_orders(product_id), product_id)
+        return self.order_store.open_orders(product_id)
+
+    # Served from the positions channel, read over REST when the stream may
+    # have missed an update or fresh is set
+    def position(self, product_id, fresh=False):
+        if not fresh and self.isConnected():
+            position = self.position_store.get(product_id)
+            if position is not None:
+                return position
         position = self.get_position_over_rest(product_id)
-        self.data['positions'][product_id] = position
-        self.last_seen['positions'][product_id] = time.time()
-        return position
+        self.position_store.reset(product_id, position)
+        return dict(position)
 
     """     *******     HTTP METHODS   *******     """
 
     @handle_requests_exceptions(client='Delta')
     def getorderbook(self, product_id):
         orderbook = self.delta_client.get_L2_orders(product_id, auth=True)
-        asks = list(map(
-            lambda x: {
-                'price': round_price_by_tick_size(x['price'], self.tick_size),
-                'size': int(x['size'])
-            }, orderbook['sell_book']
-        ))
-        bids = list(map(
-            lambda x: {
-                'price': round_price_by_tick_size(x['price'], self.tick_size),
-                'size': int(x['size'])
-            }, orderbook['buy_book']
-        ))
-        asks.sort(key=lambda x: x['price'])
-        bids.sort(key=lambda x: x['price'], reverse=True)
-        return {'asks': asks, 'bids': bids}
+        book = self.orderbooks.book(
+            self.products.get(product_id, self.product)['symbol'])
+        book.apply_snapshot(
+            orderbook['buy_book'], orderbook['sell_book'], price_key='price')
+        return book.snapshot()
 
     @handle_requests_exceptions(client='Delta')
     def get_mark_price(self, product_id):
@@ -364,47 +765,50 @@ class Delta(BaseClient):
     @handle_requests_exceptions(client='Delta')
     def get_position_over_rest(self, product_id):
         positions = self.delta_client.get_position(product_id)
-        if positions and int(positions['size']) != 0:
-            position = get_position(
-                entry_price=round_price_by_tick_size(
-                    positions['entry_price'], self.tick_size),
-                size=int(positions['size'])
-            )
-            position['margin'] = Decimal(positions['margin'])
-            position['liquidation_price'] = Decimal(
-                positions['liquidation_price'])
-            return position
-        else:
-            # RETURN EMPTY POSITION ONLY IF NO OPEN POSITIONS IS FOUND
-            position = get_position()
-            position['margin'] = 0
-            position['liquidation_price'] = None
-            self.logger.info(position)
-            return position
+        return self.position_from_response(positions, product_id)
 
     @handle_requests_exceptions(client='Delta')
     def addPositionMargin(self, product_id, delta_margin):
+        self.position_store.mark_stale(product_id)
         return self.delta_client.change_position_margin(product_id, delta_margin)
 
     @handle_requests_exceptions(client='Delta')
-    def funds(self):
+    def funds(self, product_id=None):
+        product = self.products.get(product_id, self.product)
         response = self.delta_client.get_wallet(
-            self.product['settling_asset']['id'])
+            product['settling_asset']['id'])
         return Decimal(response['balance']) - Decimal(response['position_margin'])
 
     @handle_requests_exceptions(client='Delta')
-    def available_funds(self):
+    def available_funds(self, product_id=None):
+        product = self.products.get(product_id, self.product)
         response = self.delta_client.get_wallet(
-            self.product['settling_asset']['id'])
+            product['settling_asset']['id'])
         return Decimal(response['balance']) - Decimal(response['position_margin']) - Decimal(response['order_margin']) - Decimal(response['commission'])
 
-    @handle_requests_exceptions(client='Delta')
     def get_product(self, product_id):
-        response = self.delta_client.request("GET", "products", auth=True)
-        response = response.json()
-        products = list(
-            filter(lambda x: x['id'] == product_id, response))
-        return products[0] if len(products) > 0 else None
+        product = self.catalog.cached(product_id)
+        if product is None:
+            self.refresh_catalog()
+            product = self.catalog.get(product_id)
+        return product
+
+    def get_products(self, product_ids):
+        if any(self.catalog.cached(pid) is None for pid in product_ids):
+            self.refresh_catalog()
+        return {pid: self.catalog.get(pid) for pid in product_ids}
+
+    # Revalidates the shared product catalog, the products list is only
+    # downloaded when it changed since our cached ETag
+    @handle_requests_exceptions(client='Delta')
+    def refresh_catalog(self):
+        headers = {'If-None-Match': self.catalog.etag} if self.catalog.etag else None
+        response = self.delta_client.request(
+            "GET", "products", auth=True, headers=headers)
+        if response.status_code == 304:
+            self.catalog.revalidated()
+        else:
+            self.catalog.store(response.json(), response.headers.get('ETag'))
 
     @handle_requests_exceptions(client='Delta')
     def get_open_orders(self, product_id, state=OrderState.OPEN, page_num=1, page_size=500):
@@ -469,34 +873,126 @@ class Delta(BaseClient):
         return response
 
     @handle_requests_exceptions(client='Delta')
-    def batch_create(self, product_id, orders):
+    def batch_create(self, product_id, orders, trace=None):
         create_batches = self.slice_orders(orders)
-        for create_order in create_batches:
-            self.delta_client.batch_create(
-                product_id, list(create_order))
+
+        def send(create_order):
+            sent = self.clock()
+            response = self.delta_client.batch_create(
+                product_id, list(map(rest_order_format, create_order)))
+            if trace is not None:
+                trace.request('create', sent, len(create_order))
+            return self.track_orders(response)
+
+        results = self.dispatch_batches(send, create_batches)
         self.logger.info('Created orders: %s, batch size: %s' %
                          (len(orders), len(create_batches)))
+        return results
 
     @handle_requests_exceptions(client='Delta')
-    def batch_cancel(self, product_id, orders):
+    def batch_cancel(self, product_id, orders, trace=None):
         delete_batches = self.slice_orders(orders)
-        for delete_order in delete_batches:
-            self.delta_client.batch_cancel(self.product_id,
-                                           list(map(
-                                                cancel_order_format, list(
-                                                    delete_order)
-                                                ))
-                                           )
+
+        def send(delete_order):
+            sent = self.clock()
+            response = self.delta_client.batch_cancel(product_id,
+                                                      list(map(
+                                                          cancel_order_format, list(
+                                                              delete_order)
+                                                      ))
+                                                      )
+            if trace is not None:
+                trace.request('cancel', sent, len(delete_order))
+            self.order_store.remove(delete_order)
+            return response
+
+        results = self.dispatch_batches(send, delete_batches)
         self.logger.info('Deleted orders: %s, batch size: %s' %
                          (len(orders), len(delete_batches)))
+        return results
 
     @handle_requests_exceptions(client='Delta')
-    def batch_edit(self, product_id, orders):
+    def batch_edit(self, product_id, orders, trace=None):
         edit_batches = self.slice_orders(orders, size=20)
-        for edit_order in edit_batches:
-            self.delta_client.batch_edit(product_id, list(edit_order))
+
+        def send(edit_order):
+            sent = self.clock()
+            response = self.delta_client.batch_edit(
+                product_id, list(edit_order))
+            if trace is not None:
+                trace.request('edit', sent, len(edit_order))
+            return self.track_orders(response)
+
+        results = self.dispatch_batches(send, edit_batches)
         self.logger.info('Edited orders: %s' % (len(orders)))
+        return results
+
+    # Send independent batches concurrently, at most batch_concurrency in
+    # flight. Every batch runs to completion before the first error is raised
+    # so results of the successful ones are not lost.
+    def dispatch_batches(self, send, batches):
+        if len(batches) == 1:
+            try:
+                return [send(batches[0])]
+            except Exception:
+                self.order_store.mark_stale()
+                raise
+        futures = [self.batch_executor.submit(send, batch)
+                   for batch in batches]
+        results = []
+        errors = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            self.order_store.mark_stale()
+            for error in errors[1:]:
+                self.logger.info('Delta batch error: %s' % str(error))
+            raise errors[0]
+        return results
+
+
+# One product's view of a Delta connection shared by several strategies.
+# Product attributes are local, everything else is delegated to the shared
+# client. The connection belongs to whoever created the Delta instance.
+class DeltaProductView:
+    def __init__(self, delta, product_id):
+        self.delta = delta
+        self.product = delta.products[product_id]
+        self.product_id = product_id
+        self.symbol = self.product['symbol']
+        self.ticks = delta.product_ticks[product_id]
+        self.tick_size = self.ticks.tick_size
+        self.contract_size = round_price_by_tick_size(
+            self.product['contract_value'], self.product['contract_value'])
+        self.isInverse = self.product['product_type'] == 'inverse_future'
+        self.isQuanto = self.product['is_quanto']
 
-    def slice_orders(self, orders, size=5):
-        orders = iter(orders)
-        return list(iter(lambda: tuple(islice(orders, size)), ()))
+    def __getattr__(self, name):
+        return getattr(self.delta, name)
+
+    def listener_keys(self):
+        return {
+            self.product_id,
+            self.symbol,
+            'MARK:%s' % self.symbol,
+            self.product['spot_index']['symbol']
+        }
+
+    def add_listener(self, listener, keys=None):
+        self.delta.add_listener(
+            listener, self.listener_keys() if keys is None else keys)
+
+    def funds(self, product_id=None):
+        return self.delta.funds(product_id or self.product_id)
+
+    def available_funds(self, product_id=None):
+        return self.delta.available_funds(product_id or self.product_id)
+
+    def disconnect(self):
+        pass
+
+    def reconnect(self):
+        pass
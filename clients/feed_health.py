@@ -0,0 +1,115 @@
+import logging
+import threading
+from time import monotonic
+
+
+class FeedHealth:
+    # Last receive time of every websocket event type, and of each symbol or
+    # product of the event types that carry many. seen() is a pair of
+    # stores on the receive path, publish() runs on the monitor and swaps in
+    # a new state dict that strategies can read without locking.
+    # stale_after maps event types to the seconds of silence after which
+    # their feed counts as stale, other event types never go stale.
+    def __init__(self, stale_after, clock=monotonic, name='Delta'):
+        self.logger = logging.getLogger(__name__)
+        self.stale_after = stale_after
+        self.clock = clock
+        self.name = name
+        self.last_seen = {}
+        self.key_last_seen = {}
+        self.last_message = None
+        self.state = {}
+
+    # Starts tracking event, for feeds subscribed after construction. The
+    # thresholds are swapped, not changed in place, as publish may be
+    # iterating over them.
+    def watch(self, event, stale_after):
+        self.stale_after = dict(self.stale_after, **{event: stale_after})
+
+    def seen(self, event):
+        now = self.clock()
+        self.last_message = now
+        self.last_seen[event] = now
+
+    def seen_key(self, event, key):
+        self.key_last_seen[(event, key)] = self.clock()
+
+    # Seconds since anything was received
+    def idle(self):
+        if self.last_message is None:
+            return float('inf')
+        return self.clock() - self.last_message
+
+    # Of key when given, the event type as a whole otherwise
+    def age(self, event, key=None):
+        if key is None:
+            last_seen = self.last_seen.get(event)
+        else:
+            last_seen = self.key_last_seen.get((event, key))
+        if last_seen is None:
+            return float('inf')
+        return self.clock() - last_seen
+
+    def is_stale(self, event):
+        stale_after = self.stale_after.get(event)
+        return stale_after is not None and self.age(event) >= stale_after
+
+    def healthy(self):
+        return not any(entry['stale'] for entry in self.state.values())
+
+    def publish(self):
+        state = {}
+        for event, stale_after in self.stale_after.items():
+            age = self.age(event)
+            state[event] = {'age': age, 'stale': age >= stale_after}
+            was_stale = self.state.get(event, {}).get('stale')
+            if state[event]['stale'] and was_stale is False:
+                self.logger.info('%s %s feed stale, nothing for %.1fs' %
+                                 (self.name, event, age))
+            elif was_stale and not state[event]['stale']:
+                self.logger.info('%s %s feed recovered' % (self.name, event))
+        self.state = state
+        return state
+
+
+class FeedMonitor:
+    # Publishes feed health every interval and pings the exchange when the
+    # connection has been idle for ping_after seconds, at most once per
+    # ping_after. Replaces restarting a ping timer on every message.
+    def __init__(self, health, ping_after=40, interval=1.0):
+        self.logger = logging.getLogger(__name__)
+        self.health = health
+        self.ping_after = ping_after
+        self.interval = interval
+        self.last_ping = None
+        self.stopped = threading.Event()
+
+    # True when a ping is due
+    def check(self, connected):
+        self.health.publish()
+        if not connected or self.health.idle() < self.ping_after:
+            return False
+        now = self.health.clock()
+        if self.last_ping is not None and now - self.last_ping < self.ping_after:
+            return False
+        self.last_ping = now
+        return True
+
+    # Runs check on a daemon thread, ping() and connected() are called from it
+    def start(self, ping, connected, name='Delta'):
+        thread = threading.Thread(
+            name='%s feed monitor' % name, target=self.run, args=(ping, connected))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def run(self, ping, connected):
+        while not self.stopped.wait(self.interval):
+            try:
+                if self.check(connected()):
+                    ping()
+            except Exception as e:
+                self.logger.info('Feed monitor error: %s' % str(e))
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,539 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from decimal import Decimal
+
+from aiohttp import web, WSMsgType
+
+from utils.rate_limiter import TokenBucket
+from utils.utility import TickSize
+
+# Products served when none are given, enough for single and multi product runs
+DEFAULT_PRODUCTS = [
+    {
+        'id': 1,
+        'symbol': 'BTCUSD',
+        'product_type': 'inverse_future',
+        'contract_type': 'perpetual_futures',
+        'tick_size': '0.5',
+        'contract_value': '1',
+        'is_quanto': False,
+        'maintenance_margin': '0.5',
+        'spot_index': {'symbol': '.DEXBTUSD'},
+        'settling_asset': {'id': 2, 'symbol': 'BTC'}
+    },
+    {
+        'id': 2,
+        'symbol': 'ETHUSD',
+        'product_type': 'future',
+        'contract_type': 'perpetual_futures',
+        'tick_size': '0.05',
+        'contract_value': '0.01',
+        'is_quanto': True,
+        'maintenance_margin': '0.5',
+        'spot_index': {'symbol': '.DEETHUSD'},
+        'settling_asset': {'id': 2, 'symbol': 'BTC'}
+    }
+]
+
+DEFAULT_PRICES = {1: Decimal(20000), 2: Decimal(1500)}
+
+
+class Market:
+    # Random walk of one product's mid price with a synthetic book around it
+    def __init__(self, product, price, depth=20):
+        self.product = product
+        self.ticks = TickSize(product['tick_size'])
+        self.mid = self.ticks.to_ticks(price)
+        self.depth = depth
+
+    def step(self, rng):
+        self.mid = max(self.depth + 2, self.mid + rng.choice((-2, -1, 0, 0, 1, 2)))
+
+    def best_bid(self):
+        return self.mid - 1
+
+    def best_ask(self):
+        return self.mid + 1
+
+    def levels(self, rng, orders):
+        buy = {self.best_bid() - i: rng.randint(1, 500) for i in range(self.depth)}
+        sell = {self.best_ask() + i: rng.randint(1, 500) for i in range(self.depth)}
+        # Our own resting orders show up in the book like anyone else's
+        for order in orders:
+            side = buy if order['side'] == 'buy' else sell
+            side[order['price_ticks']] = side.get(
+                order['price_ticks'], 0) + order['unfilled_size']
+        return (sorted(buy.items(), reverse=True), sorted(sell.items()))
+
+    def price(self):
+        return self.ticks.to_price(self.mid)
+
+
+class LocalExchange:
+    # In-process stand-in for the Delta REST and websocket APIs used by the
+    # bots, for load tests on one machine. Signatures are not checked.
+    # latency (+ up to jitter) delays every REST response, error_rate fails
+    # that share of REST calls with error_status, and rate_limit/burst
+    # answer 429s the way the exchange does. Resting orders fill when the
+    # simulated price trades through them.
+    def __init__(self, host='127.0.0.1', port=8765, products=None, prices=None,
+                 tick_interval=0.1, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=500, rate_limit=None, burst=None, seed=None):
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.products = {product['id']: product for product in (products or DEFAULT_PRODUCTS)}
+        prices = prices or DEFAULT_PRICES
+        self.markets = {
+            product_id: Market(product, prices.get(product_id, Decimal(100)))
+            for product_id, product in self.products.items()
+        }
+        self.tick_interval = tick_interval
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_bucket = TokenBucket(
+            rate_limit, burst or rate_limit) if rate_limit else None
+        self.rng = random.Random(seed)
+        self.forced_errors = []
+
+        self.orders = {}
+        self.next_order_id = 1
+        self.positions = {}
+        self.balance = Decimal(10)
+        self.leverage = {}
+        self.sockets = {}
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0,
+                      'orders_created': 0, 'orders_cancelled': 0, 'orders_edited': 0,
+                      'fills': 0, 'ws_messages': 0}
+
+        self.loop = None
+        self.thread = None
+        self.runner = None
+        self.ticker = None
+        self.started = threading.Event()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    @property
+    def ws_url(self):
+        return 'ws://%s:%d' % (self.host, self.port)
+
+    """     *******     LIFECYCLE   *******     """
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/', self.websocket)
+        app.router.add_get('/products', self.get_products)
+        app.router.add_get('/orderbook/{product_id}/l2', self.get_l2_orderbook)
+        app.router.add_get('/orders', self.get_orders)
+        app.router.add_post('/orders', self.create_order)
+        app.router.add_post('/orders/batch', self.batch_create)
+        app.router.add_delete('/orders/batch', self.batch_cancel)
+        app.router.add_put('/orders/batch', self.batch_edit)
+        app.router.add_post('/orders/leverage', self.set_leverage)
+        app.router.add_get('/positions', self.get_positions)
+        app.router.add_post('/positions/change_margin', self.change_margin)
+        app.router.add_get('/wallet/balance', self.get_wallet)
+        return app
+
+    async def start_async(self):
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            self.port = self.runner.addresses[0][1]
+        self.ticker = asyncio.ensure_future(self.tick_loop())
+        self.logger.info('Local exchange listening on %s' % self.url)
+
+    async def stop_async(self):
+        if self.ticker is not None:
+            self.ticker.cancel()
+        for ws in list(self.sockets):
+            await ws.close()
+        await self.runner.cleanup()
+
+    # Runs the exchange on its own event loop thread, port=0 picks a free port
+    def start(self):
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start_async())
+            self.started.set()
+            self.loop.run_forever()
+        self.thread = threading.Thread(name='Local exchange', target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        self.started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self.stop_async(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    # Thread safe control helpers for tests and benchmarks
+    def call(self, fn, *args):
+        if self.loop is None or threading.current_thread() is self.thread:
+            return fn(*args)
+        future = asyncio.run_coroutine_threadsafe(self.as_coroutine(fn, *args), self.loop)
+        return future.result()
+
+    async def as_coroutine(self, fn, *args):
+        result = fn(*args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    # The next len(statuses) REST calls fail with these status codes
+    def fail_next(self, *statuses):
+        self.call(self.forced_errors.extend, statuses)
+
+    # Closes every websocket, clients see a server side disconnect
+    def drop_connections(self):
+        async def close_all():
+            for ws in list(self.sockets):
+                await ws.close()
+        self.call(close_all)
+
+    """     *******     REST   *******     """
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path == '/':
+            return await handler(request)
+        self.stats['requests'] += 1
+        delay = self.latency + (self.rng.random() * self.jitter if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.rate_bucket is not None:
+            wait = self.rate_bucket.delay(time.monotonic())
+            if wait > 0:
+                self.stats['rate_limited'] += 1
+                return self.error(429, 'TooManyRequests', headers={
+                    'X-RATE-LIMIT-RESET': str(int(wait * 1000) + 1),
+                    'X-RATE-LIMIT-REMAINING': '0'
+                })
+            self.rate_bucket.take()
+        if self.forced_errors:
+            return self.error(self.forced_errors.pop(0), 'InjectedError')
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return self.error(self.error_status, 'InjectedError')
+        return await handler(request)
+
+    def error(self, status, message, headers=None):
+        self.stats['errors'] += 1
+        return web.json_response({'error': message}, status=status, headers=headers)
+
+    def product(self, product_id):
+        return self.products.get(int(product_id))
+
+    async def get_products(self, request):
+        etag = '"%d"' % len(self.products)
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.json_response(list(self.products.values()), headers={'ETag': etag})
+
+    async def get_l2_orderbook(self, request):
+        product_id = int(request.match_info['product_id'])
+        market = self.markets.get(product_id)
+        if market is None:
+            return self.error(404, 'NotFound')
+        buy, sell = market.levels(self.rng, self.open_orders(product_id))
+        to_str = market.ticks.to_str
+        return web.json_response({
+            'buy_book': [{'price': to_str(price), 'size': size} for price, size in buy],
+            'sell_book': [{'price': to_str(price), 'size': size} for price, size in sell],
+            'mark_price': str(market.price()),
+            'spot_price': str(market.price())
+        })
+
+    def open_orders(self, product_id=None):
+        return [order for order in self.orders.values()
+                if order['state'] == 'open' and (product_id is None or order['product_id'] == product_id)]
+
+    def order_response(self, order):
+        return {key: value for key, value in order.items() if key != 'price_ticks'}
+
+    def place(self, product_id, order):
+        product = self.product(order.get('product_id', product_id))
+        if product is None:
+            raise ValueError('InvalidProduct')
+        market = self.markets[product['id']]
+        size = int(order['size'])
+        if size <= 0 or order.get('side') not in ('buy', 'sell'):
+            raise ValueError('InvalidOrder')
+        price_ticks = market.ticks.to_ticks(order['limit_price'])
+        crosses = price_ticks >= market.best_ask() if order['side'] == 'buy' \
+            else price_ticks <= market.best_bid()
+        if crosses and str(order.get('post_only')).lower() == 'true':
+            raise ValueError('PostOnlyRejected')
+        placed = {
+            'id': self.next_order_id,
+            'product_id': product['id'],
+            'product': {'id': product['id'], 'symbol': product['symbol']},
+            'side': order['side'],
+            'size': size,
+            'unfilled_size': size,
+            'limit_price': market.ticks.to_str(price_ticks),
+            'price_ticks': price_ticks,
+            'order_type': order.get('order_type', 'limit_order'),
+            'post_only': order.get('post_only', 'false'),
+            'state': 'open',
+            'created_at': int(time.time() * 1000000)
+        }
+        self.next_order_id += 1
+        self.orders[placed['id']] = placed
+        # Crossing orders rest until the next tick fills them
+        self.stats['orders_created'] += 1
+        return placed
+
+    async def create_order(self, request):
+        body = await request.json()
+        try:
+            return web.json_response(self.order_response(self.place(body.get('product_id'), body)))
+        except ValueError as e:
+            return self.error(400, str(e))
+
+    async def batch_create(self, request):
+        body = await request.json()
+        try:
+            placed = [self.place(body['product_id'], order) for order in body['orders']]
+        except ValueError as e:
+            return self.error(400, str(e))
+        return web.json_response(list(map(self.order_response, placed)))
+
+    async def batch_cancel(self, request):
+        body = await request.json()
+        cancelled = []
+        for order in body['orders']:
+            existing = self.orders.get(order['id'])
+            if existing is not None and existing['state'] == 'open':
+                existing['state'] = 'cancelled'
+                del self.orders[order['id']]
+                self.stats['orders_cancelled'] += 1
+                cancelled.append(self.order_response(existing))
+        return web.json_response(cancelled)
+
+    async def batch_edit(self, request):
+        body = await request.json()
+        edited = []
+        for order in body['orders']:
+            existing = self.orders.get(order['id'])
+            if existing is None or existing['state'] != 'open':
+                return self.error(400, 'EditOrderError')
+            market = self.markets[existing['product_id']]
+            if 'limit_price' in order:
+                existing['price_ticks'] = market.ticks.to_ticks(order['limit_price'])
+                existing['limit_price'] = market.ticks.to_str(existing['price_ticks'])
+            size = order.get('size', order.get('unfilled_size'))
+            if size is not None:
+                existing['size'] = existing['unfilled_size'] = int(size)
+            self.stats['orders_edited'] += 1
+            edited.append(self.order_response(existing))
+        return web.json_response(edited)
+
+    async def get_orders(self, request):
+        product_id = request.query.get('product_id')
+        state = request.query.get('state', 'open')
+        orders = [order for order in self.orders.values()
+                  if order['state'] == state and (product_id is None or order['product_id'] == int(product_id))]
+        return web.json_response(list(map(self.order_response, orders)))
+
+    async def set_leverage(self, request):
+        body = await request.json()
+        self.leverage[int(body['product_id'])] = body['leverage']
+        return web.json_response({'product_id': int(body['product_id']), 'leverage': body['leverage']})
+
+    def position(self, product_id):
+        return self.positions.setdefault(product_id, {
+            'product_id': product_id,
+            'size': 0,
+            'entry_price': None,
+            'margin': '0',
+            'liquidation_price': None
+        })
+
+    async def get_positions(self, request):
+        product_id = request.query.get('product_id')
+        positions = [position for position in self.positions.values()
+                     if position['size'] != 0 and (product_id is None or position['product_id'] == int(product_id))]
+        return web.json_response(positions)
+
+    async def change_margin(self, request):
+        body = await request.json()
+        position = self.position(int(body['product_id']))
+        position['margin'] = str(Decimal(position['margin']) + Decimal(body['delta_margin']))
+        return web.json_response(position)
+
+    async def get_wallet(self, request):
+        margin = sum(Decimal(position['margin']) for position in self.positions.values())
+        return web.json_response({
+            'asset_id': int(request.query.get('asset_id', 2)),
+            'balance': str(self.balance),
+            'position_margin': str(margin),
+            'order_margin': '0',
+            'commission': '0'
+        })
+
+    """     *******     WEBSOCKET   *******     """
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets[ws] = {'channels': {}, 'authenticated': False}
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    await self.on_ws_message(ws, json.loads(message.data))
+                except Exception as e:
+                    await ws.send_str(json.dumps({'message': 'Invalid message: %s' % str(e)}))
+        finally:
+            self.sockets.pop(ws, None)
+        return ws
+
+    async def on_ws_message(self, ws, message):
+        state = self.sockets[ws]
+        if message['type'] == 'auth':
+            state['authenticated'] = True
+            await ws.send_str(json.dumps({'type': 'auth', 'success': True}))
+        elif message['type'] == 'subscribe':
+            for channel in message['payload']['channels']:
+                state['channels'].setdefault(channel['name'], set()).update(
+                    channel.get('symbols', []))
+            await ws.send_str(json.dumps({
+                'type': 'subscriptions',
+                'channels': [{'name': name, 'symbols': sorted(symbols)}
+                             for name, symbols in state['channels'].items()]
+            }))
+        elif message['type'] == 'unsubscribe':
+            for channel in message.get('channels', message.get('payload', {}).get('channels', [])):
+                state['channels'].pop(channel['name'], None)
+        elif message['type'] == 'ping':
+            await ws.send_str(json.dumps({'type': 'pong'}))
+
+    async def publish(self, channel, symbol, message, private=False):
+        data = None
+        for ws, state in list(self.sockets.items()):
+            if symbol not in state['channels'].get(channel, ()):
+                continue
+            if private and not state['authenticated']:
+                continue
+            if data is None:
+                data = json.dumps(message)
+            try:
+                await ws.send_str(data)
+                self.stats['ws_messages'] += 1
+            except Exception:
+                pass
+
+    async def tick_loop(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                self.logger.info('Local exchange tick failed: %s' % str(e))
+
+    async def tick(self):
+        for product_id, market in self.markets.items():
+            product = market.product
+            symbol = product['symbol']
+            market.step(self.rng)
+            fills = []
+            for order in self.open_orders(product_id):
+                if order['side'] == 'buy' and order['price_ticks'] >= market.best_ask() or \
+                        order['side'] == 'sell' and order['price_ticks'] <= market.best_bid():
+                    fills.append(self.fill(order, market))
+            buy, sell = market.levels(self.rng, self.open_orders(product_id))
+            to_str = market.ticks.to_str
+            await self.publish('l2_orderbook', symbol, {
+                'type': 'l2_orderbook',
+                'symbol': symbol,
+                'buy': [{'limit_price': to_str(price), 'size': size} for price, size in buy],
+                'sell': [{'limit_price': to_str(price), 'size': size} for price, size in sell],
+                'timestamp': int(time.time() * 1000000)
+            })
+            await self.publish('mark_price', 'MARK:%s' % symbol, {
+                'type': 'mark_price',
+                'symbol': 'MARK:%s' % symbol,
+                'product_id': product_id,
+                'price': str(market.price())
+            })
+            spot_symbol = product['spot_index']['symbol']
+            await self.publish('spot_price', spot_symbol, {
+                'type': 'spot_price',
+                'symbol': spot_symbol,
+                'price': str(market.price())
+            })
+            for fill in fills:
+                await self.publish('trading_notifications', symbol, fill, private=True)
+            if fills:
+                position = self.position(product_id)
+                await self.publish('positions', symbol, dict(
+                    position, type='positions', symbol=symbol), private=True)
+
+    # Fills the whole order at its limit price and moves our position
+    def fill(self, order, market):
+        size = order['unfilled_size']
+        price = market.ticks.to_price(order['price_ticks'])
+        signed = size if order['side'] == 'buy' else -size
+        position = self.position(order['product_id'])
+        old_size = position['size']
+        new_size = old_size + signed
+        if new_size == 0:
+            position['entry_price'] = None
+        elif old_size == 0 or (old_size > 0) != (signed > 0):
+            if abs(signed) > abs(old_size):
+                position['entry_price'] = str(price)
+        else:
+            entry = Decimal(position['entry_price'])
+            position['entry_price'] = str(
+                (entry * abs(old_size) + price * abs(signed)) / abs(new_size))
+        position['size'] = new_size
+        position['liquidation_price'] = str(price / 2) if new_size > 0 else (
+            str(price * 2) if new_size < 0 else None)
+        order['unfilled_size'] = 0
+        order['state'] = 'closed'
+        del self.orders[order['id']]
+        self.stats['fills'] += 1
+        return {
+            'type': 'fill',
+            'symbol': market.product['symbol'],
+            'product_id': order['product_id'],
+            'order_id': order['id'],
+            'side': order['side'],
+            'size': size,
+            'price': str(price),
+            'timestamp': int(time.time() * 1000000)
+        }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    exchange = LocalExchange(
+        host=os.getenv('LOCAL_EXCHANGE_HOST', '127.0.0.1'),
+        port=int(os.getenv('LOCAL_EXCHANGE_PORT', 8765)),
+        latency=float(os.getenv('LOCAL_EXCHANGE_LATENCY', 0)),
+        error_rate=float(os.getenv('LOCAL_EXCHANGE_ERROR_RATE', 0)),
+        rate_limit=float(os.getenv('LOCAL_EXCHANGE_RATE_LIMIT', 0)) or None
+    )
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(exchange.start_async())
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import threading
+from time import monotonic
+
+
+def order_product_id(order):
+    if 'product' in order:
+        return order['product']['id']
+    return order.get('product_id')
+
+
+class OpenOrderStore:
+    # In-memory mirror of our open orders. Seeded from REST, then kept current
+    # from batch responses and trading notifications. Anything we cannot
+    # account for marks the store stale so the next read reconciles over REST.
+    # Reconciliation is tracked per product so products sharing one
+    # connection can be reseeded independently.
+    def __init__(self, reconcile_interval=60):
+        self.reconcile_interval = reconcile_interval
+        self.orders = {}
+        self.tracking = False
+        self.last_reconciled = {}
+        self.lock = threading.Lock()
+
+    def needs_reconcile(self, product_id=None):
+        last_reconciled = self.last_reconciled.get(product_id)
+        if not self.tracking or last_reconciled is None:
+            return True
+        return monotonic() - last_reconciled > self.reconcile_interval
+
+    def mark_stale(self, product_id=None):
+        if product_id is None:
+            self.last_reconciled = {}
+        else:
+            self.last_reconciled.pop(product_id, None)
+
+    def reset(self, orders, product_id=None):
+        with self.lock:
+            if product_id is None:
+                self.orders = {}
+            else:
+                self.orders = {
+                    order_id: order for order_id, order in self.orders.items()
+                    if order_product_id(order) != product_id
+                }
+            for order in orders:
+                self.orders[order['id']] = order
+            self.last_reconciled[product_id] = monotonic()
+
+    def update(self, orders):
+        with self.lock:
+            for order in orders:
+                if order.get('state', 'open') == 'open' and int(order['unfilled_size']) > 0:
+                    self.orders[order['id']] = order
+                else:
+                    self.orders.pop(order['id'], None)
+
+    def remove(self, orders):
+        with self.lock:
+            for order in orders:
+                self.orders.pop(order['id'], None)
+
+    def apply_fill(self, message):
+        order_id = message.get('order_id')
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None:
+                # Fill for an order we do not know about, our view has a gap
+                self.mark_stale(message.get('product_id'))
+                return
+            unfilled_size = int(order['unfilled_size']) - int(message['size'])
+            if unfilled_size > 0:
+                order = dict(order, unfilled_size=unfilled_size)
+                self.orders[order_id] = order
+            else:
+                del self.orders[order_id]
+
+    def open_orders(self, product_id=None):
+        with self.lock:
+            orders = list(self.orders.values())
+        return [
+            dict(order) for order in orders
+            if product_id is None or order_product_id(order) == product_id
+        ]
@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import namedtuple
+
+
+class Level(namedtuple('Level', ['price', 'size', 'ticks'])):
+    __slots__ = ()
+
+    # Allow level['price'] so snapshots read like the old list of dicts
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+
+class BookSnapshot(namedtuple('BookSnapshot', ['symbol', 'version', 'asks', 'bids'])):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def changed_since(self, version):
+        return self.version != version
+
+    def top(self, k):
+        return self._replace(asks=self.asks[:k], bids=self.bids[:k])
+
+
+class BookSide:
+    # Levels are kept as a ticks -> size map plus a list of integer sort keys
+    # that is always ordered best-first (ticks for asks, negated ticks for
+    # bids), so best level is keys[0] and top-k is a slice.
+    def __init__(self, is_bid, ticks):
+        self.is_bid = is_bid
+        self.ticks = ticks
+        self.keys = []
+        self.levels = {}
+
+    def _key(self, price):
+        return -price if self.is_bid else price
+
+    def _price(self, key):
+        return -key if self.is_bid else key
+
+    def _level(self, price):
+        return Level(self.ticks.to_price(price), self.levels[price], price)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def replace(self, levels):
+        # levels: dict of ticks -> size for a full side snapshot. Exchange
+        # snapshots arrive already ordered, so timsort is linear here.
+        keys = [self._key(price) for price in levels]
+        keys.sort()
+        self.keys, self.levels = keys, levels
+
+    def best(self):
+        if not self.keys:
+            return None
+        return self._level(self._price(self.keys[0]))
+
+    def top(self, k=None):
+        keys = self.keys if k is None else self.keys[:k]
+        return tuple(self._level(price) for price in map(self._price, keys))
+
+
+class OrderBook:
+    def __init__(self, symbol, ticks, clock=time.time):
+        self.symbol = symbol
+        self.ticks = ticks
+        self.clock = clock
+        self.bids = BookSide(is_bid=True, ticks=ticks)
+        self.asks = BookSide(is_bid=False, ticks=ticks)
+        self.last_seen = None
+        self.version = 0
+        self._snapshot = None
+        self.lock = threading.Lock()
+
+    def normalize(self, levels, is_bid, price_key='limit_price'):
+        normalized = {}
+        to_ticks = self.ticks.to_ticks
+        for level in levels:
+            price = to_ticks(level[price_key])
+            # Bids at or below one tick are placeholder levels, never quoted
+            if is_bid and price <= 1:
+                continue
+            normalized[price] = normalized.get(price, 0) + int(level['size'])
+        return normalized
+
+    def apply_snapshot(self, buy, sell, price_key='limit_price'):
+        bids = self.normalize(buy, is_bid=True, price_key=price_key)
+        asks = self.normalize(sell, is_bid=False, price_key=price_key)
+        with self.lock:
+            self.bids.replace(bids)
+            self.asks.replace(asks)
+            self.last_seen = self.clock()
+            self.version += 1
+
+    def changed_since(self, version):
+        return self.version != version
+
+    def age(self):
+        if self.last_seen is None:
+            return float('inf')
+        return self.clock() - self.last_seen
+
+    def best_bid(self):
+        with self.lock:
+            return self.bids.best()
+
+    def best_ask(self):
+        with self.lock:
+            return self.asks.best()
+
+    # Snapshots are built at most once per version and shared by all readers
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.version:
+            return snapshot
+        with self.lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != self.version:
+                snapshot = BookSnapshot(
+                    symbol=self.symbol,
+                    version=self.version,
+                    asks=self.asks.top(),
+                    bids=self.bids.top()
+                )
+                self._snapshot = snapshot
+        return snapshot
+
+    def depth(self, k=None):
+        snapshot = self.snapshot()
+        return snapshot if k is None else snapshot.top(k)
+
+
+class OrderBookStore:
+    # ticks is used for any symbol not registered with add_symbol
+    def __init__(self, ticks, clock=time.time):
+        self.ticks = ticks
+        self.clock = clock
+        self.symbol_ticks = {}
+        self.books = {}
+
+    def add_symbol(self, symbol, ticks):
+        self.symbol_ticks[symbol] = ticks
+
+    def get(self, symbol):
+        return self.books.get(symbol)
+
+    def book(self, symbol):
+        book = self.books.get(symbol)
+        if book is None:
+            book = self.books.setdefault(
+                symbol, OrderBook(symbol, self.symbol_ticks.get(symbol, self.ticks), self.clock))
+        return book
+
+    def update(self, message):
+        book = self.book(message['symbol'])
+        book.apply_snapshot(message['buy'], message['sell'])
+        return book
+
+    def version(self, symbol):
+        book = self.books.get(symbol)
+        return book.version if book else 0
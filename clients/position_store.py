@@ -0,0 +1,56 @@
+import threading
+from time import monotonic
+
+
+class PositionStore:
+    # Latest position of each product from the positions channel. The
+    # exchange only sends a position when it changes, so an entry is trusted
+    # until the stream may have missed an update: a disconnect, a sequence
+    # gap, a margin change we made, or reconcile_interval seconds without
+    # an update or a REST read to confirm it.
+    def __init__(self, reconcile_interval=60, clock=monotonic):
+        self.reconcile_interval = reconcile_interval
+        self.clock = clock
+        self.positions = {}
+        self.confirmed = {}
+        self.sequence = {}
+        self.tracking = False
+        self.lock = threading.Lock()
+
+    def update(self, product_id, position, seq_no=None):
+        with self.lock:
+            last_seq_no = self.sequence.get(product_id)
+            self.positions[product_id] = position
+            if seq_no is not None:
+                self.sequence[product_id] = seq_no
+            if last_seq_no is not None and seq_no is not None and seq_no != last_seq_no + 1:
+                self.confirmed.pop(product_id, None)
+            else:
+                self.confirmed[product_id] = self.clock()
+
+    # Position read over REST, the sequence restarts from the next update
+    def reset(self, product_id, position):
+        with self.lock:
+            self.positions[product_id] = position
+            self.sequence.pop(product_id, None)
+            self.confirmed[product_id] = self.clock()
+
+    def mark_stale(self, product_id=None):
+        with self.lock:
+            if product_id is None:
+                self.confirmed = {}
+            else:
+                self.confirmed.pop(product_id, None)
+
+    def is_stale(self, product_id):
+        confirmed = self.confirmed.get(product_id)
+        return not self.tracking or confirmed is None or \
+            self.clock() - confirmed > self.reconcile_interval
+
+    # A copy callers may modify, None when the position has to be read
+    # over REST
+    def get(self, product_id):
+        with self.lock:
+            if self.is_stale(product_id) or product_id not in self.positions:
+                return None
+            return dict(self.positions[product_id])
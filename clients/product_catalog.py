@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class ProductCatalog:
+    # Products indexed by id and symbol, persisted to disk so restarts skip
+    # the products download while the cache is younger than ttl. Past that
+    # the client revalidates with the stored ETag and only downloads the
+    # list again if it changed. The client does the fetching, see
+    # Delta.refresh_catalog.
+    def __init__(self, path=None, ttl=3600):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.ttl = ttl
+        self.by_id = {}
+        self.by_symbol = {}
+        self.etag = None
+        self.fetched_at = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+            self.index(cache['products'])
+            self.etag = cache.get('etag')
+            self.fetched_at = cache['fetched_at']
+        except Exception as e:
+            self.logger.info('Ignoring product cache %s: %s' %
+                             (self.path, str(e)))
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'etag': self.etag,
+                    'fetched_at': self.fetched_at,
+                    'products': list(self.by_id.values())
+                }, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.info('Could not write product cache %s: %s' %
+                             (self.path, str(e)))
+
+    def index(self, products):
+        self.by_id = {product['id']: product for product in products}
+        self.by_symbol = {product['symbol']: product for product in products}
+
+    def is_fresh(self):
+        return self.fetched_at is not None and time.time() - self.fetched_at < self.ttl
+
+    # Product if the cache is fresh and knows it, None means refresh first
+    def cached(self, product_id):
+        if self.is_fresh():
+            return self.by_id.get(product_id)
+        return None
+
+    def get(self, product_id):
+        return self.by_id.get(product_id)
+
+    def get_by_symbol(self, symbol):
+        return self.by_symbol.get(symbol)
+
+    # Full product list from the exchange
+    def store(self, products, etag=None):
+        with self.lock:
+            self.index(products)
+            self.etag = etag
+            self.fetched_at = time.time()
+            self.save()
+
+    # Exchange answered 304 Not Modified to our ETag
+    def revalidated(self):
+        with self.lock:
+            self.fetched_at = time.time()
+            self.save()
+
+
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+
+# One catalog per exchange endpoint, shared by every client in the process.
+# PRODUCT_CACHE_DIR picks the cache directory, empty keeps it in memory.
+def product_catalog(base_url):
+    with catalogs_lock:
+        catalog = catalogs.get(base_url)
+        if catalog is None:
+            cache_dir = os.getenv('PRODUCT_CACHE_DIR', 'cache')
+            path = os.path.join(cache_dir, 'products-%s.json' %
+                                urlparse(base_url).netloc.replace(':', '-')) if cache_dir else None
+            catalog = ProductCatalog(
+                path, ttl=float(os.getenv('PRODUCT_CACHE_TTL', 3600)))
+            catalogs[base_url] = catalog
+        return catalog
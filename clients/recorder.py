@@ -0,0 +1,59 @@
+import atexit
+import gzip
+import logging
+import threading
+import time
+from time import monotonic
+
+
+class FrameRecorder:
+    # Appends raw websocket frames to a gzip file, one frame per line
+    # prefixed with its receive time. Appending adds a new gzip member, so
+    # a file can be reopened and extended across restarts. Data is flushed
+    # every flush_interval seconds, a crash loses at most that much.
+    def __init__(self, path, flush_interval=1.0, clock=time.time):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.file = gzip.open(path, 'ab', compresslevel=5)
+        self.lock = threading.Lock()
+        self.last_flush = monotonic()
+        self.frames = 0
+        atexit.register(self.close)
+
+    def record(self, frame, received_at=None):
+        if received_at is None:
+            received_at = self.clock()
+        # JSON never needs a raw newline, escaped ones inside strings stay
+        line = '%.6f %s\n' % (received_at, frame.replace('\n', ' '))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line.encode('utf-8'))
+            self.frames += 1
+            if monotonic() - self.last_flush > self.flush_interval:
+                self.file.flush()
+                self.last_flush = monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.logger.info('Recorded %d frames to %s' %
+                                 (self.frames, self.path))
+
+
+# Yields (received_at, frame) from recordings in order. A file cut short by
+# a crash is read up to its last flushed frame.
+def read_frames(paths):
+    for path in paths:
+        with gzip.open(path, 'rb') as f:
+            try:
+                for line in f:
+                    received_at, _, frame = line.decode('utf-8').partition(' ')
+                    if frame.endswith('\n'):
+                        yield float(received_at), frame[:-1]
+            except EOFError:
+                pass
@@ -0,0 +1,133 @@
+import logging
+from decimal import Decimal
+
+from clients.delta import DeltaStreamHandlers
+from utils.rate_limiter import RateLimiter
+from utils.utility import rest_order_format
+
+
+class SimulatedClock:
+    # Time only moves when the replay moves it, never backwards
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, now):
+        if now > self.now:
+            self.now = now
+
+
+class ReplayDelta(DeltaStreamHandlers):
+    # Offline stand-in for Delta fed from recorded websocket frames. Market
+    # data goes through the same stream handlers as the live clients, orders
+    # are kept in the local order store and every order call succeeds.
+    def __init__(self, products, clock, funds=Decimal(10 ** 6)):
+        self.logger = logging.getLogger(__name__)
+        self.init_stream_state(
+            ['trading_notifications', 'l2_orderbook', 'positions'], 60, clock,
+            monotonic_clock=clock)
+        self.init_product(products[0])
+        for product in products[1:]:
+            self.register_product(product)
+        self.product_id = self.product['id']
+        self.balance = funds
+        self.rate_limiter = RateLimiter()
+        self.next_order_id = 1
+        self.order_calls = {'create': 0, 'cancel': 0, 'edit': 0}
+
+    def replay(self, frame):
+        self.dispatch_frame(frame)
+
+    def isConnected(self):
+        return True
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def reconnect(self):
+        pass
+
+    def subscribeChannel(self, channel_name, symbol, callback=None):
+        self.callbacks[channel_name] = callback
+
+    def unsubscribeChannel(self, channel_name, symbol=None):
+        self.callbacks.pop(channel_name, None)
+
+    def market_depth(self, symbol, levels=None):
+        return self.orderbooks.book(symbol).depth(levels)
+
+    def mark_price(self, product_id):
+        return self.data['mark_price'].get(product_id)
+
+    def spot_price(self, spot_symbol, product_id):
+        return self.data['spot_price'].get(spot_symbol)
+
+    def position(self, product_id, fresh=False):
+        position = self.data['positions'].get(product_id)
+        if position is None:
+            position = self.position_from_response(None, product_id)
+        return dict(position)
+
+    def funds(self, product_id=None):
+        return self.balance
+
+    def available_funds(self, product_id=None):
+        return self.balance
+
+    def get_product(self, product_id):
+        return self.products.get(product_id)
+
+    def set_leverage(self, product_id, leverage):
+        pass
+
+    def addPositionMargin(self, product_id, delta_margin):
+        pass
+
+    def open_orders(self, product_id):
+        return self.order_store.open_orders(product_id)
+
+    def get_open_orders(self, product_id, *args, **kwargs):
+        return self.order_store.open_orders(product_id)
+
+    # Order calls are acknowledged instantly in simulated time
+    def batch_create(self, product_id, orders, trace=None):
+        created = []
+        for order in orders:
+            order = rest_order_format(order)
+            order.update({
+                'id': self.next_order_id,
+                'product_id': product_id,
+                'unfilled_size': order['size'],
+                'state': 'open'
+            })
+            self.next_order_id += 1
+            created.append(order)
+        self.order_store.update(created)
+        self.order_calls['create'] += len(created)
+        if trace is not None:
+            trace.request('create', self.clock(), len(created))
+        return created
+
+    def batch_cancel(self, product_id, orders, trace=None):
+        self.order_store.remove(orders)
+        self.order_calls['cancel'] += len(orders)
+        if trace is not None:
+            trace.request('cancel', self.clock(), len(orders))
+
+    def batch_edit(self, product_id, orders, trace=None):
+        edited = []
+        for order in orders:
+            existing = self.order_store.orders.get(order['id'])
+            if existing is not None:
+                edited.append(dict(existing, limit_price=order['limit_price'],
+                                   unfilled_size=order['unfilled_size']))
+        self.order_store.update(edited)
+        self.order_calls['edit'] += len(orders)
+        if trace is not None:
+            trace.request('edit', self.clock(), len(orders))
+        return edited
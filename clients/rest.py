@@ -0,0 +1,191 @@
+import logging
+import threading
+from time import monotonic
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.connection import is_connection_dropped
+from delta_rest_client import DeltaRestClient
+from delta_rest_client.delta_rest_client import get_time_stamp, generate_signature, query_string, body_string
+
+from utils.metrics import registry as metrics
+
+# (connect, read) timeouts in seconds by endpoint class
+TIMEOUTS = {
+    'read': (3, 27),
+    'create': (3, 27),
+    'cancel': (3, 27)
+}
+
+metrics.describe('delta_rest_requests_total', 'REST requests sent')
+metrics.describe('delta_rest_connections_total',
+                 'REST connections opened, each one a TCP and TLS handshake')
+
+
+def endpoint_class(method, path):
+    if path.startswith('orders'):
+        if method == 'DELETE':
+            return 'cancel'
+        elif method in ('POST', 'PUT'):
+            return 'create'
+    return 'read'
+
+
+class PooledDeltaRestClient(DeltaRestClient):
+    # DeltaRestClient opens a fresh connection per call, route every request
+    # through one keep-alive session sized for concurrent batch calls instead.
+    # timeouts overrides entries of TIMEOUTS, a timeout passed to request
+    # wins over both.
+    def __init__(self, base_url, api_key=None, api_secret=None, pool_size=4, rate_limiter=None, timeouts=None):
+        super().__init__(base_url, api_key=api_key, api_secret=api_secret)
+        self.logger = logging.getLogger(__name__)
+        self.rate_limiter = rate_limiter
+        self.pool_size = pool_size
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.warmed = 0
+        self.last_request = monotonic()
+        self.stopped = threading.Event()
+        labels = (('host', base_url.split('://')[-1]),)
+        metrics.register_function(
+            'delta_rest_requests_total', labels, lambda: self.sent, 'counter')
+        metrics.register_function(
+            'delta_rest_connections_total', labels,
+            lambda: self.connection_pool().num_connections, 'counter')
+
+    # The urllib3 pool requests sends base_url requests through, looked up
+    # with the same environment settings (CA bundle, proxies) as a request
+    def connection_pool(self):
+        settings = self.session.merge_environment_settings(
+            self.base_url, {}, None, None, None)
+        if hasattr(self.adapter, 'get_connection_with_tls_context'):
+            return self.adapter.get_connection_with_tls_context(
+                requests.Request('GET', self.base_url).prepare(),
+                settings['verify'], settings['proxies'], settings['cert'])
+        return self.adapter.get_connection(self.base_url, settings['proxies'])
+
+    # Leaves up to connections (the pool size by default) idle connections
+    # in the pool so the first requests skip the TCP and TLS handshakes.
+    # Each warm-up thread holds its HEAD response unread until all of them
+    # have one, so they cannot share a connection. Connections the server
+    # closed are opened again.
+    def prewarm(self, connections=None):
+        connections = min(connections or self.pool_size, self.pool_size)
+        barrier = threading.Barrier(connections)
+        threads = [threading.Thread(name='Delta REST prewarm', target=self.warm_connection, args=(barrier,))
+                   for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self
+
+    # Idle connections in the pool the server has not closed
+    def open_connections(self):
+        queue = self.connection_pool().pool
+        with queue.mutex:
+            idle = [conn for conn in queue.queue if conn is not None]
+        return sum(1 for conn in idle if not is_connection_dropped(conn))
+
+    # Warm-up requests count against the exchange's rate limit like any other
+    def warm_connection(self, barrier):
+        try:
+            if self.rate_limiter:
+                self.rate_limiter.acquire('read')
+            response = self.session.head(
+                self.base_url, stream=True, timeout=self.timeouts['read'])
+            with self.lock:
+                self.warmed += 1
+            try:
+                barrier.wait(self.timeouts['read'][0])
+            except threading.BrokenBarrierError:
+                pass
+            # Reading the empty body returns the connection to the pool
+            response.content
+        except Exception as e:
+            barrier.abort()
+            self.logger.info('Could not prewarm a %s connection: %s' %
+                             (self.base_url, str(e)))
+
+    # Servers close idle keep-alive connections. When no request was sent
+    # for interval seconds, ping() sends a cheap one, and when the server
+    # dropped some of the other connections the pool is warmed again, so
+    # reconnecting happens here instead of before an order.
+    def keep_alive(self, interval, ping):
+        if interval > 0:
+            thread = threading.Thread(
+                name='Delta REST keep-alive', target=self.keep_alive_loop, args=(interval, ping))
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def keep_alive_loop(self, interval, ping):
+        while not self.stopped.wait(interval / 2.0):
+            if monotonic() - self.last_request < interval:
+                continue
+            try:
+                ping()
+            except Exception as e:
+                self.logger.info('REST keep-alive ping failed: %s' % str(e))
+            if self.open_connections() < self.pool_size:
+                self.prewarm()
+
+    # Requests sent, warm-up requests, connections the pool created for
+    # both, and the requests of either kind that reused an open connection.
+    # A pooled connection the server closed is reopened in place and not
+    # counted again.
+    def stats(self):
+        connections = self.connection_pool().num_connections
+        return {
+            'pool_size': self.pool_size,
+            'requests': self.sent,
+            'prewarmed': self.warmed,
+            'connections': connections,
+            'reused': max(self.sent + self.warmed - connections, 0)
+        }
+
+    def close(self):
+        self.stopped.set()
+        self.session.close()
+
+    # timeout is a (connect, read) pair in seconds
+    def request(self, method, path, payload=None, query=None, auth=False, headers=None, timeout=None):
+        url = '%s/%s' % (self.base_url, path)
+        kind = endpoint_class(method, path)
+        if self.rate_limiter:
+            self.rate_limiter.acquire(kind)
+        if auth:
+            if self.api_key is None or self.api_secret is None:
+                raise Exception('Api_key or Api_secret missing')
+            timestamp = get_time_stamp()
+            signature_data = method + timestamp + '/' + path + \
+                query_string(query) + body_string(payload)
+            signature = generate_signature(self.api_secret, signature_data)
+            req_headers = {
+                'api-key': self.api_key,
+                'timestamp': timestamp,
+                'signature': signature,
+                'User-Agent': 'rest-client',
+                'Content-Type': 'application/json'
+            }
+        else:
+            req_headers = {'User-Agent': 'rest-client'}
+        if headers:
+            req_headers.update(headers)
+
+        with self.lock:
+            self.sent += 1
+        self.last_request = monotonic()
+        res = self.session.request(
+            method, url, data=body_string(payload), params=query,
+            timeout=timeout or self.timeouts[kind], headers=req_headers
+        )
+        if self.rate_limiter:
+            self.rate_limiter.on_response(res)
+        res.raise_for_status()
+        return res
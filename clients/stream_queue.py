@@ -0,0 +1,142 @@
+import threading
+from collections import OrderedDict, deque
+
+from utils.metrics import registry as metrics
+
+metrics.describe('delta_stream_queue_depth',
+                 'Websocket messages waiting for their channel consumer')
+metrics.describe('delta_stream_queue_dropped_total',
+                 'Websocket messages dropped or replaced before being applied')
+
+
+class LatestValueQueue:
+    # Holds at most one message per key. A put for a key that is still
+    # waiting replaces the message in place and counts it as dropped.
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, key, item):
+        with self.condition:
+            if key in self.pending:
+                self.dropped += 1
+            elif len(self.pending) >= self.maxsize:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[key] = item
+            self.max_depth = max(self.max_depth, len(self.pending))
+            self.condition.notify()
+        return True
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.pending and not self.condition.wait(timeout):
+                return None
+            if not self.pending:
+                return None
+            return self.pending.popitem(last=False)[1]
+
+
+class BoundedQueue:
+    # First in first out. put returns False and drops the item when full,
+    # the receive thread never blocks on a slow consumer.
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, key, item):
+        with self.condition:
+            if len(self.pending) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.pending.append(item)
+            self.max_depth = max(self.max_depth, len(self.pending))
+            self.condition.notify()
+        return True
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.pending and not self.condition.wait(timeout):
+                return None
+            if not self.pending:
+                return None
+            return self.pending.popleft()
+
+
+class ChannelDispatcher:
+    # Hands decoded messages from the receive thread to one consumer thread
+    # per channel, which calls dispatch(message, received_at).
+    # channel_events maps each channel to its event types, messages of
+    # other types are dispatched on the receive thread. latest_value
+    # channels keep only the newest message per symbol and product, the
+    # others are first in first out. overflow(channel, message) is called
+    # on the receive thread when a first in first out message was dropped.
+    def __init__(self, dispatch, overflow, channel_events, latest_value=(), maxsize=1024, name='Delta'):
+        self.dispatch = dispatch
+        self.overflow = overflow
+        self.name = name
+        self.closed = False
+        self.queues = {}
+        self.channels = {}
+        for channel, events in channel_events.items():
+            if channel in latest_value:
+                self.queues[channel] = LatestValueQueue(maxsize)
+            else:
+                self.queues[channel] = BoundedQueue(maxsize)
+            for event in events:
+                self.channels[event] = channel
+            labels = (('channel', channel),)
+            metrics.register_function(
+                'delta_stream_queue_depth', labels, self.queues[channel].__len__)
+            metrics.register_function(
+                'delta_stream_queue_dropped_total', labels,
+                lambda queue=self.queues[channel]: queue.dropped, 'counter')
+        self.threads = []
+        for channel in self.queues:
+            thread = threading.Thread(
+                name='%s %s consumer' % (name, channel), target=self.consume, args=(channel,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, message, received_at):
+        event = message.get('type')
+        channel = self.channels.get(event)
+        if channel is None:
+            self.dispatch(message, received_at)
+            return
+        key = (event, message.get('symbol'), message.get('product_id'))
+        if not self.queues[channel].put(key, (message, received_at)):
+            self.overflow(channel, message)
+
+    def consume(self, channel):
+        queue = self.queues[channel]
+        while not self.closed:
+            item = queue.get(timeout=1.0)
+            if item is not None:
+                self.dispatch(*item)
+
+    def close(self):
+        self.closed = True
+
+    def stats(self):
+        return {
+            channel: {
+                'depth': len(queue),
+                'max_depth': queue.max_depth,
+                'dropped': queue.dropped
+            }
+            for channel, queue in self.queues.items()
+        }
@@ -108,3 +108,11 @@ class UnknownError(Error):
     def __init__(self, client):
         self.client = client
         self.status_code = 1000
+
+
+class HTTPStatusError(Error):
+    # Raised by the asyncio client for non 2xx responses, mapped onto the
+    # errors above by handle_async_requests_exceptions
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
@@ -1,5 +1,6 @@
 import logging
-from time import sleep
+import asyncio
+from time import sleep, perf_counter
 import signal
 import sys
 import os
@@ -11,24 +12,130 @@ import operator
 import socket
 from functools import wraps
 import math
+import datetime
 
 import json
-from clients.delta import Delta
-from delta_rest_client import create_order_format, round_by_tick_size
+from clients.delta import Delta, DeltaProductView
+from clients.async_delta import AsyncDelta
+from delta_rest_client import create_order_format
 
 from utils.utility import takePrice, round_price_by_tick_size
+from utils.ladder import Ladder
+from utils.depth import DepthIndex
+from clients.recorder import FrameRecorder
+from utils.scheduler import RequoteScheduler
+from utils.rate_limiter import RateLimiter
+from utils.metrics import MetricsExporter, registry as metrics
+from utils.tracing import Trace, TraceLog
 from abc import ABC, abstractmethod
 from config import accounts
 import custom_exceptions
 
 
+recorder = None
+exporter = None
+trace_log = None
+
+
+# Websocket recording for offline replay, one file per process run
+def frame_recorder():
+    global recorder
+    record_dir = os.getenv('RECORD_DIR')
+    if record_dir and recorder is None:
+        os.makedirs(record_dir, exist_ok=True)
+        recorder = FrameRecorder(os.path.join(record_dir, 'frames-%s-%d.log.gz' % (
+            datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S'), os.getpid())))
+    return recorder
+
+
+# Tick to trade traces of every requote to TRACE_LOG, shared by the process
+def requote_trace_log():
+    global trace_log
+    path = os.getenv('TRACE_LOG')
+    if path and trace_log is None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        trace_log = TraceLog(path)
+    return trace_log
+
+
+# Run loop stage timings over HTTP in Prometheus text format and/or in the
+# log, one exporter per process
+def metrics_exporter():
+    global exporter
+    if exporter is None:
+        port = os.getenv('METRICS_PORT')
+        exporter = MetricsExporter(
+            metrics,
+            port=int(port) if port else None,
+            host=os.getenv('METRICS_HOST', '127.0.0.1'),
+            dump_interval=float(os.getenv('METRICS_DUMP_INTERVAL', 0))
+        ).start()
+    return exporter
+
+
+metrics.describe('market_maker_stage_seconds',
+                 'Time spent in each stage of a quote cycle')
+
+
+# (connect, read) timeouts of order requests and of everything else
+def rest_timeouts():
+    connect = float(os.getenv('REST_CONNECT_TIMEOUT', 3))
+    read = float(os.getenv('REST_READ_TIMEOUT', 27))
+    order = float(os.getenv('REST_ORDER_TIMEOUT', 27))
+    return {
+        'read': (connect, read),
+        'create': (connect, order),
+        'cancel': (connect, order)
+    }
+
+
+# Client settings shared by every product traded from this process
+def delta_client_options():
+    return {
+        'recorder': frame_recorder(),
+        'account': accounts.exchange_accounts('delta')[0],
+        'order_reconcile_interval': float(
+            os.getenv('ORDER_RECONCILE_INTERVAL', 60)),
+        'batch_concurrency': int(os.getenv('BATCH_CONCURRENCY', 4)),
+        'queue_size': int(os.getenv('STREAM_QUEUE_SIZE', 1024)),
+        'stale_after': {
+            'l2_orderbook': float(os.getenv('BOOK_STALE_AFTER', 2)),
+            'mark_price': float(os.getenv('PRICE_STALE_AFTER', 15)),
+            'spot_price': float(os.getenv('PRICE_STALE_AFTER', 15))
+        },
+        'ping_after': float(os.getenv('FEED_PING_AFTER', 40)),
+        'rest_pool_size': int(os.getenv('REST_POOL_SIZE', 0)) or None,
+        'rest_keepalive': float(os.getenv('REST_KEEPALIVE_INTERVAL', 30)),
+        'rest_timeouts': rest_timeouts(),
+        'rate_limiter': RateLimiter(
+            rate=float(os.getenv('RATE_LIMIT_PER_SECOND', 10)),
+            burst=int(os.getenv('RATE_LIMIT_BURST', 20))
+        )
+    }
+
+
 class BaseMarketMaker(ABC):
-    def __init__(self):
+    # Websocket events that trigger a requote in event scheduling mode
+    requote_events = ('spot_price', 'mark_price', 'l2_orderbook', 'fill')
+    # Channels the strategy needs streamed for its product
+    delta_channels = []
+
+    # Pass product_id and a connected Delta to trade one product over a
+    # connection shared with other strategies, see market_maker.multi
+    def __init__(self, product_id=None, delta=None):
+        self.product_id = product_id
+        self.shared_delta = delta
         self.trading_paused = False
         self.exit_run_loop = False
+        self.depth_indexes = {}
         self.bot_name = os.getenv("BOT")
         logfile = os.getenv('LOG_FILE')
         self.setup_logger(logfile)
+        metrics_exporter()
+        self.trace_log = requote_trace_log()
+        self.trace = None
         self.num_levels = int(os.getenv('NUM_LEVELS'))
         self.min_levels = int(os.getenv('MIN_NUM_LEVELS'))
         self.diff_size_percent = Decimal(os.getenv('DIFF_SIZE_PERCENT'))
@@ -41,8 +148,24 @@ class BaseMarketMaker(ABC):
         self.sell_price_scale_factor = Decimal(
             os.getenv('SELL_PRICE_SCALING_FACTOR'))
         self.delta_product_symbol = os.getenv("DELTA_PRODUCT_SYMBOL")
-        signal.signal(signal.SIGINT, self.exit)
-        self.delta_setup()
+        self.requote_scheduler = None
+        if os.getenv('SCHEDULING_MODE', 'interval').lower() == 'event':
+            self.requote_scheduler = RequoteScheduler(
+                min_interval=float(os.getenv('MIN_REQUOTE_INTERVAL', 0.2)),
+                max_staleness=float(
+                    os.getenv('MAX_REQUOTE_STALENESS', self.loop_interval)),
+                events=self.requote_events
+            )
+        # DELTA_CLIENT=async drives market data and orders from one asyncio
+        # loop, setup then happens inside async_run_loop
+        self.async_client = os.getenv(
+            'DELTA_CLIENT', 'threaded').lower() == 'async'
+        if self.shared_delta is None:
+            signal.signal(signal.SIGINT, self.exit)
+        if not self.async_client:
+            self.delta_setup()
+            if self.requote_scheduler:
+                self.delta.add_listener(self.requote_scheduler.notify)
 
     @abstractmethod
     def generate_orders(self):
@@ -57,18 +180,30 @@ class BaseMarketMaker(ABC):
     def apply_risk_limits(self, buy_orders, sell_orders):
         raise NotImplementedError
 
+    # Strategies that read from the client in generate_orders must override
+    # this to await the AsyncDelta coroutines
+    async def async_generate_orders(self):
+        return self.generate_orders()
+
+    def delta_options(self, channels, callback):
+        if self.product_id is None:
+            self.product_id = int(os.getenv('DELTA_PRODUCT_ID'))
+        options = delta_client_options()
+        options.update({
+            'channels': channels,
+            'product_id': self.product_id,
+            'callback': callback
+        })
+        return options
+
     def delta_setup(self, channels=[], callback=None):
-        maker_account = accounts.exchange_accounts('delta')[0]
-        self.product_id = int(os.getenv('DELTA_PRODUCT_ID'))
-        self.delta = Delta(
-            account=maker_account,
-            channels=channels,
-            product_id=self.product_id,
-            callback=callback
-        )
-        self.product = self.delta.get_product(self.product_id)
-        self.tick_size = round_price_by_tick_size(
-            self.product['tick_size'], self.product['tick_size'])
+        if self.shared_delta is not None:
+            self.delta = DeltaProductView(self.shared_delta, self.product_id)
+        else:
+            self.delta = Delta(**self.delta_options(channels, callback))
+        self.product = self.delta.product
+        self.ticks = self.delta.ticks
+        self.tick_size = self.ticks.tick_size
         self.logger.info(self.tick_size)
         self.cancel_open_orders()
 
@@ -77,6 +212,20 @@ class BaseMarketMaker(ABC):
         self.delta.set_leverage(
             product_id=self.product_id, leverage=max_delta_leverage)
 
+    async def async_delta_setup(self, channels=[], callback=None):
+        self.delta = AsyncDelta(**self.delta_options(channels, callback))
+        await self.delta.start()
+        self.product = self.delta.product
+        self.ticks = self.delta.ticks
+        self.tick_size = self.ticks.tick_size
+        self.logger.info(self.tick_size)
+        await self.async_cancel_open_orders()
+
+        # Set order leverage on delta
+        max_delta_leverage = os.getenv("MAX_LEVERAGE")
+        await self.delta.set_leverage(
+            product_id=self.product_id, leverage=max_delta_leverage)
+
     def is_inverse_future(self):
         return self.product['product_type'] == 'inverse_future'
 
@@ -108,18 +257,46 @@ class BaseMarketMaker(ABC):
             return Decimal(size) * (1 / Decimal(price)
                                     if self.is_inverse_future() else Decimal(price))
 
+    # Notional in tick units: integer for linear contracts, only comparable
+    # with other values from this method
+    def notional_ticks(self, size, ticks):
+        if size == 0 or ticks is None:
+            return 0
+        elif self.is_inverse_future():
+            return Decimal(size) / ticks
+        else:
+            return size * ticks
+
+    def price_ticks(self, order):
+        ticks = order.get('price_ticks')
+        if ticks is None:
+            ticks = order['price_ticks'] = self.ticks.to_ticks(
+                order['limit_price'])
+        return ticks
+
     def get_open_orders(self):
-        return self.delta.get_open_orders(self.product_id)
+        return self.delta.open_orders(self.product_id)
 
     def cancel_open_orders(self):
-        open_orders = self.get_open_orders()
+        # Always ask the exchange here, this is our recovery path
+        open_orders = self.delta.get_open_orders(self.product_id)
+        self.delta.order_store.reset(open_orders, self.product_id)
         self.logger.info('Cancelling %d open order on delta' %
                          len(open_orders))
 
         self.delta.batch_cancel(self.product_id, open_orders)
 
-    def delta_position(self):
-        current_position_delta = self.delta.position(self.product_id)
+    async def async_cancel_open_orders(self):
+        open_orders = await self.delta.get_open_orders(self.product_id)
+        self.delta.order_store.reset(open_orders, self.product_id)
+        self.logger.info('Cancelling %d open order on delta' %
+                         len(open_orders))
+
+        await self.delta.batch_cancel(self.product_id, open_orders)
+
+    # fresh reads the position over REST instead of the positions channel
+    def delta_position(self, fresh=False):
+        current_position_delta = self.delta.position(self.product_id, fresh=fresh)
         size = current_position_delta['size']
         if size != 0:
             size = current_position_delta['size'] * self.delta.contract_size
@@ -138,110 +315,186 @@ class BaseMarketMaker(ABC):
         # TODO : handle change in quantity
         if old_order['size'] == 0:
             return 3
-        change_price = (takePrice(new_order) -
-                        takePrice(old_order)) * Decimal(100.0000) / takePrice(old_order)
-        change_size = (new_order['size'] - old_order['size']
-                       ) * 100.0000 / old_order['size']
-
-        if abs(change_size) > self.diff_size_percent and abs(change_price) <= self.diff_price_percent:
+        old_ticks = old_order['price_ticks']
+        # Compare percentages cross-multiplied so no division is needed
+        price_changed = abs(new_order['price_ticks'] - old_ticks) * \
+            100 > self.diff_price_percent * old_ticks
+        size_changed = abs(new_order['size'] - old_order['size']) * \
+            100 > self.diff_size_percent * old_order['size']
+
+        if size_changed and not price_changed:
             return 2    # Size has changed significantly, price is same
-        elif abs(change_price) > self.diff_price_percent:
+        elif price_changed:
             self.logger.debug('Price diff %s %s' %
-                              (change_price, self.diff_price_percent))
+                              (new_order['price_ticks'] - old_ticks, self.diff_price_percent))
             return 1    # Price has changed significantly
         else:
             return 0    # Levels are same, no need to recreate
 
+    # Single merge pass over both ladders, each ordered best price first
     def calculate_orders_diff(self, side, old_orders, new_orders):
         orders_to_create = []
         orders_to_delete = []
 
-        ops = {
-            "<": operator.lt,
-            ">": operator.gt
-        }
-
+        # Old order is further from the touch than the new one
         if side == 'buy':
-            comparision = "<"
+            behind = operator.lt
         else:
-            comparision = ">"
+            behind = operator.gt
+        debug = self.logger.isEnabledFor(logging.DEBUG)
 
         i = 0
         j = 0
         level_index = 0
-
-        while i < len(old_orders) and j < len(new_orders) and level_index < self.num_levels:
-            diff_level = self.diff(
-                old_order=old_orders[i], new_order=new_orders[j])
-            self.logger.debug('DIFF %s %s %s %d' %
-                              (side, takePrice(old_orders[i]), takePrice(new_orders[j]), diff_level))
+        num_old = len(old_orders)
+        num_new = len(new_orders)
+        num_levels = self.num_levels
+
+        while i < num_old and j < num_new and level_index < num_levels:
+            old_order = old_orders[i]
+            new_order = new_orders[j]
+            diff_level = self.diff(old_order=old_order, new_order=new_order)
+            if debug:
+                self.logger.debug('DIFF %s %s %s %d' %
+                                  (side, old_order['limit_price'], new_order['limit_price'], diff_level))
             if diff_level == 2:
                 # Size has changed
-                orders_to_create.append(new_orders[j])
-                orders_to_delete.append(old_orders[i])
+                orders_to_create.append(new_order)
+                orders_to_delete.append(old_order)
                 level_index += 1
                 i += 1
                 j += 1
             elif diff_level == 1:
-                if ops[comparision](takePrice(old_orders[i]), takePrice(new_orders[j])):
-                    orders_to_create.append(new_orders[j])
+                if behind(old_order['price_ticks'], new_order['price_ticks']):
+                    orders_to_create.append(new_order)
                     level_index += 1
                     j += 1
                 else:
-                    orders_to_delete.append(old_orders[i])
+                    orders_to_delete.append(old_order)
                     i += 1
             else:
                 j += 1
                 i += 1
                 level_index += 1
-        while i < len(old_orders):
-            orders_to_delete.append(old_orders[i])
-            i += 1
-        while j < len(new_orders) and level_index < self.num_levels:
-            orders_to_create.append(new_orders[j])
-            level_index += 1
-            j += 1
+        orders_to_delete.extend(old_orders[i:])
+        orders_to_create.extend(
+            new_orders[j:j + max(0, num_levels - level_index)])
 
         return (orders_to_create, orders_to_delete)
 
+    # Records the time since started for a quote cycle stage and returns
+    # now, so consecutive stages can be chained
+    def observe_stage(self, stage, started):
+        now = perf_counter()
+        metrics.observe('market_maker_stage_seconds',
+                        (('product_id', self.product_id), ('stage', stage)), now - started)
+        return now
+
+    # Market data symbols whose updates can trigger a requote
+    def market_data_symbols(self):
+        spot_index = self.product.get('spot_index') or {}
+        return (self.delta.symbol, 'MARK:%s' % self.delta.symbol, spot_index.get('symbol'))
+
+    # The trace of a quote cycle starts from the latest market data update
+    # it could have seen and is handed down to the order calls
+    def start_trace(self):
+        if self.trace_log is None:
+            return None
+        self.trace = Trace(
+            self.product_id, self.delta.latest_stamp(self.market_data_symbols()), self.delta.clock)
+        return self.trace
+
+    def finish_trace(self):
+        if self.trace is not None:
+            self.trace_log.write(self.trace)
+            self.trace = None
+
     def converge_orders(self, buy_orders, sell_orders, max_bid=None, min_ask=None):
         # Get all open orders from delta
+        started = perf_counter()
         old_open_orders = self.get_open_orders()
+        started = self.observe_stage('get_open_orders', started)
+        orders_to_delete, orders_to_edit, orders_to_create = self.plan_orders(
+            old_open_orders, buy_orders, sell_orders, max_bid, min_ask)
+        started = self.observe_stage('plan_orders', started)
+
+        if orders_to_delete:
+            self.delta.batch_cancel(
+                self.product_id, orders_to_delete, trace=self.trace)
+            started = self.observe_stage('batch_cancel', started)
+        if orders_to_edit:
+            self.delta.batch_edit(
+                self.product_id, orders_to_edit, trace=self.trace)
+            started = self.observe_stage('batch_edit', started)
+        if orders_to_create:
+            self.delta.batch_create(
+                self.product_id, orders_to_create, trace=self.trace)
+            self.observe_stage('batch_create', started)
+
+    async def async_converge_orders(self, buy_orders, sell_orders, max_bid=None, min_ask=None):
+        started = perf_counter()
+        old_open_orders = await self.delta.open_orders(self.product_id)
+        started = self.observe_stage('get_open_orders', started)
+        orders_to_delete, orders_to_edit, orders_to_create = self.plan_orders(
+            old_open_orders, buy_orders, sell_orders, max_bid, min_ask)
+        started = self.observe_stage('plan_orders', started)
+
+        if orders_to_delete:
+            await self.delta.batch_cancel(
+                self.product_id, orders_to_delete, trace=self.trace)
+            started = self.observe_stage('batch_cancel', started)
+        if orders_to_edit:
+            await self.delta.batch_edit(
+                self.product_id, orders_to_edit, trace=self.trace)
+            started = self.observe_stage('batch_edit', started)
+        if orders_to_create:
+            await self.delta.batch_create(
+                self.product_id, orders_to_create, trace=self.trace)
+            self.observe_stage('batch_create', started)
+
+    # Work out which orders to cancel, edit and create to move the open
+    # orders to the new ladder. No network calls happen here.
+    def plan_orders(self, old_open_orders, buy_orders, sell_orders, max_bid=None, min_ask=None):
         for order in old_open_orders:
             order['size'] = order['unfilled_size']
+            self.price_ticks(order)
+        for order in buy_orders + sell_orders:
+            self.price_ticks(order)
         # filter current asks and bids from open orders
         old_sell_orders = list(
             filter(lambda x: x['side'] == 'sell', old_open_orders))
-        old_sell_orders.sort(key=takePrice)
+        old_sell_orders.sort(key=lambda x: x['price_ticks'])
         old_buy_orders = list(
             filter(lambda x: x['side'] == 'buy', old_open_orders))
-        old_buy_orders.sort(key=takePrice, reverse=True)
+        old_buy_orders.sort(key=lambda x: x['price_ticks'], reverse=True)
 
         orders_to_create = []
         orders_to_delete = []
         orders_to_edit = []
 
         if max_bid:
+            max_bid = self.ticks.to_ticks(max_bid, 'floor')
             # Collect all old buy orders with price > max_bid and add them to delete list
-            while len(old_buy_orders) > 0:
-                if Decimal(takePrice(old_buy_orders[0])) > max_bid:
-                    orders_to_delete.append(old_buy_orders.pop(0))
-                else:
-                    break
+            i = 0
+            while i < len(old_buy_orders) and old_buy_orders[i]['price_ticks'] > max_bid:
+                i += 1
+            orders_to_delete.extend(old_buy_orders[:i])
+            old_buy_orders = old_buy_orders[i:]
             # remove all buy orders where price > max_bid
-            buy_orders = list(filter(lambda x: Decimal(
-                takePrice(x)) <= max_bid, buy_orders))
+            buy_orders = list(
+                filter(lambda x: x['price_ticks'] <= max_bid, buy_orders))
 
         if min_ask:
+            min_ask = self.ticks.to_ticks(min_ask, 'ceil')
             # Collect all old sell orders with price < min_ask and add them to delete list
-            while len(old_sell_orders) > 0:
-                if Decimal(takePrice(old_sell_orders[0])) < min_ask:
-                    orders_to_delete.append(old_sell_orders.pop(0))
-                else:
-                    break
+            i = 0
+            while i < len(old_sell_orders) and old_sell_orders[i]['price_ticks'] < min_ask:
+                i += 1
+            orders_to_delete.extend(old_sell_orders[:i])
+            old_sell_orders = old_sell_orders[i:]
             # remove all sell orders where price < min_ask
-            sell_orders = list(filter(lambda x: Decimal(
-                takePrice(x)) >= min_ask, sell_orders))
+            sell_orders = list(
+                filter(lambda x: x['price_ticks'] >= min_ask, sell_orders))
 
         buy_create, buy_delete = self.calculate_orders_diff(
             side='buy',
@@ -282,25 +535,19 @@ class BaseMarketMaker(ABC):
         self.logger.info('Orders to be deleted %d' % len(orders_to_delete))
         self.logger.info('Orders to be edited %d' % len(orders_to_edit))
         self.logger.info('Orders to be created %d' % len(orders_to_create))
-
-        if orders_to_delete:
-            self.delta.batch_cancel(self.product_id, orders_to_delete)
-        if orders_to_edit:
-            self.delta.batch_edit(self.product_id, orders_to_edit)
-        if orders_to_create:
-            self.delta.batch_create(self.product_id, orders_to_create)
+        return orders_to_delete, orders_to_edit, orders_to_create
 
     def market_trend(self, create_orders, delete_orders, side='sell'):
         if side == 'sell':
             op = min
         else:
             op = max
-        old_best_price = Decimal(op(map(
-            lambda x: x['limit_price'], delete_orders
-        )))
-        new_best_price = Decimal(op(map(
-            lambda x: x['limit_price'], create_orders
-        )))
+        old_best_price = op(map(
+            lambda x: x['price_ticks'], delete_orders
+        ))
+        new_best_price = op(map(
+            lambda x: x['price_ticks'], create_orders
+        ))
         price_diff = new_best_price - old_best_price
         if price_diff > 0:
             return 1
@@ -322,33 +569,70 @@ class BaseMarketMaker(ABC):
                 'unfilled_size': create_order['size'],
                 'post_only': self.post_only
             })
-        delete_orders = list(filter(
-            lambda o: o.update(
-                {'notional': str(self.notional(o['size'], o['limit_price']))}) or o, delete_orders
-        ))
-        create_orders = list(filter(
-            lambda o: o.update(
-                {'notional': str(self.notional(o['size'], o['limit_price']))}) or o, create_orders
-        ))
+        notional_ticks = self.notional_ticks
+        delete_notional = [notional_ticks(o['size'], o['price_ticks'])
+                           for o in delete_orders]
+        create_notional = [notional_ticks(o['size'], o['price_ticks'])
+                           for o in create_orders]
+        # i and j are cursors into create_orders and delete_orders. Every
+        # step consumes a delete order, a create order is only consumed when
+        # it is turned into an edit.
         extra_notional = 0
-        while len(create_orders) > 0 and len(delete_orders) > 0:
-            delete_order = delete_orders.pop(0)
-            create_order = create_orders.pop(0)
-            create_order_notional = Decimal(create_order['notional'])
-            delete_order_notional = Decimal(delete_order['notional'])
+        i = 0
+        j = 0
+        while i < len(create_orders) and j < len(delete_orders):
+            delete_order_notional = delete_notional[j]
+            create_order_notional = create_notional[i]
             if create_order_notional > delete_order_notional + extra_notional:
                 extra_notional += delete_order_notional
-                orders_to_delete.append(delete_order)
-                create_orders.insert(0, create_order)
+                orders_to_delete.append(delete_orders[j])
             else:
-                edit_append(create_order, delete_order, orders_to_edit)
+                edit_append(create_orders[i], delete_orders[j], orders_to_edit)
                 extra_notional += delete_order_notional - \
                     create_order_notional
+                i += 1
+            j += 1
 
-        orders_to_create += create_orders
-        orders_to_delete += delete_orders
+        orders_to_create += create_orders[i:]
+        orders_to_delete += delete_orders[j:]
         return orders_to_edit, orders_to_create, orders_to_delete
 
+    # generate_orders may return lists of {'price', 'size'} dicts or Ladders,
+    # either way exchange order dicts come out
+    def prepare_orders(self, buy_orders, sell_orders):
+        started = perf_counter()
+        buy_orders, sell_orders = self.apply_risk_limits(
+            buy_orders, sell_orders)
+        started = self.observe_stage('apply_risk_limits', started)
+        ladders = isinstance(buy_orders, Ladder)
+        if ladders:
+            buy_orders, sell_orders = buy_orders.merged(), sell_orders.merged()
+        else:
+            buy_orders, sell_orders = self.merge_levels(
+                buy_orders), self.merge_levels(sell_orders)
+        started = self.observe_stage('merge_levels', started)
+        if ladders:
+            orders = self.ladder_order_format(buy_orders, sell_orders)
+        else:
+            orders = self.create_order_format(buy_orders, sell_orders)
+        self.observe_stage('create_order_format', started)
+        return orders
+
+    # Same as create_order_format on whole arrays of merged ladders, dicts
+    # are only built for the final orders
+    def ladder_order_format(self, buy_ladder, sell_ladder):
+        buy_ladder = buy_ladder.scaled(self.buy_price_scale_factor)
+        sell_ladder = sell_ladder.scaled(self.sell_price_scale_factor)
+        return self.ladder_orders(buy_ladder), self.ladder_orders(sell_ladder)
+
+    def ladder_orders(self, ladder):
+        price_ticks, sizes = ladder.quotes(self.delta.contract_size)
+        return [
+            self.limit_order_format(
+                price_ticks=price, size=size, side=ladder.side)
+            for price, size in zip(price_ticks.tolist(), sizes.tolist())
+        ]
+
     # Create order format for buy and sell orders
     def create_order_format(self, buy_orders, sell_orders):
         buy_price_scale_factor = self.buy_price_scale_factor
@@ -367,29 +651,28 @@ class BaseMarketMaker(ABC):
             sell_order['size'] = int(sell_order['size'])
 
         buy_orders = list(map(
-            lambda o: create_order_format(
-                price=round_by_tick_size(
-                    Decimal(o['price']) *
-                    buy_price_scale_factor,
-                    self.tick_size,
-                    'floor'
-                ),
-                size=o['size'], side='buy', product_id=self.product_id,
-                post_only=self.post_only
+            lambda o: self.limit_order_format(
+                price_ticks=self.ticks.to_ticks(
+                    Decimal(o['price']) * buy_price_scale_factor, 'floor'),
+                size=o['size'], side='buy'
             ), buy_orders))
         sell_orders = list(map(
-            lambda o: create_order_format(
-                price=round_by_tick_size(
-                    Decimal(o['price']) *
-                    sell_price_scale_factor,
-                    self.tick_size,
-                    'ceil'
-                ),
-                size=o['size'], side='sell', product_id=self.product_id,
-                post_only=self.post_only
+            lambda o: self.limit_order_format(
+                price_ticks=self.ticks.to_ticks(
+                    Decimal(o['price']) * sell_price_scale_factor, 'ceil'),
+                size=o['size'], side='sell'
             ), sell_orders))
         return buy_orders, sell_orders
 
+    def limit_order_format(self, price_ticks, size, side):
+        order = create_order_format(
+            price=self.ticks.to_str(price_ticks),
+            size=size, side=side, product_id=self.product_id,
+            post_only=self.post_only
+        )
+        order['price_ticks'] = price_ticks
+        return order
+
     def stop_trading(self, halt_message=None, send_email=True):
         self.cancel_open_orders()
         if halt_message:
@@ -411,61 +694,47 @@ class BaseMarketMaker(ABC):
         sleep(halting_time)
         self.trading_paused = False
 
+    async def async_pause_trading(self, halt_message=None, halting_time=10):
+        self.trading_paused = True
+        if halt_message:
+            self.logger.info("Trading paused: " + halt_message)
+        await self.async_cancel_open_orders()
+        self.logger.info('Sleeping for %d seconds' % halting_time)
+        await asyncio.sleep(halting_time)
+        self.trading_paused = False
+
     def exit(self, signum, frame):
+        if self.async_client:
+            # Let async_run_loop cancel orders and close the client
+            self.exit_run_loop = True
+            return
         self.stop_trading("Manual Termination", send_email=False)
 
+    # Depth index for one side ('bids' or 'asks') of a book snapshot, rebuilt
+    # only when the snapshot version changes
+    def depth_index(self, snapshot, side):
+        key = (snapshot.symbol, side)
+        index = self.depth_indexes.get(key)
+        if index is None or snapshot.changed_since(index.version):
+            index = DepthIndex(
+                snapshot[side], self.notional, version=snapshot.version)
+            self.depth_indexes[key] = index
+        return index
+
+    # List based wrappers around DepthIndex, orders is left untouched
     def get_top_orders_by_size(self, orders, size, enforce_min_levels=False):
-        min_size_per_level = Decimal(size / self.min_levels)
-        selected_orders = []
-        leftover_orders = []
-        while size > 0 and len(orders) > 0:
-            order = orders.pop(0)
-            size_limit = min_size_per_level
-            level_size = min(size_limit,
-                             size) if enforce_min_levels else size
-            if order['size'] > level_size:
-                selected_orders.append({
-                    'price': order['price'],
-                    'size': level_size
-                })
-                order['size'] -= level_size
-                size = size - level_size
-                leftover_orders.insert(0, order)
-            else:
-                size = size - order['size']
-                selected_orders.append(order)
-        for order in leftover_orders:
-            orders.insert(0, order)
-        return selected_orders
+        index = orders if isinstance(orders, DepthIndex) else DepthIndex(
+            orders, self.notional)
+        max_level_size = Decimal(
+            size / self.min_levels) if enforce_min_levels else None
+        return index.top_by_size(size, max_level_size)
 
     def get_top_orders_by_notional(self, orders, notional, enforce_min_levels=False):
-        max_notional_per_level = notional / self.min_levels
-        selected_orders = []
-        leftover_orders = []
-        while notional > 0 and len(orders) > 0:
-            order = orders.pop(0)
-            notional_limit = max_notional_per_level
-            level_notional = min(notional_limit,
-                                 notional) if enforce_min_levels else notional
-            order_notional = self.notional(order['size'], order['price'])
-            if order_notional > level_notional:
-                new_size = order['size'] * level_notional / order_notional
-                if new_size > 0:
-                    order['size'] -= new_size
-                    selected_orders.append({
-                        'price': order['price'],
-                        'size': new_size
-                    })
-                    notional = notional - \
-                        self.notional(new_size, order['price'])
-                if order['size'] > 0:
-                    leftover_orders.insert(0, order)
-            else:
-                notional = notional - order_notional
-                selected_orders.append(order)
-        for order in leftover_orders:
-            orders.insert(0, order)
-        return selected_orders, notional
+        index = orders if isinstance(orders, DepthIndex) else DepthIndex(
+            orders, self.notional)
+        max_level_notional = notional / \
+            self.min_levels if enforce_min_levels else None
+        return index.top_by_notional(notional, max_level_notional)
 
     def merge_levels(self, orders):
         merged_orders = []
@@ -482,57 +751,100 @@ class BaseMarketMaker(ABC):
             merged_orders.append(last_order)
         return merged_orders
 
+    def wait_for_next_cycle(self):
+        if self.requote_scheduler:
+            self.requote_scheduler.wait()
+        else:
+            sleep(self.loop_interval)
+
+    # Returns (message, pause, delay) for errors raised inside the run loop,
+    # None for errors we do not know how to handle
+    def loop_exception_action(self, e):
+        if isinstance(e, socket.timeout):
+            return str(e), False, 2
+        elif isinstance(e, custom_exceptions.InsufficientMarginError):
+            message = '%s exception raised at %s. Insufficient Margin Error, Status: %s' % (
+                self.bot_name, e.client, e.status_code)
+            return message, True, 5
+        elif isinstance(e, (custom_exceptions.LowerThanBankruptcyError, custom_exceptions.LowOrderSizeError, custom_exceptions.InvalidOrder, custom_exceptions.EditOrderError)):
+            message = '%s exception raised at %s. Bad Request Error, Status: %s' % (
+                self.bot_name, e.client, e.status_code)
+            return message, False, self.loop_interval
+        elif isinstance(e, (custom_exceptions.NonceError, custom_exceptions.AuthenticationError, custom_exceptions.ContractExpiredError)):
+            message = '%s exception raised at %s. Authentication Error, Status: %s' % (
+                self.bot_name, e.client, e.status_code)
+            return message, True, 2
+        elif isinstance(e, custom_exceptions.TooManyRequestsError):
+            message = '%s exception raised at %s. TooManyRequestsError, Status: %s' % (
+                self.bot_name, e.client, e.status_code)
+            # The rate limiter already holds requests back for the
+            # backoff window, just avoid spinning until it passes
+            return message, False, self.delta.rate_limiter.retry_after()
+        elif isinstance(e, (custom_exceptions.BadGatewayError, custom_exceptions.ServiceUnavailabeError, custom_exceptions.MarketDisrupted, custom_exceptions.InternalServerError)):
+            message = '%s exception raised at %s. ServerError, Status: %s' % (
+                self.bot_name, e.client, e.status_code)
+            return message, False, 5
+        elif isinstance(e, custom_exceptions.BadRequestError):
+            message = '%s exception raised at %s. BadRequestError, Status: %s' % (
+                self.bot_name, e.client, e.status_code)
+            return message, True, 5
+        elif isinstance(e, custom_exceptions.UnknownError):
+            message = '%s exception raised at %s. UnknownError, Status: %s' % (
+                self.bot_name, e.client, e.status_code)
+            return message, True, 5
+        return None
+
+    # One quote cycle: generate, risk check, format and converge. self.trace
+    # is the cycle's trace while it runs, None when tracing is off.
+    def run_cycle(self):
+        cycle_started = perf_counter()
+        self.start_trace()
+        try:
+            should_update, buy_orders, sell_orders = self.generate_orders()
+            self.observe_stage('generate_orders', cycle_started)
+            if should_update:
+                buy_orders, sell_orders = self.prepare_orders(
+                    buy_orders, sell_orders)
+                self.converge_orders(buy_orders, sell_orders)
+        finally:
+            self.finish_trace()
+        self.observe_stage('cycle', cycle_started)
+
+    async def async_run_cycle(self):
+        cycle_started = perf_counter()
+        self.start_trace()
+        try:
+            should_update, buy_orders, sell_orders = await self.async_generate_orders()
+            self.observe_stage('generate_orders', cycle_started)
+            if should_update:
+                buy_orders, sell_orders = self.prepare_orders(
+                    buy_orders, sell_orders)
+                await self.async_converge_orders(buy_orders, sell_orders)
+        finally:
+            self.finish_trace()
+        self.observe_stage('cycle', cycle_started)
+
     def run_loop(self):
-        while True:
+        if self.async_client:
+            return asyncio.run(self.async_run_loop())
+        while not self.exit_run_loop:
             self.logger.info(
                 '----------------Run loop started--------------')
             try:
                 if not self.trading_paused:
-                    should_update, buy_orders, sell_orders = self.generate_orders()
-                    if should_update:
-                        buy_orders, sell_orders = self.apply_risk_limits(
-                            buy_orders, sell_orders)
-                        buy_orders, sell_orders = self.merge_levels(
-                            buy_orders), self.merge_levels(sell_orders)
-                        buy_orders, sell_orders = self.create_order_format(
-                            buy_orders, sell_orders)
-                        self.converge_orders(buy_orders, sell_orders)
-                sleep(self.loop_interval)
-            except socket.timeout as e:
-                self.logger.info(str(e))
-                sleep(2)
-            except custom_exceptions.InsufficientMarginError as e:
-                message = '%s exception raised at %s. Insufficient Margin Error, Status: %s' % (
-                    self.bot_name, e.client, e.status_code)
-                self.pause_trading(halt_message=message, halting_time=5)
-            except (custom_exceptions.LowerThanBankruptcyError, custom_exceptions.LowOrderSizeError, custom_exceptions.InvalidOrder, custom_exceptions.EditOrderError) as e:
-                message = '%s exception raised at %s. Bad Request Error, Status: %s' % (
-                    self.bot_name, e.client, e.status_code)
-                self.logger.info(message)
-                sleep(self.loop_interval)
-            except (custom_exceptions.NonceError, custom_exceptions.AuthenticationError, custom_exceptions.ContractExpiredError) as e:
-                message = '%s exception raised at %s. Authentication Error, Status: %s' % (
-                    self.bot_name, e.client, e.status_code)
-                self.pause_trading(halt_message=message, halting_time=2)
-            except custom_exceptions.TooManyRequestsError as e:
-                message = '%s exception raised at %s. TooManyRequestsError, Status: %s' % (
-                    self.bot_name, e.client, e.status_code)
-                self.logger.info(message)
-                sleep(20)
-            except (custom_exceptions.BadGatewayError, custom_exceptions.ServiceUnavailabeError, custom_exceptions.MarketDisrupted, custom_exceptions.InternalServerError) as e:
-                message = '%s exception raised at %s. ServerError, Status: %s' % (
-                    self.bot_name, e.client, e.status_code)
-                self.logger.info(message)
-                sleep(5)
-            except custom_exceptions.BadRequestError as e:
-                message = '%s exception raised at %s. BadRequestError, Status: %s' % (
-                    self.bot_name, e.client, e.status_code)
-                self.pause_trading(halt_message=message, halting_time=5)
-            except custom_exceptions.UnknownError as e:
-                message = '%s exception raised at %s. UnknownError, Status: %s' % (
-                    self.bot_name, e.client, e.status_code)
-                self.pause_trading(halt_message=message, halting_time=5)
+                    self.run_cycle()
+                self.wait_for_next_cycle()
             except Exception as e:
+                action = self.loop_exception_action(e)
+                if action is not None:
+                    message, pause, delay = action
+                    if pause:
+                        self.pause_trading(
+                            halt_message=message, halting_time=delay)
+                    else:
+                        self.logger.info(message)
+                        sleep(delay)
+                    continue
                 message = '%s exception raised.Message: %s' % (
                     self.bot_name, str(e))
                 traceback.print_exc()
@@ -545,3 +857,42 @@ class BaseMarketMaker(ABC):
                         self.logger.info(
                             'Exception raised while pausing : %s' % str(e1))
                         pass
+
+    async def async_wait_for_next_cycle(self):
+        if self.requote_scheduler:
+            await self.requote_scheduler.wait_async()
+        else:
+            await asyncio.sleep(self.loop_interval)
+
+    async def async_run_loop(self):
+        await self.async_delta_setup()
+        if self.requote_scheduler:
+            self.delta.add_listener(self.requote_scheduler.notify)
+        while not self.exit_run_loop:
+            self.logger.info(
+                '----------------Run loop started--------------')
+            try:
+                if not self.trading_paused:
+                    await self.async_run_cycle()
+                await self.async_wait_for_next_cycle()
+            except Exception as e:
+                action = self.loop_exception_action(e)
+                if action is None:
+                    traceback.print_exc()
+                    action = '%s exception raised.Message: %s' % (
+                        self.bot_name, str(e)), True, 5
+                message, pause, delay = action
+                try:
+                    if pause:
+                        await self.async_pause_trading(
+                            halt_message=message, halting_time=delay)
+                    else:
+                        self.logger.info(message)
+                        await asyncio.sleep(delay)
+                except Exception as e1:
+                    self.logger.info(
+                        'Exception raised while pausing : %s' % str(e1))
+
+        await self.async_cancel_open_orders()
+        self.logger.info("Trading stopped: Manual Termination")
+        await self.delta.close()
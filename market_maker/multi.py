@@ -0,0 +1,60 @@
+import logging
+import signal
+import sys
+import threading
+
+from clients.delta import Delta
+from market_maker.base import delta_client_options
+
+
+class MultiProductRunner:
+    # Trades several products from one process. A single Delta connection
+    # streams every product, each strategy instance reads its own product
+    # through a DeltaProductView and runs its loop in its own thread. REST
+    # batches share the client's connection pool, executor and rate limiter.
+    def __init__(self, strategy_class, product_ids):
+        self.logger = logging.getLogger(__name__)
+        self.strategy_class = strategy_class
+        self.product_ids = product_ids
+        self.strategies = []
+        self.threads = []
+
+    def delta_setup(self):
+        options = delta_client_options()
+        options.update({
+            'channels': self.strategy_class.delta_channels,
+            'product_id': self.product_ids[0],
+            'product_ids': self.product_ids[1:]
+        })
+        self.delta = Delta(**options)
+
+    def run(self):
+        self.delta_setup()
+        for product_id in self.product_ids:
+            self.strategies.append(self.strategy_class(
+                product_id=product_id, delta=self.delta))
+        signal.signal(signal.SIGINT, self.exit)
+
+        for strategy in self.strategies:
+            thread = threading.Thread(
+                name='Strategy %s' % strategy.product_id, target=strategy.run_loop)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        # Join with a timeout so the main thread keeps handling signals
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    def exit(self, signum, frame):
+        for strategy in self.strategies:
+            strategy.exit_run_loop = True
+        for strategy in self.strategies:
+            try:
+                strategy.cancel_open_orders()
+            except Exception as e:
+                self.logger.info('Exception raised while cancelling orders for %s : %s' % (
+                    strategy.product_id, str(e)))
+        self.delta.disconnect()
+        self.logger.info("Trading stopped: Manual Termination")
+        sys.exit()
@@ -0,0 +1,163 @@
+import logging
+import os
+import random
+import sys
+import time
+
+import numpy
+
+from clients.delta import delta_endpoints
+from clients.product_catalog import product_catalog
+from clients.recorder import read_frames
+from clients.replay import ReplayDelta, SimulatedClock
+
+# Replays recorded websocket frames through a strategy as fast as possible.
+#
+#   STRATEGY=unhedged DELTA_PRODUCT_ID=... python -m market_maker.replay log/frames-*.log.gz
+#
+# Products are read from the product cache of REPLAY_CHAIN (mainnet by
+# default), so the bot must have run online once on that machine.
+
+
+class CycleSchedule:
+    # When a strategy would have requoted, in simulated time. Mirrors
+    # RequoteScheduler in event mode and the fixed sleep in interval mode.
+    def __init__(self, strategy):
+        self.strategy = strategy
+        scheduler = strategy.requote_scheduler
+        if scheduler is None:
+            self.min_interval = self.max_staleness = strategy.loop_interval
+            self.events = ()
+        else:
+            self.min_interval = scheduler.min_interval
+            self.max_staleness = scheduler.max_staleness
+            self.events = scheduler.events
+        self.last_run = None
+        self.pending_since = None
+
+    def notify(self, event, message=None):
+        if event in self.events and self.pending_since is None:
+            self.pending_since = self.strategy.delta.clock()
+
+    # The first cycle waits for the book and prices the strategy quotes
+    # from, a cycle before them only fails
+    def ready(self):
+        stamps = self.strategy.delta.market_stamps
+        return all(symbol in stamps for symbol in self.strategy.market_data_symbols() if symbol)
+
+    def due(self):
+        if self.last_run is None:
+            return float('-inf') if self.ready() else float('inf')
+        due = self.last_run + self.max_staleness
+        if self.pending_since is not None:
+            due = min(due, max(self.last_run + self.min_interval, self.pending_since))
+        return due
+
+    def ran(self, now):
+        self.last_run = now
+        self.pending_since = None
+
+
+class ReplayRunner:
+    def __init__(self, strategies, delta, clock):
+        self.strategies = strategies
+        self.delta = delta
+        self.clock = clock
+        self.schedules = []
+        for strategy in strategies:
+            schedule = CycleSchedule(strategy)
+            strategy.delta.add_listener(schedule.notify)
+            self.schedules.append(schedule)
+        self.frames = 0
+        self.cycles = 0
+        self.errors = 0
+        self.cycle_times = []
+        self.first_frame_at = None
+
+    def run_due_cycles(self, until):
+        while True:
+            schedule = min(self.schedules, key=CycleSchedule.due)
+            due = schedule.due()
+            if due > until:
+                return
+            self.clock.advance(due)
+            started = time.perf_counter()
+            try:
+                schedule.strategy.run_cycle()
+            except Exception as e:
+                self.errors += 1
+                if self.errors == 1:
+                    logging.getLogger(__name__).warning(
+                        'Replay cycle failed: %s' % str(e))
+            self.cycle_times.append(time.perf_counter() - started)
+            self.cycles += 1
+            schedule.ran(self.clock())
+
+    def run(self, frames):
+        started = time.perf_counter()
+        for received_at, frame in frames:
+            if self.first_frame_at is None:
+                self.first_frame_at = received_at
+                self.clock.advance(received_at)
+            else:
+                self.run_due_cycles(received_at)
+            self.clock.advance(received_at)
+            self.delta.replay(frame)
+            self.frames += 1
+        self.wall_time = time.perf_counter() - started
+        return self.report()
+
+    def report(self):
+        cycle_times = numpy.array(self.cycle_times or [0.0]) * 1000
+        simulated = self.clock() - (self.first_frame_at or self.clock())
+        return {
+            'frames': self.frames,
+            'cycles': self.cycles,
+            'errors': self.errors,
+            'simulated_seconds': simulated,
+            'wall_seconds': self.wall_time,
+            'speedup': simulated / self.wall_time if self.wall_time else 0,
+            'frames_per_second': self.frames / self.wall_time if self.wall_time else 0,
+            'cycles_per_second': self.cycles / self.wall_time if self.wall_time else 0,
+            'cycle_ms_mean': float(cycle_times.mean()),
+            'cycle_ms_p99': float(numpy.percentile(cycle_times, 99)),
+            'orders': dict(self.delta.order_calls)
+        }
+
+
+def strategy_class(strategy_name):
+    if strategy_name == 'unhedged':
+        from market_maker.unhedged import UnhedgedMarketMaker
+        return UnhedgedMarketMaker
+    raise BaseException('Unknown STRATEGY %s' % strategy_name)
+
+
+def main(paths):
+    seed = int(os.getenv('REPLAY_SEED', 0))
+    random.seed(seed)
+    numpy.random.seed(seed)
+    product_ids = os.getenv('DELTA_PRODUCT_IDS') or os.getenv('DELTA_PRODUCT_ID')
+    product_ids = [int(product_id) for product_id in product_ids.split(',')]
+    catalog = product_catalog(delta_endpoints(
+        os.getenv('REPLAY_CHAIN', 'mainnet'))[0])
+    products = [catalog.get(product_id) for product_id in product_ids]
+    if None in products:
+        raise BaseException('Products %s missing from the product cache' % product_ids)
+
+    clock = SimulatedClock()
+    delta = ReplayDelta(products, clock)
+    cls = strategy_class(os.getenv('STRATEGY', 'unhedged').lower())
+    strategies = [cls(product_id=product_id, delta=delta)
+                  for product_id in product_ids]
+    # Per cycle logging would dominate the run time
+    logging.getLogger().setLevel(
+        os.getenv('REPLAY_LOG_LEVEL', 'WARNING').upper())
+
+    report = ReplayRunner(strategies, delta, clock).run(read_frames(paths))
+    for key in sorted(report):
+        print('%-20s %s' % (key, report[key]))
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,39 +1,78 @@
 import os
-import random
 from time import sleep
 from decimal import Decimal
 from market_maker.base import BaseMarketMaker
 from clients.delta import Delta, OrderState, OrderType
 from delta_rest_client import cancel_order_format
 from utils.utility import round_price_by_tick_size
+from utils.ladder import Ladder
+from utils.depth import DepthIndex
 from utils.margin_helper import calculateMarginFromLiquidationPrice, funding_dampener
 import operator
+import numpy
 
 import json
 
 
 class UnhedgedMarketMaker(BaseMarketMaker):
-    def __init__(self):
+    delta_channels = ['trading_notifications', 'l2_orderbook', 'positions']
+
+    def __init__(self, product_id=None, delta=None):
         self.max_leverage = int(os.getenv('MAX_LEVERAGE'))
         self.auto_topup_threshold = Decimal(os.getenv('AUTO_TOPUP_THRESHOLD'))
         self.min_level_size = int(os.getenv('MIN_LEVEL_SIZE'))
         self.max_level_size = int(os.getenv('MAX_LEVEL_SIZE'))
-        super().__init__()
+        # Sizes we want impact prices for, comma separated
+        self.impact_sizes = [
+            Decimal(size) for size in os.getenv('IMPACT_SIZE', '').split(',') if size.strip()]
+        super().__init__(product_id=product_id, delta=delta)
 
     def delta_setup(self):
-        channels = ['trading_notifications', 'l2_orderbook', 'positions']
-        super().delta_setup(channels=channels)
+        super().delta_setup(channels=self.delta_channels)
         self.delta.subscribeChannel(
             'mark_price', "MARK:%s" % (self.product['symbol']))
         self.delta.subscribeChannel(
             'spot_price', self.product['spot_index']['symbol'])
 
+    async def async_delta_setup(self):
+        await super().async_delta_setup(channels=self.delta_channels)
+        await self.delta.subscribeChannel(
+            'mark_price', "MARK:%s" % (self.product['symbol']))
+        await self.delta.subscribeChannel(
+            'spot_price', self.product['spot_index']['symbol'])
+
+    # Open orders are cancelled before disconnect shuts the REST client down
     def exit(self, signum, frame):
-        self.delta.disconnect()
-        super().exit(signum, frame)
+        try:
+            super().exit(signum, frame)
+        finally:
+            if not self.async_client:
+                self.delta.disconnect()
+
+    # Impact prices for many sizes at once on each side of a book snapshot,
+    # served from the depth index so repeat queries on a version are free
+    def impact_prices(self, snapshot, sizes=None):
+        if sizes is None:
+            sizes = self.impact_sizes
+        return {
+            side: self.index_impact_prices(self.depth_index(snapshot, side), sizes)
+            for side in ('bids', 'asks')
+        }
 
-    # Get impact squareoff
+    # The same Decimals calculate_impact_price gives, from the index's
+    # integer tick sums. None for an empty book.
+    def index_impact_prices(self, index, sizes):
+        values, filled = index.impact_fills(sizes)
+        return [self.tick_size * int(value) / int(size) if size else None
+                for value, size in zip(values, filled)]
+
+    # orders may be a list of levels or a DepthIndex from depth_index()
     def get_impact_squareoff(self, size, orders):
+        if isinstance(orders, DepthIndex):
+            return self.index_impact_prices(orders, (size,))[0]
+        return self.calculate_impact_price(size, orders)
+
+    def calculate_impact_price(self, size, orders):
         fills = []
         for order in orders:
             fill_size = min(size, order['size'])
@@ -49,14 +88,17 @@ class UnhedgedMarketMaker(BaseMarketMaker):
     def apply_risk_limits(self, buy_orders, sell_orders):
         return buy_orders, sell_orders
 
-    def check_for_position_auto_topup(self):
-        current_delta_position = self.delta_position()
+    def check_for_position_auto_topup(self, fresh=False):
+        current_delta_position = self.delta_position(fresh)
         if current_delta_position['size'] != 0:
             current_liquidation_price = current_delta_position['liquidation_price']
             current_mark_price = self.delta.mark_price(self.product_id)
             distance = abs(current_liquidation_price -
                            current_mark_price) * 100 / current_mark_price
             if distance < self.auto_topup_threshold:
+                # Margin is only added against the exchange's own position
+                if not fresh:
+                    return self.check_for_position_auto_topup(fresh=True)
                 if current_delta_position['size'] > 0:
                     new_liquidation_price = current_mark_price * \
                         (1 - self.auto_topup_threshold/100)
@@ -109,15 +151,18 @@ class UnhedgedMarketMaker(BaseMarketMaker):
     def generate_orders(self):
         delta_spot_price = self.delta.spot_price(
             self.product['spot_index']['symbol'], self.product_id)
-        buy_orders = []
-        sell_orders = []
-        for i in range(1, self.num_levels + 1):
-            buy_orders.append({
-                'price': delta_spot_price - i * self.tick_size,
-                'size': random.randint(self.min_level_size, self.max_level_size)
-            })
-            sell_orders.append({
-                'price': delta_spot_price + i * self.tick_size,
-                'size': random.randint(self.min_level_size, self.max_level_size)
-            })
+        return self.generate_orders_around(delta_spot_price)
+
+    async def async_generate_orders(self):
+        delta_spot_price = await self.delta.spot_price(
+            self.product['spot_index']['symbol'], self.product_id)
+        return self.generate_orders_around(delta_spot_price)
+
+    def generate_orders_around(self, delta_spot_price):
+        spot_ticks = float(Decimal(delta_spot_price) / self.tick_size)
+        sizes = numpy.random.randint(
+            self.min_level_size, self.max_level_size + 1, size=(2, self.num_levels))
+        buy_orders = Ladder.around('buy', spot_ticks, self.num_levels, sizes[0])
+        sell_orders = Ladder.around(
+            'sell', spot_ticks, self.num_levels, sizes[1])
         return True, buy_orders, sell_orders
@@ -3,6 +3,7 @@ import json
 import traceback
 from raven import Client
 from market_maker.unhedged import UnhedgedMarketMaker
+from market_maker.multi import MultiProductRunner
 
 # from config import dotenv
 
@@ -14,8 +15,13 @@ def main():
     else:
         raise BaseException('Please pass STRATEGY environment variable')
 
+    product_ids = os.getenv('DELTA_PRODUCT_IDS')
     if strategy_name == 'unhedged':
-        UnhedgedMarketMaker().run_loop()
+        if product_ids:
+            MultiProductRunner(UnhedgedMarketMaker, [
+                int(product_id) for product_id in product_ids.split(',')]).run()
+        else:
+            UnhedgedMarketMaker().run_loop()
 
 
 if __name__ == '__main__':
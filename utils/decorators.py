@@ -56,3 +56,21 @@ def handle_requests_exceptions(client):
                     check_requests_error(client, status_code)
         return wraps(make_request)(wrapper)
     return inner_function
+
+
+def handle_async_requests_exceptions(client):
+    def inner_function(make_request):
+        async def wrapper(*args, **kwargs):
+            logger = args[0].logger
+            try:
+                response = await make_request(*args, **kwargs)
+                return response
+            except custom_exceptions.HTTPStatusError as e:
+                logger.info('%s Exception: %s ' % (client, e.text))
+                try:
+                    error_msg = json.loads(e.text)['error']
+                except Exception:
+                    error_msg = None
+                check_requests_error(client, e.status_code, error_msg)
+        return wraps(make_request)(wrapper)
+    return inner_function
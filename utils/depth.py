@@ -0,0 +1,138 @@
+from bisect import bisect_left
+from itertools import accumulate
+
+import numpy
+
+
+class DepthIndex:
+    # Cumulative size and notional over one side of a book, best level first.
+    # Built once per book version, queries never touch the levels passed in.
+    # notional(size, price) is the strategy's notional function.
+    def __init__(self, levels, notional, version=None):
+        self.version = version
+        self.prices = [level['price'] for level in levels]
+        self.sizes = [level['size'] for level in levels]
+        self.notional = notional
+        self.notionals = [notional(size, price)
+                          for size, price in zip(self.sizes, self.prices)]
+        self.cum_sizes = list(accumulate(self.sizes))
+        self.cum_notionals = list(accumulate(self.notionals))
+        # Integer tick prices, only book snapshot levels carry them
+        self.price_ticks = [level.ticks for level in levels] if not levels or hasattr(levels[0], 'ticks') else None
+        self.impact_arrays = None
+        self.impact_cache = {}
+
+    def __len__(self):
+        return len(self.prices)
+
+    def levels(self, end):
+        return [{'price': price, 'size': size}
+                for price, size in zip(self.prices[:end], self.sizes[:end])]
+
+    # Levels covering size, the last one cut down to what is left.
+    # max_level_size caps what is taken from any single level.
+    def top_by_size(self, size, max_level_size=None):
+        if size <= 0:
+            return []
+        if max_level_size is not None:
+            return self.capped_by_size(size, max_level_size)
+        k = bisect_left(self.cum_sizes, size)
+        if k == len(self.prices):
+            return self.levels(k)
+        selected = self.levels(k)
+        remaining = size - (self.cum_sizes[k - 1] if k else 0)
+        if self.sizes[k] > remaining:
+            selected.append({'price': self.prices[k], 'size': remaining})
+        else:
+            selected.append({'price': self.prices[k], 'size': self.sizes[k]})
+        return selected
+
+    def capped_by_size(self, size, max_level_size):
+        selected = []
+        for price, level_size in zip(self.prices, self.sizes):
+            if size <= 0:
+                break
+            take = min(max_level_size, size)
+            if level_size > take:
+                selected.append({'price': price, 'size': take})
+                size = size - take
+            else:
+                selected.append({'price': price, 'size': level_size})
+                size = size - level_size
+        return selected
+
+    # Levels covering notional and the notional left uncovered.
+    # max_level_notional caps what is taken from any single level.
+    def top_by_notional(self, notional, max_level_notional=None):
+        if notional <= 0:
+            return [], notional
+        if max_level_notional is not None:
+            return self.capped_by_notional(notional, max_level_notional)
+        k = bisect_left(self.cum_notionals, notional)
+        if k == len(self.prices):
+            return self.levels(k), notional - (self.cum_notionals[-1] if k else 0)
+        selected = self.levels(k)
+        remaining = notional - (self.cum_notionals[k - 1] if k else 0)
+        if self.notionals[k] > remaining:
+            size = self.sizes[k] * remaining / self.notionals[k]
+            if size > 0:
+                selected.append({'price': self.prices[k], 'size': size})
+                remaining = remaining - self.notional(size, self.prices[k])
+        else:
+            selected.append({'price': self.prices[k], 'size': self.sizes[k]})
+            remaining = remaining - self.notionals[k]
+        return selected, remaining
+
+    def capped_by_notional(self, notional, max_level_notional):
+        selected = []
+        for price, level_size, level_notional in zip(self.prices, self.sizes, self.notionals):
+            if notional <= 0:
+                break
+            take = min(max_level_notional, notional)
+            if level_notional > take:
+                size = level_size * take / level_notional
+                if size > 0:
+                    selected.append({'price': price, 'size': size})
+                    notional = notional - self.notional(size, price)
+            else:
+                selected.append({'price': price, 'size': level_size})
+                notional = notional - level_notional
+        return selected, notional
+
+    # Ticks times size filled and size filled by market orders of each
+    # size in sizes, as integer arrays so that value / filled * tick size is
+    # the exact average fill price. Sizes are whole contracts, those beyond
+    # the book fill against all of it, a zero size fills one contract at
+    # the best price and an empty book fills nothing. Results are kept for
+    # the life of the index.
+    def impact_fills(self, sizes):
+        key = tuple(sizes)
+        cached = self.impact_cache.get(key)
+        if cached is not None:
+            return cached
+        if self.impact_arrays is None:
+            ticks = numpy.array(self.price_ticks, dtype=numpy.int64)
+            cum_sizes = numpy.array(self.cum_sizes, dtype=numpy.int64)
+            cum_values = numpy.cumsum(
+                ticks * numpy.array(self.sizes, dtype=numpy.int64))
+            self.impact_arrays = ticks, cum_sizes, cum_values
+        ticks, cum_sizes, cum_values = self.impact_arrays
+
+        sizes = numpy.array([int(size) for size in sizes], dtype=numpy.int64)
+        if not len(ticks):
+            values = filled = numpy.zeros(len(sizes), dtype=numpy.int64)
+        else:
+            k = numpy.searchsorted(cum_sizes, sizes, side='left')
+            inside = k < len(ticks)
+            k = numpy.minimum(k, len(ticks) - 1)
+            size_before = numpy.where(k > 0, cum_sizes[k - 1], 0)
+            value_before = numpy.where(k > 0, cum_values[k - 1], 0)
+            filled = numpy.where(inside, sizes, cum_sizes[-1])
+            values = numpy.where(
+                inside, value_before + ticks[k] * (sizes - size_before), cum_values[-1])
+            values = numpy.where(filled > 0, values, ticks[0])
+            filled = numpy.where(filled > 0, filled, 1)
+        values.setflags(write=False)
+        filled.setflags(write=False)
+        self.impact_cache[key] = values, filled
+        return values, filled
@@ -0,0 +1,62 @@
+import numpy
+
+# Tick and contract values within this distance of an integer are treated as
+# that integer before floor/ceil, so float noise never moves an order a tick
+PRECISION = 6
+
+
+def exact_floor(values):
+    return numpy.floor(numpy.round(values, PRECISION))
+
+
+def exact_ceil(values):
+    return numpy.ceil(numpy.round(values, PRECISION))
+
+
+class Ladder:
+    # One side of a quote ladder as parallel arrays, best level first. Prices
+    # are in tick units and may be fractional until quotes() rounds them
+    # away from the touch, sizes are in base units.
+    def __init__(self, side, ticks, sizes):
+        self.side = side
+        self.ticks = numpy.asarray(ticks, dtype=numpy.float64)
+        self.sizes = numpy.asarray(sizes, dtype=numpy.float64)
+
+    # num_levels levels spaced step ticks apart, starting one step from center
+    @classmethod
+    def around(cls, side, center_ticks, num_levels, sizes, step=1):
+        offsets = numpy.arange(1, num_levels + 1) * step
+        if side == 'buy':
+            return cls(side, center_ticks - offsets, sizes)
+        return cls(side, center_ticks + offsets, sizes)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def scaled(self, factor):
+        if factor == 1:
+            return self
+        return Ladder(self.side, self.ticks * float(factor), self.sizes)
+
+    # Adjacent levels at the same price are merged into one
+    def merged(self):
+        if len(self.ticks) < 2:
+            return self
+        starts = numpy.flatnonzero(
+            numpy.concatenate(([True], self.ticks[1:] != self.ticks[:-1])))
+        if len(starts) == len(self.ticks):
+            return self
+        return Ladder(self.side, self.ticks[starts],
+                      numpy.add.reduceat(self.sizes, starts))
+
+    # Integer price ticks and contract sizes, levels smaller than one
+    # contract are dropped. Buys round down and sells round up.
+    def quotes(self, contract_size):
+        contracts = exact_floor(self.sizes / float(contract_size))
+        keep = contracts >= 1
+        ticks = self.ticks[keep]
+        if self.side == 'buy':
+            ticks = exact_floor(ticks)
+        else:
+            ticks = exact_ceil(ticks)
+        return ticks.astype(numpy.int64), contracts[keep].astype(numpy.int64)
@@ -0,0 +1,218 @@
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Histogram bucket upper bounds in seconds, 50us to 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    # Fixed buckets, observe is a bisect and three additions. Each series
+    # has a single writer thread (one strategy or client), readers may see
+    # a sample counted in one field and not yet in another.
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Upper bound of the bucket holding the q quantile
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+def format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, value) for key, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    # Series are keyed by metric name and a tuple of (label, value) pairs,
+    # callers pass the labels in a fixed order so no sorting is needed
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.functions = {}
+        self.descriptions = {}
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def histogram(self, name, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, labels, value):
+        self.histogram(name, labels).observe(value)
+
+    def counter(self, name, labels=()):
+        key = (name, labels)
+        counter = self.counters.get(key)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault(key, Counter())
+        return counter
+
+    # Series read from function() when rendered, for values the owner
+    # already keeps such as queue depths. metric_type is gauge or counter.
+    def register_function(self, name, labels, function, metric_type='gauge'):
+        with self.lock:
+            self.functions[(name, labels)] = (metric_type, function)
+
+    def series(self, metrics=None):
+        with self.lock:
+            return sorted((self.histograms if metrics is None else metrics).items(),
+                          key=lambda item: repr(item[0]))
+
+    def header(self, lines, name, metric_type):
+        if name in self.descriptions:
+            lines.append('# HELP %s %s' % (name, self.descriptions[name]))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        last_name = None
+        for (name, labels), counter in self.series(self.counters):
+            if name != last_name:
+                self.header(lines, name, 'counter')
+                last_name = name
+            lines.append('%s%s %s' % (name, format_labels(labels), format_value(counter.value)))
+        for (name, labels), (metric_type, function) in self.series(self.functions):
+            if name != last_name:
+                self.header(lines, name, metric_type)
+                last_name = name
+            lines.append('%s%s %s' % (name, format_labels(labels), format_value(function())))
+        for (name, labels), histogram in self.series():
+            if name != last_name:
+                self.header(lines, name, 'histogram')
+                last_name = name
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels, (('le', format_value(bound)),)), cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(histogram.sum)))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    # One line per series for the log: counter values, and count, mean and
+    # bucket p50/p99 in ms of histograms
+    def summary(self):
+        lines = []
+        for (name, labels), counter in self.series(self.counters):
+            lines.append('%s%s %s' % (name, format_labels(labels), counter.value))
+        for (name, labels), (metric_type, function) in self.series(self.functions):
+            lines.append('%s%s %s' % (name, format_labels(labels), function()))
+        for (name, labels), histogram in self.series():
+            if not histogram.count:
+                continue
+            lines.append('%s%s count=%d mean=%.3fms p50<=%.3fms p99<=%.3fms' % (
+                name, format_labels(labels), histogram.count,
+                histogram.sum / histogram.count * 1000,
+                histogram.quantile(0.5) * 1000, histogram.quantile(0.99) * 1000))
+        return lines
+
+
+registry = MetricsRegistry()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def metrics_handler(registry):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Scrapes would flood the bot log
+        def log_message(self, format, *args):
+            pass
+    return MetricsHandler
+
+
+class MetricsExporter:
+    # Serves the registry on http://host:port/metrics and/or logs its
+    # summary every dump_interval seconds, both from daemon threads
+    def __init__(self, registry, port=None, host='127.0.0.1', dump_interval=0):
+        self.logger = logging.getLogger(__name__)
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.dump_interval = dump_interval
+        self.server = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.port is not None:
+            self.server = ThreadingHTTPServer(
+                (self.host, self.port), metrics_handler(self.registry))
+            self.port = self.server.server_address[1]
+            thread = threading.Thread(
+                name='Metrics server', target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.logger.info('Serving metrics on http://%s:%d/metrics' %
+                             (self.host, self.port))
+        if self.dump_interval > 0:
+            thread = threading.Thread(name='Metrics dump', target=self.dump_loop)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def dump_loop(self):
+        while not self.stopped.wait(self.dump_interval):
+            for line in self.registry.summary():
+                self.logger.info(line)
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,144 @@
+import asyncio
+import threading
+from time import monotonic
+
+# Lower number wins when requests are queued behind the limiter
+PRIORITIES = {
+    'cancel': 0,
+    'create': 1,
+    'read': 2
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def refill(self, now, rate):
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * rate)
+        self.updated = now
+
+    def delay(self, now, scale=1.0):
+        rate = self.rate * scale
+        self.refill(now, rate)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    # Shared account budget plus a budget per endpoint class. Requests of a
+    # lower priority class wait while higher priority ones are queued. A 429
+    # halves the request rate and pauses everything for the advertised reset
+    # window (or an exponential backoff), successes slowly restore the rate.
+    def __init__(self, rate=10, burst=20, class_shares=None, min_scale=0.1,
+                 initial_backoff=1.0, max_backoff=20.0):
+        if class_shares is None:
+            class_shares = {'cancel': 1.0, 'create': 1.0, 'read': 0.5}
+        self.bucket = TokenBucket(rate, burst)
+        self.class_buckets = {
+            endpoint_class: TokenBucket(rate * share, max(1, burst * share))
+            for endpoint_class, share in class_shares.items()
+        }
+        self.waiting = {priority: 0 for priority in PRIORITIES.values()}
+        self.scale = 1.0
+        self.min_scale = min_scale
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.backoff = initial_backoff
+        self.penalty_until = 0
+        self.rate_limited_count = 0
+        self.condition = threading.Condition()
+
+    # Takes a token and returns 0, or returns how long to wait before
+    # trying again. Must be called with the condition held.
+    def poll(self, priority, endpoint_class):
+        now = monotonic()
+        wait = self.penalty_until - now
+        if wait > 0:
+            return wait
+        if any(self.waiting[p] for p in range(priority)):
+            return 0.01
+        class_bucket = self.class_buckets[endpoint_class]
+        wait = max(self.bucket.delay(now, self.scale),
+                   class_bucket.delay(now, self.scale))
+        if wait <= 0:
+            self.bucket.take()
+            class_bucket.take()
+            return 0
+        return wait
+
+    def acquire(self, endpoint_class='read'):
+        priority = PRIORITIES[endpoint_class]
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    wait = self.poll(priority, endpoint_class)
+                    if wait <= 0:
+                        return
+                    self.condition.wait(wait)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    async def acquire_async(self, endpoint_class='read'):
+        priority = PRIORITIES[endpoint_class]
+        with self.condition:
+            self.waiting[priority] += 1
+        try:
+            while True:
+                with self.condition:
+                    wait = self.poll(priority, endpoint_class)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            with self.condition:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def on_response(self, response):
+        self.on_status(response.status_code, response.headers)
+
+    def on_status(self, status_code, headers):
+        with self.condition:
+            remaining = headers.get('X-RATE-LIMIT-REMAINING')
+            if remaining is not None:
+                try:
+                    self.bucket.tokens = min(
+                        self.bucket.tokens, float(remaining))
+                except ValueError:
+                    pass
+            if status_code == 429:
+                self.rate_limited_count += 1
+                self.scale = max(self.min_scale, self.scale / 2)
+                retry_after = self.retry_after_header(headers)
+                if retry_after is None:
+                    retry_after = self.backoff
+                    self.backoff = min(self.max_backoff, self.backoff * 2)
+                self.penalty_until = max(
+                    self.penalty_until, monotonic() + retry_after)
+            elif status_code < 400:
+                self.scale = min(1.0, self.scale + 0.05)
+                self.backoff = self.initial_backoff
+            self.condition.notify_all()
+
+    def retry_after_header(self, headers):
+        try:
+            if 'Retry-After' in headers:
+                return float(headers['Retry-After'])
+            if 'X-RATE-LIMIT-RESET' in headers:
+                # Delta reports the reset window in milliseconds
+                return float(headers['X-RATE-LIMIT-RESET']) / 1000
+        except ValueError:
+            pass
+        return None
+
+    def retry_after(self):
+        return max(0, self.penalty_until - monotonic())
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from time import monotonic, sleep
+
+
+class RequoteScheduler:
+    # Wakes the quoting loop on market events. Events arriving while a cycle
+    # is running or while we wait out min_interval are coalesced into a single
+    # wakeup; max_staleness forces a cycle even if nothing has happened.
+    def __init__(self, min_interval, max_staleness, events=None):
+        self.min_interval = min_interval
+        self.max_staleness = max_staleness
+        self.events = events
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.last_run = None
+        self.async_event = None
+
+    def notify(self, event, message=None):
+        if self.events is not None and event not in self.events:
+            return
+        with self.condition:
+            self.pending.add(event)
+            self.condition.notify()
+        if self.async_event is not None:
+            self.async_event.set()
+
+    def wait(self):
+        with self.condition:
+            if self.last_run is not None:
+                deadline = self.last_run + self.max_staleness
+                while not self.pending:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+        if self.last_run is not None:
+            spacing = self.last_run + self.min_interval - monotonic()
+            if spacing > 0:
+                sleep(spacing)
+
+        with self.condition:
+            events, self.pending = self.pending, set()
+            self.last_run = monotonic()
+        return events
+
+    # Same as wait() for loops driven by asyncio, notify() must then be
+    # called from the event loop thread
+    async def wait_async(self):
+        if self.async_event is None:
+            self.async_event = asyncio.Event()
+        if self.last_run is not None:
+            deadline = self.last_run + self.max_staleness
+            while not self.pending:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.async_event.clear()
+                try:
+                    await asyncio.wait_for(self.async_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+            spacing = self.last_run + self.min_interval - monotonic()
+            if spacing > 0:
+                await asyncio.sleep(spacing)
+
+        with self.condition:
+            events, self.pending = self.pending, set()
+            self.last_run = monotonic()
+        return events
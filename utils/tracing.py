@@ -0,0 +1,119 @@
+import atexit
+import logging
+import threading
+from collections import namedtuple
+from time import monotonic
+
+
+# When a market data update for symbol was received, and when the exchange
+# says it was sent if the message carried a timestamp. Times are seconds
+# from the client's clock.
+class MarketStamp(namedtuple('MarketStamp', ['event', 'symbol', 'exchange_time', 'received_at'])):
+    __slots__ = ()
+
+
+# Exchange timestamps come in seconds, milliseconds, microseconds or
+# nanoseconds depending on the channel
+def exchange_time(message):
+    timestamp = message.get('timestamp')
+    if timestamp is None:
+        return None
+    try:
+        timestamp = float(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if timestamp > 1e17:
+        return timestamp / 1e9
+    elif timestamp > 1e14:
+        return timestamp / 1e6
+    elif timestamp > 1e11:
+        return timestamp / 1e3
+    return timestamp
+
+
+def ms(seconds):
+    return '-' if seconds is None else '%.3f' % (seconds * 1000)
+
+
+class Trace:
+    # One requote, from the market data update it acted on to the
+    # acknowledgement of every order request it sent. Order requests may
+    # be sent from several threads at once.
+    def __init__(self, product_id, stamp, clock):
+        self.product_id = product_id
+        self.stamp = stamp
+        self.clock = clock
+        self.started = clock()
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def request(self, kind, sent, orders):
+        acked = self.clock()
+        with self.lock:
+            self.requests.append((kind, sent, acked, orders))
+
+    # Compact key=value line, durations in milliseconds:
+    #   feed     exchange timestamp to receipt
+    #   wait     receipt to the start of the quote cycle
+    #   decide   cycle start to the first order request
+    #   <kind>   requests x orders : slowest round trip of that kind
+    #   t2t      receipt to the last acknowledgement
+    def line(self):
+        stamp = self.stamp
+        fields = ['%.6f' % self.started, 'product=%s' % self.product_id]
+        if stamp is None:
+            fields.append('event=-')
+            received_at = None
+        else:
+            received_at = stamp.received_at
+            fields.append('event=%s' % stamp.event)
+            fields.append('feed=%s' % ms(
+                None if stamp.exchange_time is None else received_at - stamp.exchange_time))
+            fields.append('wait=%s' % ms(self.started - received_at))
+        first_sent = min(sent for kind, sent, acked, orders in self.requests)
+        last_acked = max(acked for kind, sent, acked, orders in self.requests)
+        fields.append('decide=%s' % ms(first_sent - self.started))
+        for kind in ('cancel', 'edit', 'create'):
+            requests = [r for r in self.requests if r[0] == kind]
+            if requests:
+                fields.append('%s=%dx%d:%s' % (
+                    kind, len(requests), sum(r[3] for r in requests),
+                    ms(max(acked - sent for _, sent, acked, _ in requests))))
+        fields.append('t2t=%s' % ms(
+            None if received_at is None else last_acked - received_at))
+        return ' '.join(fields)
+
+
+class TraceLog:
+    # Appends one line per requote that sent orders, flushed at most every
+    # flush_interval seconds
+    def __init__(self, path, flush_interval=1.0):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+        self.last_flush = monotonic()
+        self.traces = 0
+        atexit.register(self.close)
+
+    def write(self, trace):
+        if not trace.requests:
+            return
+        line = trace.line() + '\n'
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line)
+            self.traces += 1
+            if monotonic() - self.last_flush > self.flush_interval:
+                self.file.flush()
+                self.last_flush = monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.logger.info('Wrote %d traces to %s' %
+                                 (self.traces, self.path))
@@ -1,22 +1,61 @@
 from decimal import Decimal
 
 
+class TickSize:
+    # Prices are carried as integer tick counts; tick metadata is computed
+    # once per product and Decimals/strings are only built at the edges.
+    def __init__(self, tick_size):
+        self.tick_size = Decimal(str(tick_size))
+        self.decimals = max(0, -self.tick_size.normalize().as_tuple().exponent)
+        self.scale = 10 ** self.decimals
+        self.units_per_tick = int(self.tick_size * self.scale)
+
+    def units(self, price):
+        # Fast path for exchange price strings that fit the tick precision
+        if isinstance(price, str):
+            whole, _, frac = price.partition('.')
+            if len(frac) <= self.decimals and whole.isdigit() and (not frac or frac.isdigit()):
+                return int(whole) * self.scale + int(frac.ljust(self.decimals, '0') or 0)
+        elif isinstance(price, int):
+            return price * self.scale
+        return None
+
+    def to_ticks(self, price, floor_or_ceil=None):
+        units = self.units(price)
+        if units is not None:
+            ticks, remainder = divmod(units, self.units_per_tick)
+            half = remainder * 2 >= self.units_per_tick
+        else:
+            ticks, remainder = divmod(Decimal(price), self.tick_size)
+            ticks = int(ticks)
+            # Decimal divmod truncates towards zero, move negatives to floor
+            if remainder < 0:
+                ticks, remainder = ticks - 1, remainder + self.tick_size
+            half = remainder * 2 >= self.tick_size
+        if remainder == 0:
+            return ticks
+        if floor_or_ceil is None:
+            floor_or_ceil = 'ceil' if half else 'floor'
+        return ticks + 1 if floor_or_ceil == 'ceil' else ticks
+
+    def to_price(self, ticks):
+        return ticks * self.tick_size
+
+    def to_str(self, ticks):
+        return str(ticks * self.tick_size)
+
+    def round(self, price, floor_or_ceil=None):
+        return self.to_ticks(price, floor_or_ceil) * self.tick_size
+
+
+tick_sizes = {}
+
+
 def round_price_by_tick_size(number, tick_size, floor_or_ceil=None):
-    tick_size = Decimal(tick_size)
-    number = Decimal(number)
-    remainder = number % tick_size
-    if remainder == 0:
-        number = number
-    if floor_or_ceil is None:
-        floor_or_ceil = 'ceil' if (remainder >= tick_size / 2) else 'floor'
-    if floor_or_ceil == 'ceil':
-        number = number - remainder + tick_size
-    else:
-        number = number - remainder
-    number_of_decimals = len(
-        format(Decimal(repr(float(tick_size))), 'f').split('.')[1])
-    number = round(number, number_of_decimals)
-    return number
+    ticks = tick_sizes.get(tick_size)
+    if ticks is None:
+        ticks = tick_sizes.setdefault(tick_size, TickSize(tick_size))
+    return ticks.round(number, floor_or_ceil)
 
 
 def get_position(size=0, entry_price=None, liquidation_price=None):
@@ -33,3 +72,11 @@ def takePrice(elem):
 
 def takeFirst(elem):
     return elem[0]
+
+
+# Keys we attach to order dicts for local bookkeeping, never sent over REST
+INTERNAL_ORDER_KEYS = ('notional', 'price_ticks')
+
+
+def rest_order_format(order):
+    return {key: value for key, value in order.items() if key not in INTERNAL_ORDER_KEYS}